@@ -0,0 +1,191 @@
+"""
+Local multi-agent test harness for gateway distribution.
+
+Serves the portal on a local port and runs one gateway_agent.py process
+per gateway. Each agent finds stub iptables-restore, iptables-save, ipset
+and nft binaries first on its PATH; the stubs record what they were fed
+in the agent's directory and can sleep to simulate a slow kernel. Nothing
+touches the host's firewall.
+
+    python agent_harness.py --agents 4 --users 400 --rules 5
+
+runs against a throwaway SQLite database. Each round changes one user
+and prints per-agent apply times and fragment downloads.
+"""
+import argparse
+import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STUB = """#!/bin/sh
+# Stub {name}: records its input, never touches the kernel
+sleep {latency}
+case "{name}" in
+    iptables-save) exit 0 ;;
+    nft) [ "$1" = "-f" ] || exit 0 ;;
+esac
+cat >> "$(dirname "$0")/{name}.in"
+"""
+
+STUBS = ('iptables-restore', 'iptables-save', 'ipset', 'nft')
+
+
+def write_stubs(directory, latency=0.0):
+    """
+    Creates the stub binaries in `directory`.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name in STUBS:
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(STUB.format(name=name, latency=latency))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def restored(directory, name='iptables-restore'):
+    """
+    Everything the agent in `directory` fed to the stub `name`.
+    """
+    try:
+        with open(os.path.join(directory, 'bin', f'{name}.in')) as f:
+            return f.read()
+    except OSError:
+        return ''
+
+
+class Portal:
+    """
+    Serves `app` on 127.0.0.1 in a background thread.
+    """
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_agents(portal_url, agents):
+    """
+    Runs `gateway_agent.py --once` for every (token, directory) in
+    `agents` in parallel. Returns their summaries in order (each run is a
+    fresh agent, so it always applies; mode 'noop' when the kernel already
+    held the ruleset); raises RuntimeError if one fails.
+    """
+    procs = []
+    for token, directory in agents:
+        env = dict(os.environ, PATH=os.path.join(directory, 'bin') + os.pathsep + os.environ.get('PATH', ''),
+                   FWM_AGENT_TOKEN=token)
+        procs.append(subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'gateway_agent.py'), '--portal', portal_url,
+             '--state-dir', os.path.join(directory, 'state'), '--once'],
+            env=env, cwd=HERE, stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+    summaries = []
+    for proc in procs:
+        out, err = proc.communicate(timeout=120)
+        if proc.returncode != 0:
+            raise RuntimeError(f"Agent failed ({proc.returncode}): {err.decode()}")
+        summaries.append(json.loads(out.decode().strip().splitlines()[-1]))
+    return summaries
+
+
+def setup_gateways(app, root, agents, users, rules, backend='iptables', latency=0.0):
+    """
+    Creates `agents` gateways with `users` users (bound round-robin) of
+    `rules` rules each, plus a stub directory per agent under `root`.
+    Returns [(gateway_id, token, directory)].
+    """
+    from models import db, Gateway, User, Rule
+    from ruleset_cache import bump_revision
+    import gateways
+
+    created = []
+    with app.app_context():
+        for i in range(agents):
+            token = gateways.new_token()
+            gateway = Gateway(name=f'gw{i}', backend=backend, token_hash=gateways.hash_token(token))
+            db.session.add(gateway)
+            db.session.flush()
+            directory = os.path.join(root, gateway.name)
+            write_stubs(os.path.join(directory, 'bin'), latency)
+            created.append((gateway.id, token, directory))
+        for n in range(users):
+            gateway_id = created[n % agents][0]
+            user = User(username=f'harness{n}', ip_address=f'10.{64 + n // 65536}.{n // 256 % 256}.{n % 256}',
+                        forward_mode='ROUTE', gateway_id=gateway_id)
+            user.rules = [Rule(destination_ip=f'172.16.{n % 256}.{r % 256}', destination_port=1000 + r,
+                               protocol='tcp', action='ACCEPT') for r in range(rules)]
+            db.session.add(user)
+        bump_revision()
+        db.session.commit()
+    return created
+
+
+def change_user(app, n):
+    """
+    Adds a rule to harness user `n`.
+    """
+    from models import db, User, Rule
+    from ruleset_cache import bump_revision
+    with app.app_context():
+        user = User.query.filter_by(username=f'harness{n}').one()
+        db.session.add(Rule(user_id=user.id, destination_ip='192.0.2.1', destination_port=443,
+                            protocol='tcp', action='ACCEPT'))
+        bump_revision(user)
+        db.session.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run gateway agents against a local portal with stub binaries.")
+    parser.add_argument('--agents', type=int, default=3)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--rules', type=int, default=5)
+    parser.add_argument('--backend', choices=('iptables', 'nftables'), default='iptables')
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds each stub call sleeps")
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix='fwm-harness-')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(root, 'portal.db')}"
+    from app import app, create_app
+    from models import db, SystemConfig, Gateway
+    create_app()
+    with app.app_context():
+        db.session.add(SystemConfig(host_ip='10.0.0.1', user_network_cidr='10.64.0.0/10', is_configured=True))
+        db.session.commit()
+    created = setup_gateways(app, root, args.agents, args.users, args.rules, args.backend, args.latency)
+    agents = [(token, directory) for _, token, directory in created]
+
+    with Portal(app) as portal:
+        print(f"Portal {portal.url}, {args.agents} agents, state in {root}")
+        for round_no in range(args.rounds):
+            if round_no:
+                change_user(app, round_no)
+            summaries = run_agents(portal.url, agents)
+            for i, summary in enumerate(summaries):
+                if summary is None:
+                    print(f"round {round_no} gw{i}: unchanged (304)")
+                else:
+                    print(f"round {round_no} gw{i}: revision {summary['revision']} {summary['mode']} "
+                          f"in {summary['apply_ms']:.0f} ms, fetched {summary['fetched']}/{summary['total']} fragments")
+        with app.app_context():
+            for gateway in Gateway.query.order_by(Gateway.id):
+                print(f"{gateway.name}: reported revision {gateway.applied_revision}, "
+                      f"{gateway.apply_ms:.0f} ms, error {gateway.last_error}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from models import db, ApplyJob
+from ruleset_cache import current_revision
+
+logger = logging.getLogger(__name__)
+
+# Seconds the worker sleeps between checks for jobs queued by other processes
+POLL_INTERVAL = 5.0
+
+# A job still 'running' after this long belongs to a worker that died
+STALE_AFTER = timedelta(minutes=10)
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+class ApplyQueue:
+    """
+    Runs ruleset applies in a background thread instead of the request.
+
+    Requests only insert (or join) a queued ApplyJob. The worker claims every
+    queued job at once and performs a single apply of the latest revision
+    for all of them, so a burst of Apply clicks costs one restore. Claiming
+    and applying happen under `lock`; pass a firewall_backend.FileLock so
+    workers in other processes never claim the same jobs or write to the
+    kernel concurrently.
+
+    `run()` performs the apply inside an app context and returns
+    (revision, result) where result is the dict from IptablesManager.
+    """
+    def __init__(self, app, run, poll_interval=POLL_INTERVAL, lock=None):
+        self.app = app
+        self.run = run
+        self.poll_interval = poll_interval
+        self.lock = lock or threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def enqueue(self):
+        """
+        Returns the pending job this request joins, creating it if there is
+        none. Commits.
+        """
+        job = ApplyJob.query.filter_by(status='queued').order_by(ApplyJob.id).first()
+        if job is None:
+            job = ApplyJob(status='queued')
+            db.session.add(job)
+        job.requested_revision = current_revision()
+        db.session.commit()
+        return job
+
+    def notify(self):
+        """
+        Wakes the worker, starting it on first use.
+        """
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name='apply-worker', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    self.run_pending()
+            except Exception:
+                logger.exception("Apply worker iteration failed")
+
+    def run_pending(self):
+        """
+        Claims all queued jobs and applies once on their behalf.
+        Returns the number of jobs completed.
+        """
+        with self.lock:
+            db.session.query(ApplyJob) \
+                .filter(ApplyJob.status == 'running', ApplyJob.started_at < datetime.utcnow() - STALE_AFTER) \
+                .update({ApplyJob.status: 'failed', ApplyJob.error: 'Interrupted'}, synchronize_session=False)
+            ids = [job_id for (job_id,) in
+                   db.session.query(ApplyJob.id).filter_by(status='queued').order_by(ApplyJob.id)]
+            if not ids:
+                return 0
+            db.session.query(ApplyJob).filter(ApplyJob.id.in_(ids), ApplyJob.status == 'queued') \
+                .update({ApplyJob.status: 'running', ApplyJob.started_at: datetime.utcnow()},
+                        synchronize_session=False)
+            db.session.commit()
+
+            started = time.monotonic()
+            try:
+                revision, result = self.run()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Apply failed: {e}")
+                values = {ApplyJob.status: 'failed', ApplyJob.error: str(e)}
+            else:
+                values = {ApplyJob.status: 'done', ApplyJob.applied_revision: revision,
+                          ApplyJob.mode: result['mode'], ApplyJob.added: result['added'],
+                          ApplyJob.removed: result['removed']}
+            values[ApplyJob.finished_at] = datetime.utcnow()
+            values[ApplyJob.duration] = time.monotonic() - started
+            db.session.query(ApplyJob).filter(ApplyJob.id.in_(ids), ApplyJob.status == 'running') \
+                .update(values, synchronize_session=False)
+            db.session.commit()
+            if len(ids) > 1:
+                logger.info(f"Coalesced {len(ids)} apply requests into one restore")
+            return len(ids)
+
+
+def job_status(job):
+    if job is None:
+        return {'status': 'none'}
+    return {
+        'id': job.id,
+        'status': job.status,
+        'pending': job.status in ACTIVE_STATUSES,
+        'requested_revision': job.requested_revision,
+        'applied_revision': job.applied_revision,
+        'mode': job.mode,
+        'added': job.added,
+        'removed': job.removed,
+        'error': job.error,
+        'requested_at': job.requested_at.isoformat() if job.requested_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'duration': job.duration,
+    }
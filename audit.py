@@ -0,0 +1,333 @@
+import atexit
+import calendar
+import json
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import delete, func, insert
+from sqlalchemy.exc import IntegrityError
+
+from models import db, AuditEntry, AuditPartition
+from pagination import keyset_page, DEFAULT_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Seconds the writer thread waits before flushing what was recorded
+FLUSH_INTERVAL = 1.0
+
+# Buffered entries that wake the writer before FLUSH_INTERVAL
+BATCH_SIZE = 500
+
+# Buffered entries at which record() flushes inline, slowing writes down
+# to what the database keeps up with rather than growing without bound
+MAX_BUFFER = 10000
+
+# Whole months kept before the current one
+RETENTION_MONTHS = 12
+PURGE_INTERVAL = 3600
+
+# Ids per DELETE when purging, each in its own transaction
+DELETE_BATCH = 10000
+
+# Fields whose before/after values are recorded
+USER_FIELDS = ('username', 'full_name', 'email', 'contact', 'user_type', 'forward_mode',
+               'ip_address', 'gateway_id', 'valid_from', 'expires_at')
+RULE_FIELDS = ('user_id', 'destination_ip', 'destination_port', 'protocol', 'action',
+               'valid_from', 'expires_at')
+CONFIG_FIELDS = ('host_ip', 'user_network_cidr')
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def values(obj, fields):
+    """
+    The audited fields of a User, Rule or SystemConfig (or of a column
+    dict of one) as JSON-ready values.
+    """
+    if isinstance(obj, dict):
+        return {field: _value(obj.get(field)) for field in fields}
+    return {field: _value(getattr(obj, field)) for field in fields}
+
+
+def diff(before, after):
+    """
+    {field: [before, after]} for the fields that differ between two
+    values() dicts. Either side may be empty (an add or a delete).
+    """
+    changes = {}
+    for field in dict.fromkeys(list(before) + list(after)):
+        old, new = before.get(field), after.get(field)
+        if old != new:
+            changes[field] = [old, new]
+    return changes
+
+
+def period(timestamp):
+    """
+    The YYYYMM partition of a Unix time.
+    """
+    tm = time.gmtime(timestamp)
+    return tm.tm_year * 100 + tm.tm_mon
+
+
+def period_start(value):
+    return calendar.timegm((value // 100, value % 100, 1, 0, 0, 0))
+
+
+def shift_period(value, months):
+    index = (value // 100) * 12 + value % 100 - 1 + months
+    return (index // 12) * 100 + index % 12 + 1
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+
+def decode(entry):
+    return json.loads(entry.data) if entry.data else {}
+
+
+def serialize(entry):
+    return {'id': entry.id, 'timestamp': entry.timestamp, 'action': entry.action,
+            'user_id': entry.user_id, 'rule_id': entry.rule_id, 'revision': entry.revision,
+            'actor': entry.actor, 'data': decode(entry)}
+
+
+def _start_partition(value, first_id):
+    # Another process may have started the month with a lower id
+    try:
+        with db.session.begin_nested():
+            db.session.add(AuditPartition(period=value, first_id=first_id))
+    except IntegrityError:
+        db.session.query(AuditPartition) \
+            .filter(AuditPartition.period == value, AuditPartition.first_id > first_id) \
+            .update({AuditPartition.first_id: first_id}, synchronize_session=False)
+
+
+def write(entries, known_periods=()):
+    """
+    Inserts `entries` (AuditEntry column dicts) in one executemany and
+    records the first id of every month not in `known_periods`. Does not
+    commit. Returns the months written.
+    """
+    periods = {period(entry['timestamp']) for entry in entries}
+    new_periods = sorted(periods - set(known_periods))
+    last_id = 0
+    if new_periods:
+        last_id = db.session.query(func.max(AuditEntry.id)).scalar() or 0
+    db.session.execute(insert(AuditEntry), entries)
+    for value in new_periods:
+        first_id = db.session.query(func.min(AuditEntry.id)) \
+            .filter(AuditEntry.id > last_id, AuditEntry.timestamp >= period_start(value)).scalar()
+        if first_id is not None:
+            _start_partition(value, first_id)
+    return periods
+
+
+def purge(now=None, months=RETENTION_MONTHS, batch_size=DELETE_BATCH):
+    """
+    Drops the months older than the current one minus `months`: their
+    entries are deleted by primary key range, `batch_size` ids per
+    transaction, then their partition rows. Commits. Returns the number
+    of entries deleted.
+    """
+    keep_from = shift_period(period(int(now if now is not None else time.time())), -months)
+    if db.session.query(AuditPartition.period).filter(AuditPartition.period < keep_from).first() is None:
+        return 0
+    boundary = db.session.query(func.min(AuditPartition.first_id)) \
+        .filter(AuditPartition.period >= keep_from).scalar()
+    if boundary is None:
+        boundary = (db.session.query(func.max(AuditEntry.id)).scalar() or 0) + 1
+    start = db.session.query(func.min(AuditEntry.id)).scalar() or boundary
+    deleted = 0
+    while start < boundary:
+        end = min(start + batch_size, boundary)
+        deleted += db.session.execute(
+            delete(AuditEntry).where(AuditEntry.id >= start, AuditEntry.id < end)).rowcount
+        db.session.commit()
+        start = end
+    db.session.execute(delete(AuditPartition).where(AuditPartition.period < keep_from))
+    db.session.commit()
+    if deleted:
+        logger.info(f"Purged {deleted} audit entries before {keep_from}")
+    return deleted
+
+
+def user_history(user_id, after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    A user's entries, newest first, one page at a time: a range scan of
+    the (user_id, timestamp) index however long the history is.
+    """
+    query = AuditEntry.query.filter(AuditEntry.user_id == user_id)
+    return keyset_page(query, AuditEntry.timestamp, AuditEntry.id, after=after, before=before,
+                       descending=True, limit=limit)
+
+
+def entries_page(user_id=None, after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    One page of a user's history, or of all entries newest first.
+    """
+    if user_id is not None:
+        return user_history(user_id, after, before, limit)
+    return keyset_page(AuditEntry.query, AuditEntry.id, AuditEntry.id, after=after, before=before,
+                       descending=True, limit=limit)
+
+
+def revision_changes(from_revision, to_revision):
+    """
+    Entries of the changes that took the ruleset from `from_revision` to
+    `to_revision`, in the order they were made.
+    """
+    return AuditEntry.query \
+        .filter(AuditEntry.revision > from_revision, AuditEntry.revision <= to_revision) \
+        .order_by(AuditEntry.revision, AuditEntry.id).all()
+
+
+def revision_diff(from_revision, to_revision):
+    """
+    Net change per user and rule between two revisions: a list of dicts
+    (kind, id, action, changes) where `changes` holds each field's value
+    at `from_revision` and at `to_revision`. Objects added and deleted in
+    between, and edits that were reverted, are left out.
+    """
+    net = {}
+    for entry in revision_changes(from_revision, to_revision):
+        kind, action = entry.action.split('.', 1)
+        key = (kind, entry.rule_id if kind == 'rule' else entry.user_id)
+        current = net.setdefault(key, {'kind': kind, 'id': key[1], 'first': action, 'action': action,
+                                       'changes': {}})
+        current['action'] = action
+        for field, (old, new) in decode(entry).items():
+            current['changes'].setdefault(field, [old, new])[1] = new
+
+    result = []
+    for current in net.values():
+        first = current.pop('first')
+        if first == 'add' and current['action'] == 'delete':
+            continue
+        if first == 'add':
+            current['action'] = 'add'
+        changes = {f: v for f, v in current['changes'].items() if v[0] != v[1]}
+        if not changes and current['action'] == 'edit':
+            continue
+        current['changes'] = changes
+        result.append(current)
+    return result
+
+
+class AuditLog:
+    """
+    Append-only audit log. record() only appends to an in-memory buffer;
+    a background thread writes the buffer in one batched insert every
+    `flush_interval` seconds (or as soon as BATCH_SIZE entries wait), so
+    write requests never wait for the log. The thread also purges months
+    past `retention_months` once an hour. Entries still buffered are
+    flushed at interpreter exit.
+    """
+    def __init__(self, app, flush_interval=FLUSH_INTERVAL, retention_months=RETENTION_MONTHS):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.retention_months = retention_months
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        # Months whose partition row this process has already written
+        self._periods = set()
+        self._purged_at = 0
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def start(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is None:
+                    atexit.register(self.flush)
+                self._thread = threading.Thread(target=self._loop, name='audit-log', daemon=True)
+                self._thread.start()
+
+    def record(self, action, user_id=None, rule_id=None, revision=None, changes=None, details=None,
+               actor=None):
+        """
+        Buffers one entry. `changes` is a diff() result; `details` any
+        other JSON-ready data (one of the two is stored).
+        """
+        self._append([self._entry(int(time.time()), action, user_id, rule_id, revision, changes, details,
+                                  actor)])
+
+    def record_many(self, action, entries, revision=None, actor=None):
+        """
+        Buffers one `action` entry per dict of `entries` (user_id, rule_id,
+        changes or details) in one step, for bulk writes.
+        """
+        timestamp = int(time.time())
+        self._append([self._entry(timestamp, action, entry.get('user_id'), entry.get('rule_id'), revision,
+                                  entry.get('changes'), entry.get('details'), actor) for entry in entries])
+
+    @staticmethod
+    def _entry(timestamp, action, user_id, rule_id, revision, changes, details, actor):
+        data = changes if changes is not None else details
+        return {'timestamp': timestamp, 'action': action, 'user_id': user_id,
+                'rule_id': rule_id, 'revision': revision, 'actor': actor,
+                'data': json.dumps(data, separators=(',', ':')) if data else None}
+
+    def _append(self, entries):
+        if not entries:
+            return
+        with self._lock:
+            self._buffer.extend(entries)
+            pending = len(self._buffer)
+        if pending >= MAX_BUFFER:
+            self.flush()
+        elif pending >= BATCH_SIZE:
+            self._wake.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def discard(self):
+        with self._lock:
+            self._buffer.clear()
+
+    def flush(self):
+        """
+        Writes everything buffered in one transaction, in its own app
+        context and session. On failure the entries are put back. Returns
+        the number written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                entries = list(self._buffer)
+                self._buffer.clear()
+            if not entries:
+                return 0
+            try:
+                with self.app.app_context():
+                    periods = write(entries, self._periods)
+                    db.session.commit()
+            except Exception:
+                logger.exception(f"Could not write {len(entries)} audit entries")
+                with self._lock:
+                    self._buffer.extendleft(reversed(entries))
+                return 0
+            self._periods.update(periods)
+            return len(entries)
+
+    def _loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            if self.retention_months > 0 and time.time() - self._purged_at >= PURGE_INTERVAL:
+                self._purged_at = time.time()
+                try:
+                    with self.app.app_context():
+                        purge(months=self.retention_months)
+                except Exception:
+                    logger.exception("Audit purge failed")
@@ -0,0 +1,99 @@
+"""
+Compares the 'flat' and 'tree' dispatch modes of the ruleset generator.
+
+For each mode it reports the size of the generated iptables-restore file and
+how many rules a forwarded packet is evaluated against before it leaves the
+owning user's rules (worst case: the packet matches none of them).
+
+    python benchmarks/bench_dispatch.py --users 5000 --rules 20
+"""
+import argparse
+import ipaddress
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from iptables_manager import IptablesManager, parse_restore_content
+
+
+def make_users(count, rules_per_user, network='10.8.0.0/16', seed=1):
+    rnd = random.Random(seed)
+    hosts = ipaddress.ip_network(network).hosts()
+    users = []
+    for user_id in range(1, count + 1):
+        rules = [
+            SimpleNamespace(
+                destination_ip=f"172.16.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}",
+                protocol=rnd.choice(['tcp', 'udp']),
+                destination_port=rnd.choice([22, 53, 80, 443, 3389, 8080]),
+                action=rnd.choice(['ACCEPT', 'DROP']),
+            )
+            for _ in range(rules_per_user)
+        ]
+        users.append(SimpleNamespace(id=user_id, ip_address=str(next(hosts)),
+                                     forward_mode='ROUTE', rules=rules))
+    return users
+
+
+def _split_rule(spec):
+    args = spec.split()
+    source = args[args.index('-s') + 1] if '-s' in args else None
+    target = args[args.index('-j') + 1] if '-j' in args else None
+    return (ipaddress.ip_network(source) if source else None), target
+
+
+def evaluations(chains, chain, addr):
+    """
+    Counts rule evaluations for a packet from `addr` traversing `chain`,
+    assuming it matches nothing but source-address dispatch jumps.
+    """
+    count = 0
+    for source, target in chains[chain]:
+        count += 1
+        if source is not None and addr in source and target in chains:
+            count += evaluations(chains, target, addr)
+    return count
+
+
+def measure(manager, users, dispatch):
+    started = time.perf_counter()
+    content = manager.generate_iptables_file_content(users, dispatch=dispatch)
+    elapsed = time.perf_counter() - started
+
+    tables = parse_restore_content(content)
+    chains = {name: [_split_rule(spec) for spec in specs]
+              for name, specs in tables['filter'].items()}
+    samples = [ipaddress.ip_address(u.ip_address) for u in users]
+    depths = [evaluations(chains, 'FORWARD', addr) for addr in samples]
+    return {
+        'dispatch': dispatch,
+        'generate_seconds': round(elapsed, 4),
+        'lines': content.count('\n'),
+        'chains': sum(len(c) for c in tables.values()),
+        'max_evaluations': max(depths),
+        'avg_evaluations': round(sum(depths) / len(depths), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--rules', type=int, default=20, help='rules per user')
+    args = parser.parse_args()
+
+    users = make_users(args.users, args.rules)
+    manager = IptablesManager()
+    print(f"{args.users} users x {args.rules} rules")
+    print(f"{'dispatch':<8} {'gen s':>8} {'lines':>9} {'chains':>7} {'max eval':>9} {'avg eval':>9}")
+    for dispatch in ('flat', 'tree'):
+        r = measure(manager, users, dispatch)
+        print(f"{r['dispatch']:<8} {r['generate_seconds']:>8} {r['lines']:>9} {r['chains']:>7} "
+              f"{r['max_evaluations']:>9} {r['avg_evaluations']:>9}")
+
+
+if __name__ == '__main__':
+    main()
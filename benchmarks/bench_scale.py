@@ -0,0 +1,328 @@
+"""
+Benchmarks ruleset generation, IP allocation, page rendering and apply
+against a SQLite database seeded with synthetic users and rules.
+
+Every measurement records wall time (best of --repeat), SQL query count,
+peak Python memory (tracemalloc) and output size. Results are written as
+JSON so runs on different commits can be compared:
+
+    python benchmarks/bench_scale.py --scale 10k --output before.json
+    python benchmarks/bench_scale.py --scale 10k --output after.json --compare before.json
+
+iptables-restore, iptables-save and ipset are replaced by stubs on PATH, so
+apply latency is measured without root and without touching the host.
+"""
+import argparse
+import ipaddress
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+# users, total rules
+SCALES = {
+    '1k': (1000, 10000),
+    '10k': (10000, 100000),
+    '100k': (100000, 1000000),
+}
+SEED_BATCH = 10000
+# Allocations timed per run of get_next_available_ip
+ALLOCATIONS = 50
+
+STUBS = {
+    'iptables-restore': "#!/bin/sh\ncat > /dev/null\n",
+    'iptables-save': "#!/bin/sh\nexit 0\n",
+    'ipset': "#!/bin/sh\ncat > /dev/null\n",
+    'nft': "#!/bin/sh\ncat > /dev/null\n",
+}
+
+
+def install_stubs(directory):
+    for name, script in STUBS.items():
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = directory + os.pathsep + os.environ.get('PATH', '')
+
+
+def user_network(users):
+    # Twice the users, so allocation benchmarks still find free addresses
+    prefixlen = 32 - max(8, (users * 2 + 2).bit_length())
+    return ipaddress.ip_network(f"10.64.0.0/{prefixlen}")
+
+
+def seed(db, models, users, rules, seed_value=1):
+    """
+    Fills an empty database with `users` users and `rules` rules spread
+    evenly over them, using batched executemany inserts.
+    """
+    rnd = random.Random(seed_value)
+    network = user_network(users)
+    first = int(network.network_address) + 1
+    host_ip = str(ipaddress.ip_address(first))
+
+    db.session.add(models.SystemConfig(host_ip=host_ip, user_network_cidr=str(network), is_configured=True))
+    db.session.add(models.RulesetRevision(id=1, revision=1))
+
+    user_rows = []
+    for i in range(users):
+        user_rows.append({
+            'id': i + 1,
+            'username': f"user{i + 1:06d}",
+            'user_type': 'employee',
+            'forward_mode': 'NAT' if i % 10 == 0 else 'ROUTE',
+            'ip_address': str(ipaddress.ip_address(first + 1 + i)),
+            'revision': 1,
+        })
+        if len(user_rows) == SEED_BATCH:
+            db.session.execute(models.User.__table__.insert(), user_rows)
+            user_rows = []
+    if user_rows:
+        db.session.execute(models.User.__table__.insert(), user_rows)
+
+    per_user, extra = divmod(rules, users)
+    rule_rows = []
+    for user_id in range(1, users + 1):
+        for _ in range(per_user + (1 if user_id <= extra else 0)):
+            protocol = rnd.choice(['tcp', 'tcp', 'udp', 'all'])
+            rule_rows.append({
+                'user_id': user_id,
+                'destination_ip': f"172.{rnd.randint(16, 31)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}",
+                'destination_port': None if protocol == 'all' else rnd.choice([22, 53, 80, 443, 3389, 8080]),
+                'protocol': protocol,
+                'action': rnd.choice(['ACCEPT', 'ACCEPT', 'DROP']),
+            })
+            if len(rule_rows) == SEED_BATCH:
+                db.session.execute(models.Rule.__table__.insert(), rule_rows)
+                rule_rows = []
+    if rule_rows:
+        db.session.execute(models.Rule.__table__.insert(), rule_rows)
+    db.session.commit()
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def measure(engine, fn, repeat, setup=None):
+    """
+    Runs `fn` (returning the output size in bytes, or None) `repeat` times
+    for timing, counting queries on the first run, then once more under
+    tracemalloc for the peak allocation.
+    """
+    times = []
+    queries = None
+    size = None
+    for i in range(repeat):
+        if setup:
+            setup()
+        if i == 0:
+            with QueryCounter(engine) as counter:
+                started = time.perf_counter()
+                size = fn()
+                times.append(time.perf_counter() - started)
+            queries = counter.count
+        else:
+            started = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - started)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds': round(min(times), 6),
+        'queries': queries,
+        'peak_kb': peak // 1024,
+        'bytes': size,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(users, rules, repeat, workdir):
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['APPLY_ASYNC'] = '0'
+    install_stubs(workdir)
+
+    import app as app_module
+    import models
+    from sqlalchemy.orm import selectinload
+    from ruleset_cache import ruleset_cache
+    from config_cache import config_cache
+
+    app, db = app_module.app, app_module.db
+    backend = app_module.iptables
+    # Keep the real instance snapshot out of it
+    backend.snapshot_path = os.path.join(workdir, 'snapshot.json')
+    client = app.test_client()
+    results = {}
+
+    with app.app_context():
+        db.create_all()
+        started = time.perf_counter()
+        seed(db, models, users, rules)
+        results['seed'] = {'seconds': round(time.perf_counter() - started, 3)}
+        engine = db.engine
+
+        def load_users():
+            db.session.expire_all()
+            return models.User.query.options(selectinload(models.User.rules)).order_by(models.User.id).all()
+
+        loaded = load_users()
+        results['load_users'] = measure(engine, lambda: len(load_users()) and None, repeat)
+
+        def generate():
+            content, _, _ = backend.build_ruleset(loaded)
+            return len(content)
+        results['generate_ruleset'] = measure(engine, generate, repeat)
+        del loaded
+
+        def allocate():
+            for _ in range(ALLOCATIONS):
+                app_module.get_next_available_ip()
+        config_cache.invalidate()
+        results['get_next_available_ip'] = measure(engine, allocate, repeat)
+        results['get_next_available_ip']['calls'] = ALLOCATIONS
+
+    def page(url, method='get'):
+        def fetch():
+            response = getattr(client, method)(url)
+            assert response.status_code in (200, 302), (url, response.status_code)
+            return len(response.data)
+        return fetch
+
+    def cold_cache():
+        ruleset_cache.clear()
+
+    def cold_apply():
+        ruleset_cache.clear()
+        if os.path.exists(backend.snapshot_path):
+            os.remove(backend.snapshot_path)
+
+    with app.app_context():
+        results['page_users'] = measure(engine, page('/users'), repeat)
+        results['page_rules'] = measure(engine, page('/rules'), repeat)
+        results['page_validate_cold'] = measure(engine, page('/validate'), repeat, setup=cold_cache)
+        results['page_validate_warm'] = measure(engine, page('/validate'), repeat)
+        results['apply_full'] = measure(engine, page('/apply', 'post'), repeat, setup=cold_apply)
+        results['apply_noop'] = measure(engine, page('/apply', 'post'), repeat)
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'users': users,
+            'rules': rules,
+            'backend': backend.name,
+            'dispatch': backend.dispatch,
+            'optimize': backend.optimize,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """
+    Prints time and query changes against a baseline result file.
+    Returns the names of measurements slower by more than `threshold`.
+    """
+    regressions = []
+    print(f"\n{'measurement':<24} {'base s':>10} {'now s':>10} {'change':>8} {'queries':>10}")
+    for name, now in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base or not base.get('seconds'):
+            continue
+        change = (now['seconds'] - base['seconds']) / base['seconds']
+        queries = f"{base.get('queries')}->{now.get('queries')}" if 'queries' in now else ''
+        flag = ' !' if change > threshold else ''
+        print(f"{name:<24} {base['seconds']:>10.4f} {now['seconds']:>10.4f} {change:>+7.0%}{flag} {queries:>10}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='1k')
+    parser.add_argument('--users', type=int, help='overrides the scale preset')
+    parser.add_argument('--rules', type=int, help='total rules, overrides the scale preset')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', metavar='BASELINE', help='result file of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown reported as a regression (default 0.2)')
+    parser.add_argument('--keep', action='store_true', help='keep the seeded database directory')
+    args = parser.parse_args()
+
+    users, rules = SCALES[args.scale]
+    users = args.users or users
+    rules = args.rules if args.rules is not None else rules
+
+    workdir = tempfile.mkdtemp(prefix='fwm-bench-')
+    try:
+        result = run(users, rules, args.repeat, workdir)
+    finally:
+        if args.keep:
+            print(f"Database kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{users} users, {rules} rules ({result['meta']['backend']})")
+    print(f"{'measurement':<24} {'seconds':>10} {'queries':>8} {'peak KB':>9} {'bytes':>11}")
+    for name, r in result['results'].items():
+        print(f"{name:<24} {r['seconds']:>10} {r.get('queries', ''):>8} {r.get('peak_kb', ''):>9} "
+              f"{r.get('bytes') if r.get('bytes') is not None else '':>11}")
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
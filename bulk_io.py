@@ -0,0 +1,346 @@
+import csv
+import io
+import ipaddress
+import json
+import logging
+from datetime import datetime
+
+from sqlalchemy import func
+
+from models import db, User, Rule, Gateway
+import audit
+import ip_pool
+import rule_schedule
+from ruleset_cache import bump_revision, bump_user_revisions
+
+logger = logging.getLogger(__name__)
+
+# Rows per executemany statement
+BATCH_SIZE = 500
+
+USER_FIELDS = ['username', 'full_name', 'email', 'contact', 'user_type', 'forward_mode', 'ip_address',
+               'gateway_id', 'valid_from', 'expires_at']
+RULE_FIELDS = ['username', 'destination_ip', 'destination_port', 'protocol', 'action',
+               'valid_from', 'expires_at']
+
+USER_TYPES = ('employee', 'vendor', 'other')
+FORWARD_MODES = ('ROUTE', 'NAT')
+PROTOCOLS = ('tcp', 'udp', 'icmp', 'all')
+# Protocols a destination_port can be matched for
+PORT_PROTOCOLS = ('tcp', 'udp')
+ACTIONS = ('ACCEPT', 'DROP')
+
+
+class BulkImportError(ValueError):
+    """
+    Raised when an import batch fails validation. `errors` is a list of
+    (record_number, message); nothing has been written.
+    """
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} invalid record(s)")
+        self.errors = errors
+
+
+def parse_records(text, fmt):
+    """
+    Parses CSV (with header), a JSON array or JSON lines into dicts.
+    """
+    if fmt == 'csv':
+        return list(csv.DictReader(io.StringIO(text)))
+    if fmt == 'json':
+        records = json.loads(text)
+        if not isinstance(records, list):
+            raise ValueError("JSON input must be an array of objects")
+        return records
+    if fmt == 'jsonl':
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    raise ValueError(f"Unknown format: {fmt}")
+
+
+def _clean(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _window(record, errors, n):
+    """
+    The record's (valid_from, expires_at), ISO 8601 UTC; see
+    rule_schedule.parse_window.
+    """
+    try:
+        return rule_schedule.parse_window(_clean(record.get('valid_from')), _clean(record.get('expires_at')))
+    except ValueError as e:
+        errors.append((n, f"invalid validity window: {e}"))
+        return None, None
+
+
+def _rule_row(record, errors, n):
+    destination_ip = _clean(record.get('destination_ip'))
+    port = _clean(record.get('destination_port'))
+    protocol = (_clean(record.get('protocol')) or 'tcp').lower()
+    action = (_clean(record.get('action')) or 'ACCEPT').upper()
+
+    try:
+        ipaddress.ip_network(destination_ip or '', strict=False)
+    except ValueError:
+        errors.append((n, f"invalid destination_ip {destination_ip!r}"))
+    if protocol not in PROTOCOLS:
+        errors.append((n, f"invalid protocol {protocol!r}"))
+    if action not in ACTIONS:
+        errors.append((n, f"invalid action {action!r}"))
+    if port is not None:
+        try:
+            port = int(port)
+            if not 1 <= port <= 65535:
+                raise ValueError
+        except ValueError:
+            errors.append((n, f"invalid destination_port {port!r}"))
+        if protocol not in PORT_PROTOCOLS:
+            errors.append((n, f"destination_port needs protocol tcp or udp, not {protocol!r}"))
+    valid_from, expires_at = _window(record, errors, n)
+    return {'destination_ip': destination_ip, 'destination_port': port,
+            'protocol': protocol, 'action': action,
+            'valid_from': valid_from, 'expires_at': expires_at}
+
+
+def _insert_batched(table, rows):
+    for i in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(table.insert(), rows[i:i + BATCH_SIZE])
+
+
+def _added_entries(model, after_id, fields):
+    """
+    audit.AuditLog.record_many() entries for the rows of `model` this
+    transaction inserted after id `after_id`, read back in batches.
+    """
+    columns = [model.id] + [getattr(model, field) for field in fields if field != 'id']
+    entries = []
+    rows = db.session.query(*columns).filter(model.id > after_id).order_by(model.id) \
+        .execution_options(yield_per=BATCH_SIZE)
+    for row in rows:
+        entries.append({'user_id': row.user_id if model is Rule else row.id,
+                        'rule_id': row.id if model is Rule else None,
+                        'changes': audit.diff({}, audit.values(row, fields))})
+    return entries
+
+
+def _last_id(model):
+    return db.session.query(func.max(model.id)).scalar() or 0
+
+
+def _schedule(scheduler, rows):
+    if scheduler is not None:
+        scheduler.schedule(*[row[field] for row in rows for field in ('valid_from', 'expires_at')])
+
+
+def import_users(config, records, dry_run=False, audit_log=None, actor=None, scheduler=None):
+    """
+    Validates and inserts user records (JSON records may carry a nested
+    `rules` list). Usernames and IPs are checked against sets preloaded in
+    one query; missing IPs are allocated from the address pool in a single
+    pass. Everything is written in one transaction with batched executemany
+    inserts. With `audit_log`, one entry per user and rule is buffered
+    once committed; with `scheduler` (rule_schedule.RuleScheduler), the
+    imported windows' boundaries are pushed to it. Raises BulkImportError
+    without writing anything if any record is invalid. Returns
+    {'users': n, 'rules': n}.
+    """
+    existing = db.session.query(User.username, User.ip_address).all()
+    usernames = {u for u, _ in existing}
+    ips = {ip for _, ip in existing}
+    gateway_ids = {gid for (gid,) in db.session.query(Gateway.id)}
+
+    errors = []
+    users = []
+    rules = []
+    for n, record in enumerate(records, 1):
+        username = _clean(record.get('username'))
+        ip = _clean(record.get('ip_address'))
+        user_type = _clean(record.get('user_type')) or 'employee'
+        forward_mode = (_clean(record.get('forward_mode')) or 'ROUTE').upper()
+        gateway_id = _clean(record.get('gateway_id'))
+        valid_from, expires_at = _window(record, errors, n)
+
+        if not username:
+            errors.append((n, "username is required"))
+        elif username in usernames:
+            errors.append((n, f"username {username!r} already exists"))
+        usernames.add(username)
+        if ip is not None:
+            try:
+                ip = str(ipaddress.ip_address(ip))
+            except ValueError:
+                errors.append((n, f"invalid ip_address {ip!r}"))
+            else:
+                if ip in ips:
+                    errors.append((n, f"ip_address {ip} already assigned"))
+                ips.add(ip)
+        if user_type not in USER_TYPES:
+            errors.append((n, f"invalid user_type {user_type!r}"))
+        if forward_mode not in FORWARD_MODES:
+            errors.append((n, f"invalid forward_mode {forward_mode!r}"))
+        if gateway_id is not None:
+            try:
+                gateway_id = int(gateway_id)
+            except ValueError:
+                pass
+            if gateway_id not in gateway_ids:
+                errors.append((n, f"unknown gateway_id {gateway_id!r}"))
+
+        users.append({
+            'username': username,
+            'full_name': _clean(record.get('full_name')),
+            'email': _clean(record.get('email')),
+            'contact': _clean(record.get('contact')),
+            'user_type': user_type,
+            'forward_mode': forward_mode,
+            'ip_address': ip,
+            'gateway_id': gateway_id,
+            'valid_from': valid_from,
+            'expires_at': expires_at,
+        })
+        for rule in record.get('rules') or []:
+            row = _rule_row(rule, errors, n)
+            row['username'] = username
+            rules.append(row)
+
+    if not errors:
+        explicit = [u['ip_address'] for u in users if u['ip_address']]
+        missing = [u for u in users if not u['ip_address']]
+        try:
+            allocated, unavailable = ip_pool.allocate_bulk(config, explicit, len(missing))
+        except ValueError as e:
+            errors.append((0, str(e)))
+        else:
+            errors.extend((0, f"ip_address {ip} is already taken") for ip in unavailable)
+            for user, ip in zip(missing, allocated):
+                user['ip_address'] = ip
+
+    if errors:
+        db.session.rollback()
+        raise BulkImportError(errors)
+    if dry_run:
+        db.session.rollback()
+        return {'users': len(users), 'rules': len(rules)}
+
+    try:
+        # Holds the write lock from here, so the ids read below are ours
+        revision = bump_revision()
+        last_user, last_rule = _last_id(User), _last_id(Rule)
+        for user in users:
+            user['revision'] = revision
+        _insert_batched(User.__table__, users)
+        _insert_rules(rules)
+        if audit_log is not None:
+            user_entries = _added_entries(User, last_user, audit.USER_FIELDS)
+            rule_entries = _added_entries(Rule, last_rule, audit.RULE_FIELDS)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if audit_log is not None:
+        audit_log.record_many('user.add', user_entries, revision, actor)
+        audit_log.record_many('rule.add', rule_entries, revision, actor)
+    _schedule(scheduler, users + rules)
+    logger.info(f"Bulk import: {len(users)} users, {len(rules)} rules")
+    return {'users': len(users), 'rules': len(rules)}
+
+
+def import_rules(records, dry_run=False, audit_log=None, actor=None, scheduler=None):
+    """
+    Validates and inserts rule records referencing users by username.
+    Same all-or-nothing behaviour, auditing and scheduling as import_users.
+    """
+    user_ids = dict(db.session.query(User.username, User.id).all())
+    errors = []
+    rules = []
+    for n, record in enumerate(records, 1):
+        username = _clean(record.get('username'))
+        if username not in user_ids:
+            errors.append((n, f"unknown username {username!r}"))
+        row = _rule_row(record, errors, n)
+        row['username'] = username
+        rules.append(row)
+
+    if errors:
+        raise BulkImportError(errors)
+    if dry_run:
+        return {'users': 0, 'rules': len(rules)}
+
+    try:
+        revision = bump_revision()
+        last_rule = _last_id(Rule)
+        bump_user_revisions({user_ids[r['username']] for r in rules}, revision)
+        _insert_rules(rules, user_ids)
+        if audit_log is not None:
+            rule_entries = _added_entries(Rule, last_rule, audit.RULE_FIELDS)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if audit_log is not None:
+        audit_log.record_many('rule.add', rule_entries, revision, actor)
+    _schedule(scheduler, rules)
+    logger.info(f"Bulk import: {len(rules)} rules")
+    return {'users': 0, 'rules': len(rules)}
+
+
+def _insert_rules(rules, user_ids=None):
+    if not rules:
+        return
+    if user_ids is None:
+        names = list({r['username'] for r in rules})
+        user_ids = {}
+        for i in range(0, len(names), BATCH_SIZE):
+            chunk = names[i:i + BATCH_SIZE]
+            user_ids.update(db.session.query(User.username, User.id).filter(User.username.in_(chunk)))
+    rows = []
+    for rule in rules:
+        row = dict(rule)
+        row['user_id'] = user_ids[row.pop('username')]
+        rows.append(row)
+    _insert_batched(Rule.__table__, rows)
+
+
+def export_records(kind, fmt, batch_size=BATCH_SIZE):
+    """
+    Yields the users or rules as CSV or JSON lines text chunks, reading the
+    table through a streaming cursor. The output can be fed back to the
+    matching import.
+    """
+    if kind == 'users':
+        fields = USER_FIELDS
+        query = db.session.query(*[getattr(User, f) for f in fields]).order_by(User.id)
+    elif kind == 'rules':
+        fields = RULE_FIELDS
+        query = db.session.query(User.username, Rule.destination_ip, Rule.destination_port,
+                                 Rule.protocol, Rule.action, Rule.valid_from, Rule.expires_at) \
+            .join(User, Rule.user_id == User.id).order_by(Rule.id)
+    else:
+        raise ValueError(f"Unknown kind: {kind}")
+    if fmt not in ('csv', 'jsonl'):
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    rows = ([_export_value(v) for v in row]
+            for row in query.execution_options(stream_results=True, yield_per=batch_size))
+    if fmt == 'csv':
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow(['' if v is None else v for v in row])
+            if buf.tell() >= 64 * 1024:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(fields, row))) + "\n"
+
+
+def _export_value(value):
+    # Windows as ISO 8601, which the import parses back
+    return value.isoformat() if isinstance(value, datetime) else value
@@ -0,0 +1,71 @@
+import threading
+import time
+
+from models import db, SystemConfig
+
+
+class ConfigSnapshot:
+    """
+    Detached, read-only copy of the SystemConfig row.
+    """
+    FIELDS = ('id', 'host_ip', 'user_network_cidr', 'is_configured', 'version', 'created_at')
+
+    def __init__(self, config):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(config, field))
+
+
+class ConfigCache:
+    """
+    Process-wide cache of the SystemConfig row.
+
+    The row carries a version counter that every change bumps. Within `ttl`
+    seconds of the last check the cached copy is returned without touching
+    the database; after that only the version column is read, and the row is
+    reloaded when another process changed it. invalidate() drops the local
+    copy right away for changes made by this process.
+    """
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = None
+        self._checked_at = None
+
+    def get(self):
+        """
+        Returns a ConfigSnapshot, or None if the system has no config row.
+        """
+        now = time.monotonic()
+        checked_at = self._checked_at
+        if checked_at is not None and now - checked_at < self.ttl:
+            return self._snapshot
+
+        with self._lock:
+            if self._checked_at is not None:
+                version = db.session.query(SystemConfig.version).limit(1).scalar()
+                if version == self._version:
+                    self._checked_at = now
+                    return self._snapshot
+            config = SystemConfig.query.first()
+            self._snapshot = ConfigSnapshot(config) if config else None
+            self._version = config.version if config else None
+            self._checked_at = now
+            return self._snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._version = None
+            self._checked_at = None
+
+
+config_cache = ConfigCache()
+
+
+def bump_config_version(config):
+    """
+    Marks a modified SystemConfig row so every process reloads it.
+    Call before committing the change.
+    """
+    config.version = (config.version or 0) + 1
@@ -0,0 +1,56 @@
+import sqlite3
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def engine_options(uri, pool_size=5, max_overflow=10, busy_timeout=30.0):
+    """
+    Returns SQLALCHEMY_ENGINE_OPTIONS for `uri`. Each worker process gets
+    its own pool of `pool_size` (+ `max_overflow`) connections. SQLite
+    connections wait up to `busy_timeout` seconds for another writer
+    instead of failing with "database is locked".
+    """
+    if uri.startswith('sqlite'):
+        return {'connect_args': {'timeout': busy_timeout}}
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        # Drop connections the server closed while idle
+        'pool_pre_ping': True,
+        'pool_recycle': 3600,
+    }
+
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    WAL lets readers run alongside the single writer, so page loads in one
+    worker are not blocked by an import or apply in another.
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+@contextmanager
+def read_snapshot(engine):
+    """
+    A connection on which every query sees the database as of the first
+    one, while writers carry on. pysqlite issues no BEGIN for reads, so
+    on SQLite (WAL) the read transaction is opened explicitly; other
+    databases use REPEATABLE READ.
+    """
+    with engine.connect() as connection:
+        if connection.dialect.name == 'sqlite':
+            connection.exec_driver_sql("BEGIN")
+        else:
+            connection = connection.execution_options(isolation_level='REPEATABLE READ')
+        try:
+            yield connection
+        finally:
+            connection.rollback()
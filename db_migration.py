@@ -1,55 +1,229 @@
-import sqlite3
-import os
+"""
+Versioned schema migrations for databases created by older releases.
 
-DB_PATH = 'instance/firewall.db'
+Each migration runs once; applied versions are recorded in the
+schema_migration table. Migrations inspect the live schema before
+changing it, so a database created from the current models simply has
+every version recorded. Large data copies run in short batches keyed by
+primary key and checkpoint after every batch, so an interrupted run
+resumes where it stopped and other connections are never locked out for
+the whole copy.
 
-def migrate_db():
-    if not os.path.exists(DB_PATH):
-        print(f"Database not found at {DB_PATH}. It will be created when the app runs.")
+Run with `python db_migration.py` or `flask --app app db-upgrade`; the
+production entry point (app.create_app) runs it on startup.
+"""
+import logging
+
+import sqlalchemy as sa
+
+from models import db, User, Rule, IpPool, SchemaMigration, MigrationCheckpoint
+
+logger = logging.getLogger(__name__)
+
+# Rows per batch of a table copy
+BATCH_SIZE = 5000
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+
+def _columns(engine, table):
+    return {c['name'] for c in sa.inspect(engine).get_columns(table)}
+
+
+def _add_column(engine, table, column):
+    """
+    Adds the model `column` to `table` unless it exists.
+    """
+    if column.name in _columns(engine, table):
         return
+    quote = engine.dialect.identifier_preparer.quote
+    ddl = f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column.name)} {column.type.compile(engine.dialect)}"
+    if column.default is not None:
+        ddl += f" DEFAULT {column.default.arg!r}"
+    if not column.nullable:
+        ddl += " NOT NULL"
+    logger.info(f"Adding column {table}.{column.name}")
+    with engine.begin() as conn:
+        conn.exec_driver_sql(ddl)
+
+
+def _checkpoint(engine, version):
+    with engine.connect() as conn:
+        return conn.execute(sa.select(MigrationCheckpoint.last_id)
+                            .where(MigrationCheckpoint.version == version)).scalar()
+
+
+def copy_table(engine, version, source, target, columns, batch_size=BATCH_SIZE):
+    """
+    Copies `columns` of every row of `source` into `target` in id order,
+    one committed batch of `batch_size` rows at a time. The last copied id
+    is committed with each batch (MigrationCheckpoint), so a rerun after
+    an interruption continues from there. Returns the rows copied.
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    cols = ", ".join(quote(c) for c in columns)
+    last_id = _checkpoint(engine, version) or 0
+    copied = 0
+    while True:
+        with engine.begin() as conn:
+            upper = conn.exec_driver_sql(
+                f"SELECT MAX(id) FROM (SELECT id FROM {quote(source)} WHERE id > {int(last_id)} "
+                f"ORDER BY id LIMIT {int(batch_size)}) batch").scalar()
+            if upper is None:
+                return copied
+            copied += conn.exec_driver_sql(
+                f"INSERT INTO {quote(target)} ({cols}) SELECT {cols} FROM {quote(source)} "
+                f"WHERE id > {int(last_id)} AND id <= {int(upper)}").rowcount
+            values = {'version': version, 'last_id': upper}
+            if conn.execute(sa.update(MigrationCheckpoint).where(MigrationCheckpoint.version == version)
+                            .values(last_id=upper)).rowcount == 0:
+                conn.execute(sa.insert(MigrationCheckpoint).values(**values))
+        last_id = upper
+        logger.info(f"Copied {source} rows up to id {upper}")
+
+
+def rebuild_table(engine, version, model, batch_size=BATCH_SIZE):
+    """
+    Replaces `model`'s table with one matching the model, for schema
+    changes the database cannot make in place. Rows are copied in
+    resumable batches into `<table>_new` without holding a lock. Writers
+    may change rows meanwhile, so the swap transaction first reconciles
+    the copy with the live table: every copied row whose contents
+    differ (updated or deleted since its batch) is dropped, and every
+    live row missing from the copy (updated, or inserted after the last
+    batch) is copied again. That comparison scans both tables inside the
+    write lock, in the database, without per-row round trips.
+    """
+    table = model.__table__
+    name, new_name = table.name, f"{table.name}_new"
+    quote = engine.dialect.identifier_preparer.quote
+    metadata = sa.MetaData()
+    # Referenced tables must be known to emit the foreign keys
+    for fk in table.foreign_keys:
+        fk.column.table.to_metadata(metadata)
+    new_table = table.to_metadata(metadata, name=new_name)
+    # Index names are global in SQLite; they are recreated after the swap
+    new_table.indexes.clear()
+    new_table.create(engine, checkfirst=True)
+
+    columns = [c.name for c in table.columns if c.name in _columns(engine, name)]
+    copy_table(engine, version, name, new_name, columns, batch_size)
+
+    cols = ", ".join(quote(c) for c in columns)
+    with engine.begin() as conn:
+        # The first statement writes, so the lock is held before anything is
+        # compared. EXCEPT treats NULLs as equal: unchanged rows stay.
+        conn.exec_driver_sql(f"DELETE FROM {quote(new_name)} WHERE id IN (SELECT id FROM ("
+                             f"SELECT {cols} FROM {quote(new_name)} EXCEPT SELECT {cols} FROM {quote(name)}) changed)")
+        conn.exec_driver_sql(f"INSERT INTO {quote(new_name)} ({cols}) SELECT {cols} FROM {quote(name)} "
+                             f"WHERE id NOT IN (SELECT id FROM {quote(new_name)})")
+        conn.exec_driver_sql(f"DROP TABLE {quote(name)}")
+        conn.exec_driver_sql(f"ALTER TABLE {quote(new_name)} RENAME TO {quote(name)}")
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
 
+@migration(1, "add user.forward_mode")
+def _user_forward_mode(engine):
+    _add_column(engine, 'user', sa.Column('forward_mode', sa.String(10), default='ROUTE'))
+
+
+@migration(2, "add system_config.version")
+def _system_config_version(engine):
+    _add_column(engine, 'system_config', sa.Column('version', sa.Integer, nullable=False, default=1))
+
+
+@migration(3, "add user.revision")
+def _user_revision(engine):
+    _add_column(engine, 'user', sa.Column('revision', sa.Integer, nullable=False, default=1))
+
+
+@migration(4, "drop rule.forward_type")
+def _rule_forward_type(engine):
+    if 'forward_type' not in _columns(engine, 'rule'):
+        return
     try:
-        # Check if forward_mode exists in user table
-        cursor.execute("PRAGMA table_info(user)")
-        columns = [info[1] for info in cursor.fetchall()]
-        
-        if 'forward_mode' not in columns:
-            print("Adding forward_mode column to user table...")
-            cursor.execute("ALTER TABLE user ADD COLUMN forward_mode VARCHAR(10) DEFAULT 'ROUTE'")
-            conn.commit()
-            print("Column added successfully.")
-        else:
-            print("Column forward_mode already exists.")
-
-        # Check if forward_type exists in rule table
-        cursor.execute("PRAGMA table_info(rule)")
-        columns = [info[1] for info in cursor.fetchall()]
-        
-        if 'forward_type' in columns:
-            print("Removing forward_type column from rule table...")
-            try:
-                cursor.execute("ALTER TABLE rule DROP COLUMN forward_type")
-                conn.commit()
-                print("Column removed successfully.")
-            except sqlite3.OperationalError:
-                print("SQLite version might be too old for DROP COLUMN. Recreating table...")
-                # Fallback: Recreate table
-                cursor.execute("CREATE TABLE rule_new (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, destination_ip VARCHAR(45) NOT NULL, destination_port INTEGER, protocol VARCHAR(10) NOT NULL, action VARCHAR(10) NOT NULL, created_at DATETIME, FOREIGN KEY(user_id) REFERENCES user(id))")
-                cursor.execute("INSERT INTO rule_new (id, user_id, destination_ip, destination_port, protocol, action, created_at) SELECT id, user_id, destination_ip, destination_port, protocol, action, created_at FROM rule")
-                cursor.execute("DROP TABLE rule")
-                cursor.execute("ALTER TABLE rule_new RENAME TO rule")
-                conn.commit()
-                print("Table recreated successfully.")
-        else:
-            print("Column forward_type already removed.")
-            
-    except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        conn.close()
+        with engine.begin() as conn:
+            conn.exec_driver_sql("ALTER TABLE rule DROP COLUMN forward_type")
+    except sa.exc.OperationalError:
+        # SQLite before 3.35
+        logger.info("DROP COLUMN not supported, rebuilding the rule table")
+        rebuild_table(engine, 4, Rule)
+
+
+@migration(5, "rule indexes for listings, searches and per-user scans")
+def _rule_indexes(engine):
+    # Indexes on columns added by later migrations are created there
+    existing = _columns(engine, 'rule')
+    for index in Rule.__table__.indexes:
+        if set(index.columns.keys()) <= existing:
+            index.create(engine, checkfirst=True)
+
+
+@migration(6, "add user.gateway_id")
+def _user_gateway(engine):
+    # SQLite cannot add the foreign key to an existing table; the column
+    # is only ever written through the model, which checks it
+    _add_column(engine, 'user', sa.Column('gateway_id', sa.Integer, nullable=True))
+    for index in User.__table__.indexes:
+        if 'gateway_id' in index.columns:
+            index.create(engine, checkfirst=True)
+
+
+@migration(7, "rule and user validity windows")
+def _validity_windows(engine):
+    for model in (User, Rule):
+        table = model.__table__
+        for name in ('valid_from', 'expires_at'):
+            _add_column(engine, table.name, sa.Column(name, sa.DateTime, nullable=True))
+        for index in table.indexes:
+            if {'valid_from', 'expires_at'} & set(index.columns.keys()):
+                index.create(engine, checkfirst=True)
+
+
+@migration(8, "drop ip_reservation")
+def _drop_ip_reservations(engine):
+    if not sa.inspect(engine).has_table('ip_reservation'):
+        return
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE ip_reservation")
+        # Held addresses were taken out of the free ranges; rebuilding
+        # the pool from the users returns them
+        conn.execute(sa.delete(IpPool.__table__))
+
+
+def upgrade(engine=None):
+    """
+    Creates missing tables and applies every migration not yet recorded.
+    Returns the versions applied.
+    """
+    engine = engine or db.engine
+    db.metadata.create_all(engine)
+    with engine.connect() as conn:
+        applied = {v for (v,) in conn.execute(sa.select(SchemaMigration.version))}
+    done = []
+    for version, name, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        logger.info(f"Applying migration {version}: {name}")
+        fn(engine)
+        with engine.begin() as conn:
+            conn.execute(sa.insert(SchemaMigration).values(version=version, name=name))
+            conn.execute(sa.delete(MigrationCheckpoint).where(MigrationCheckpoint.version == version))
+        done.append(version)
+    return done
+
 
 if __name__ == '__main__':
-    migrate_db()
+    logging.basicConfig(level=logging.INFO)
+    from app import app
+    with app.app_context():
+        versions = upgrade()
+    print(f"Applied migrations: {versions}" if versions else "Database is up to date.")
@@ -0,0 +1,263 @@
+import ipaddress
+import logging
+import shlex
+import threading
+import time
+from collections import Counter, namedtuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks
+CHECK_INTERVAL = 300
+
+# Chains we create (see iptables_manager); any kernel chain with this
+# prefix is ours even if the applied ruleset no longer declares it
+OWNED_PREFIX = "FWM_"
+
+BUILTIN_CHAINS = {'INPUT', 'FORWARD', 'OUTPUT', 'PREROUTING', 'POSTROUTING'}
+
+# Long option names iptables-save prints in their short form
+OPTION_ALIASES = {
+    '--source': '-s', '--destination': '-d', '--protocol': '-p', '--jump': '-j', '--goto': '-g',
+    '--in-interface': '-i', '--out-interface': '-o', '--match': '-m',
+    '--destination-port': '--dport', '--source-port': '--sport',
+    # iptables-nft loads `-m state` as conntrack
+    '--state': '--ctstate',
+}
+MODULE_ALIASES = {'state': 'conntrack'}
+# Values that are sets, whatever order they are written in
+LIST_OPTIONS = {'--ctstate', '--dports', '--sports', '--ports'}
+
+# missing: expected rules absent from the kernel; extra: kernel rules in our
+# chains that we did not apply; chains: sorted (table, chain) pairs that
+# differ (also in order only, or by existing at all)
+DriftReport = namedtuple('DriftReport', 'missing extra chains')
+
+
+def _address(value):
+    network = ipaddress.ip_network(value, strict=False)
+    if network.prefixlen == 0:
+        return None
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address)
+    return str(network)
+
+
+def normalize_spec(spec):
+    """
+    Canonical form of a rule spec (everything after "-A CHAIN"), so our
+    generated line and the kernel's rendering of it compare equal:
+    long options, quoting, "/32" host masks, the implicit "-m tcp" and
+    the order of options and of list values do not matter.
+    """
+    tokens = shlex.split(spec)
+    options = []
+    negate = False
+    for token in tokens:
+        if token == '!':
+            negate = True
+        elif token.startswith('-') and not token[1:].isdigit():
+            name = OPTION_ALIASES.get(token, token)
+            options.append([('!' if negate else '') + name])
+            negate = False
+        elif options:
+            options[-1].append(token)
+    protocol = next((o[1] for o in options if o[0] == '-p' and len(o) > 1), None)
+
+    normalized = []
+    for name, *values in options:
+        bare = name.lstrip('!')
+        if bare == '-m' and values:
+            module = MODULE_ALIASES.get(values[0], values[0])
+            if module == protocol:
+                continue
+            values = [module]
+        elif bare in ('-s', '-d') and values:
+            address = _address(values[0])
+            if address is None:
+                continue
+            values = [address]
+        elif bare in LIST_OPTIONS and values:
+            values = [",".join(sorted(values[0].split(',')))]
+        normalized.append((name,) + tuple(values))
+    return tuple(sorted(normalized))
+
+
+def rule_hash(spec):
+    return hash(normalize_spec(spec))
+
+
+def parse_save(output):
+    """
+    Parses one `iptables-save` listing (all tables) into
+    {table: {chain: [spec, ...]}}. Every declared chain is included.
+    """
+    tables = {}
+    chains = None
+    for line in output.splitlines():
+        if line.startswith('*'):
+            chains = tables.setdefault(line[1:].strip(), {})
+        elif line.startswith(':') and chains is not None:
+            chains.setdefault(line[1:].split()[0], [])
+        elif line.startswith('-A ') and chains is not None:
+            parts = line.split(' ', 2)
+            chains.setdefault(parts[1], []).append(parts[2] if len(parts) > 2 else '')
+    return tables
+
+
+def compare(expected, kernel, owned_prefix=OWNED_PREFIX):
+    """
+    Compares the chains of the applied ruleset `expected` (as returned by
+    parse_restore_content) with the kernel's (parse_save). Only chains the
+    ruleset declares and kernel chains named `owned_prefix`* are looked at.
+    Each chain's rules are hashed once and compared as multisets; a chain
+    whose rules match but not in order is reported with no missing or
+    extra rules. Returns a DriftReport.
+    """
+    missing = extra = 0
+    drifted = []
+    for table in sorted(set(expected) | set(kernel)):
+        expected_chains = expected.get(table, {})
+        kernel_chains = kernel.get(table, {})
+        owned = set(expected_chains) | {c for c in kernel_chains if c.startswith(owned_prefix)}
+        for chain in sorted(owned):
+            want = [rule_hash(spec) for spec in expected_chains.get(chain, ())]
+            have = [rule_hash(spec) for spec in kernel_chains.get(chain, ())]
+            if want == have and (chain in kernel_chains) == (chain in expected_chains):
+                continue
+            want_counts, have_counts = Counter(want), Counter(have)
+            missing += sum((want_counts - have_counts).values())
+            extra += sum((have_counts - want_counts).values())
+            drifted.append((table, chain))
+    return DriftReport(missing, extra, drifted)
+
+
+def repair_content(expected, chains):
+    """
+    iptables-restore input (for `-n`) that rewrites only the drifted
+    `chains` from the applied ruleset `expected`: each one is flushed (or
+    created) and refilled, and drifted chains the ruleset does not declare
+    are deleted. Chains not listed are left alone.
+    """
+    by_table = {}
+    for table, chain in chains:
+        by_table.setdefault(table, []).append(chain)
+
+    lines = []
+    for table in sorted(by_table):
+        table_chains = expected.get(table, {})
+        rewrite = [c for c in by_table[table] if c in table_chains]
+        stale = [c for c in by_table[table] if c not in table_chains]
+        lines.append(f"*{table}")
+        # Declared first so jumps between rewritten chains resolve
+        for chain in rewrite:
+            lines.append(f"-F {chain}" if chain in BUILTIN_CHAINS else f":{chain} - [0:0]")
+        for chain in rewrite:
+            lines.extend(f"-A {chain} {spec}" for spec in table_chains[chain])
+        # Only after the jumps into them were rewritten
+        lines.extend(f"-F {chain}" for chain in stale)
+        lines.extend(f"-X {chain}" for chain in stale)
+        lines.append("COMMIT")
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def parse_nft_listing(listing):
+    """
+    Splits an `nft list table` listing into {chain: [line, ...]}; lines
+    outside chains (sets, maps) are kept under None.
+    """
+    chains = {None: []}
+    chain = None
+    for line in listing.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('chain ') and stripped.endswith('{'):
+            chain = stripped.split()[1]
+            chains[chain] = []
+        elif stripped == '}' and chain is not None:
+            chain = None
+        elif stripped:
+            chains[chain].append(stripped)
+    return chains
+
+
+def compare_listings(expected, current, table):
+    """
+    Compares two `nft list table` listings chain by chain, like compare().
+    """
+    expected, current = parse_nft_listing(expected), parse_nft_listing(current)
+    missing = extra = 0
+    drifted = []
+    for chain in sorted(set(expected) | set(current), key=lambda c: (c is not None, c or '')):
+        want, have = expected.get(chain), current.get(chain)
+        if want == have:
+            continue
+        want_counts, have_counts = Counter(want or ()), Counter(have or ())
+        missing += sum((want_counts - have_counts).values())
+        extra += sum((have_counts - want_counts).values())
+        drifted.append((table, chain or ''))
+    return DriftReport(missing, extra, drifted)
+
+
+def record(backend, report):
+    if report is None:
+        return
+    metrics.DRIFT_RULES.set(report.missing, backend=backend, kind='missing')
+    metrics.DRIFT_RULES.set(report.extra, backend=backend, kind='extra')
+    metrics.DRIFT_CHAINS.set(len(report.chains), backend=backend)
+
+
+class DriftChecker:
+    """
+    Compares the kernel with the last applied ruleset every `interval`
+    seconds in a background thread (one iptables-save or nft listing per
+    check, no database access) and exports the result as metrics. With
+    `repair` the drifted chains are re-applied right away. Checks and
+    repairs hold `lock`, so they never see a half-finished apply.
+    """
+    def __init__(self, app, backend, lock, interval=CHECK_INTERVAL, repair=False):
+        self.app = app
+        self.backend = backend
+        self.lock = lock
+        self.interval = interval
+        self.repair = repair
+        # (time.time(), DriftReport or None) of the last check in this process
+        self.last = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name='drift-checker', daemon=True)
+                self._thread.start()
+
+    def check(self, repair=None):
+        """
+        Runs one check (and a repair when drifted and `repair`, by default
+        the checker's setting). Returns (report, chains repaired).
+        """
+        repair = self.repair if repair is None else repair
+        repaired = 0
+        with self.lock:
+            report = self.backend.check_drift()
+            if report is not None and report.chains:
+                logger.warning(f"Kernel rules drifted: {report.missing} missing, {report.extra} extra "
+                               f"in {len(report.chains)} chains")
+                if repair:
+                    repaired = self.backend.repair_drift(report)
+                    report = self.backend.check_drift()
+        record(self.backend.name, report)
+        self.last = (time.time(), report)
+        return report, repaired
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Drift check failed")
@@ -0,0 +1,262 @@
+import fcntl
+import json
+import logging
+import os
+import subprocess
+import threading
+
+import metrics
+from ruleset_optimizer import CompiledUser
+
+logger = logging.getLogger(__name__)
+
+# Size of the writes into the loader's stdin
+RESTORE_CHUNK_BYTES = 64 * 1024
+
+BACKENDS = ('iptables', 'nftables')
+
+# Kernel rules generated from a database rule carry "fwm:r<rule id>" as a
+# comment, which is how traffic counters are mapped back to rules
+RULE_COMMENT_PREFIX = "fwm:r"
+
+
+class FirewallBackend:
+    """
+    Interface the application uses to turn users and rules into kernel
+    state. A backend generates its ruleset as text lines (so it can be
+    previewed on /validate and streamed), applies it and remembers what it
+    applied.
+
+    Subclasses set `name` and implement iter_lines, build_ruleset,
+    apply_compiled and apply_rules_stream.
+    """
+    name = None
+
+    def __init__(self, snapshot_path=None, dispatch='flat', optimize=False):
+        # Backend specific rule layout, see the subclass
+        self.dispatch = dispatch
+        # Run ruleset_optimizer.optimize_ruleset before generating
+        self.optimize = optimize
+        # Where the last successfully applied ruleset is remembered between
+        # runs. Without it every apply is a full restore.
+        self.snapshot_path = snapshot_path
+
+    def iter_lines(self, users):
+        """
+        Yields the ruleset for `users` one line at a time.
+        """
+        raise NotImplementedError
+
+    def build_ruleset(self, users):
+        """
+        Returns (content, ipsets, stats) for `users`; see IptablesManager.
+        """
+        raise NotImplementedError
+
+    def apply_compiled(self, content, ipsets=None, incremental=False, revision=None):
+        """
+        Applies a ruleset returned by build_ruleset. Returns a summary dict:
+        mode, added and removed rule counts.
+        """
+        raise NotImplementedError
+
+    def apply_rules_stream(self, users):
+        """
+        Full apply that streams generated lines straight into the loader.
+        """
+        raise NotImplementedError
+
+    def read_rule_counters(self):
+        """
+        Returns {rule_id: (packets, bytes)} read from the kernel in one
+        listing, or None if the counters cannot be read.
+        """
+        raise NotImplementedError
+
+    def check_drift(self):
+        """
+        Compares the kernel with the last applied ruleset. Returns a
+        drift.DriftReport, or None if nothing was applied yet (or it was
+        streamed) or the kernel cannot be read.
+        """
+        raise NotImplementedError
+
+    def repair_drift(self, report):
+        """
+        Re-applies the parts of the last applied ruleset that `report`
+        found drifted. Returns the number of chains restored.
+        """
+        raise NotImplementedError
+
+    def table_line_counts(self, content):
+        """
+        Returns {table: line_count} for a generated ruleset.
+        """
+        counts = {}
+        table = None
+        for line in content.splitlines():
+            if line.startswith('*'):
+                table = line[1:]
+                counts[table] = 0
+            elif table is not None and line != 'COMMIT':
+                counts[table] += 1
+        return counts
+
+    def apply_rules(self, users, incremental=False):
+        content, ipsets, _ = self.build_ruleset(users)
+        return self.apply_compiled(content, ipsets, incremental=incremental)
+
+    def applied_users(self):
+        """
+        The users (CompiledUser) the ruleset in the kernel was built from,
+        as recorded by record_applied_users(), or None if unknown: nothing
+        applied yet, a streamed apply, or an apply that did not record them.
+        """
+        snapshot = self._load_snapshot()
+        if not snapshot or snapshot.get('users') is None:
+            return None
+        return [CompiledUser.from_json(user) for user in snapshot['users']]
+
+    def record_applied_users(self, users):
+        """
+        Records the users the ruleset just applied was built from, so a
+        later apply can change some users and keep the others as applied.
+        """
+        snapshot = self._load_snapshot()
+        if snapshot is not None:
+            snapshot['users'] = [user.to_json() for user in users]
+            self._write_snapshot(snapshot)
+
+    def _keep_applied_users(self, previous):
+        # Rewriting the snapshot of an unchanged ruleset keeps its users
+        if previous.get('users') is not None:
+            snapshot = self._load_snapshot()
+            if snapshot is not None:
+                self._write_snapshot(dict(snapshot, users=previous['users']))
+
+    def _load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            with open(self.snapshot_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable ruleset snapshot: {e}")
+            return None
+
+    def _write_snapshot(self, snapshot):
+        os.makedirs(os.path.dirname(os.path.abspath(self.snapshot_path)), exist_ok=True)
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.snapshot_path)
+
+
+class FileLock:
+    """
+    Exclusive lock shared by every thread and process using the same
+    `path` (flock on a lock file), so only one worker writes to the
+    kernel at a time. Not reentrant.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except BaseException:
+                os.close(fd)
+                raise
+            self._fd = fd
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        fd, self._fd = self._fd, None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        finally:
+            self._thread_lock.release()
+
+
+def rule_comment(rule):
+    """
+    Returns the comment tagging the kernel rule generated from `rule`, or
+    None if it has no database id. Rules merged by the optimizer are tagged
+    with their first source rule, which then carries the merged traffic.
+    """
+    rule_ids = getattr(rule, 'rule_ids', None) or [getattr(rule, 'id', None)]
+    if rule_ids[0] is None:
+        return None
+    return f"{RULE_COMMENT_PREFIX}{rule_ids[0]}"
+
+
+def pipe_lines(cmd, lines):
+    """
+    Streams `lines` into the stdin of `cmd` (no shell, no temp file) in
+    RESTORE_CHUNK_BYTES writes. Raises CalledProcessError on failure.
+    """
+    logger.info(f"Running: {' '.join(cmd)}")
+    with metrics.restore_timer(cmd[0]):
+        _pipe_lines(cmd, lines)
+
+
+def _pipe_lines(cmd, lines):
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        logger.error(f"An error occurred: {e}")
+        raise e
+
+    try:
+        chunk = []
+        size = 0
+        for line in lines:
+            chunk.append(line)
+            size += len(line) + 1
+            if size >= RESTORE_CHUNK_BYTES:
+                proc.stdin.write(("\n".join(chunk) + "\n").encode())
+                chunk, size = [], 0
+        if chunk:
+            proc.stdin.write(("\n".join(chunk) + "\n").encode())
+        proc.stdin.close()
+    except BrokenPipeError:
+        # The loader bailed out early; its exit status says why
+        pass
+    except Exception as e:
+        proc.kill()
+        proc.wait()
+        logger.error(f"An error occurred: {e}")
+        raise e
+
+    stderr = proc.stderr.read()
+    proc.stderr.close()
+    returncode = proc.wait()
+    if returncode != 0:
+        e = subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+        logger.error(f"Error applying rules: {e}")
+        if stderr:
+            logger.error(f"Stderr: {stderr.decode()}")
+        raise e
+
+
+def create_backend(name, **kwargs):
+    """
+    Returns the backend registered under `name` ('iptables' or 'nftables').
+    """
+    if name == 'iptables':
+        from iptables_manager import IptablesManager
+        return IptablesManager(**kwargs)
+    if name == 'nftables':
+        from nftables_manager import NftablesManager
+        return NftablesManager(**kwargs)
+    raise ValueError(f"Unknown firewall backend: {name}")
@@ -0,0 +1,239 @@
+"""
+Gateway agent: pulls the ruleset of the users bound to this gateway from
+the portal and applies it to the local kernel.
+
+    python gateway_agent.py --portal https://portal:5000 --token <token>
+
+The portal answers a poll with 304 while nothing changed for this
+gateway. After a change the agent downloads only the ruleset fragments it
+does not already hold, applies the assembled ruleset incrementally with
+the backend the portal names, and reports the applied revision and apply
+time back to the portal.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+import zlib
+
+from firewall_backend import create_backend
+
+logger = logging.getLogger('gateway_agent')
+
+# Seconds between polls
+POLL_INTERVAL = 10
+
+# Digests per /agent/objects request
+OBJECT_BATCH = 200
+
+STATE_DIR = '/var/lib/firewall-manager-agent'
+
+
+class AgentError(Exception):
+    pass
+
+
+class ManifestChanged(AgentError):
+    """
+    The portal's manifest changed while fragments were being fetched.
+    """
+
+
+class HttpTransport:
+    """
+    JSON over HTTP(S) to the portal, authenticated by the gateway token.
+    """
+    def __init__(self, portal_url, token, timeout=30):
+        self.portal_url = portal_url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Returns (status, headers, decoded JSON body or None).
+        """
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.portal_url + path, data=data, method=method)
+        req.add_header('Authorization', f'Bearer {self.token}')
+        if data is not None:
+            req.add_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            req.add_header(name, value)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                payload = response.read()
+                status, response_headers = response.status, response.headers
+        except urllib.error.HTTPError as e:
+            payload, status, response_headers = e.read(), e.code, e.headers
+        return status, response_headers, json.loads(payload) if payload else None
+
+
+class GatewayAgent:
+    """
+    Keeps the fragments of the last applied manifest under `state_dir`, so
+    a change costs only the fragments that differ, also across restarts.
+    The backend keeps its snapshot there too, so kernel updates stay
+    incremental. The first sync of a process always applies (from the
+    stored fragments when nothing changed), so a gateway whose kernel
+    rules were lost in a reboot gets them back right away; the backend
+    skips the load when the kernel still matches.
+    """
+    def __init__(self, transport, state_dir=STATE_DIR):
+        self.transport = transport
+        self.state_dir = state_dir
+        self.manifest = None
+        self.revision = None
+        self._objects = {}
+        self._backends = {}
+        # Set once this process applied a manifest; until then polls are
+        # unconditional
+        self._applied = False
+        self._load_state()
+
+    def _state_path(self, *parts):
+        return os.path.join(self.state_dir, *parts)
+
+    def _load_state(self):
+        try:
+            with open(self._state_path('agent_state.json')) as f:
+                state = json.load(f)
+            objects = {}
+            for digest in state['objects']:
+                with open(self._state_path('objects', digest), 'rb') as f:
+                    objects[digest] = f.read()
+        except (OSError, ValueError, KeyError):
+            # First run or incomplete state: fetch everything
+            return
+        self.manifest, self.revision, self._objects = state['manifest'], state['revision'], objects
+
+    def _save_state(self, objects):
+        os.makedirs(self._state_path('objects'), exist_ok=True)
+        for digest, data in objects.items():
+            if digest not in self._objects:
+                with open(self._state_path('objects', digest), 'wb') as f:
+                    f.write(data)
+        tmp_path = self._state_path('agent_state.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'manifest': self.manifest, 'revision': self.revision, 'objects': list(objects)}, f)
+        os.replace(tmp_path, self._state_path('agent_state.json'))
+        for digest in self._objects:
+            if digest not in objects:
+                try:
+                    os.remove(self._state_path('objects', digest))
+                except OSError:
+                    pass
+
+    def _backend(self, name):
+        if name not in self._backends:
+            self._backends[name] = create_backend(
+                name, snapshot_path=os.path.join(self.state_dir, f'{name}_snapshot.json'))
+        return self._backends[name]
+
+    def _fetch(self, digests):
+        fetched = {}
+        for i in range(0, len(digests), OBJECT_BATCH):
+            status, _, body = self.transport.request('POST', '/agent/objects',
+                                                     {'digests': digests[i:i + OBJECT_BATCH]})
+            if status == 409:
+                raise ManifestChanged(body.get('error') if body else 'manifest changed')
+            if status != 200:
+                raise AgentError(f"Fetching fragments failed with HTTP {status}")
+            for digest, data in body['objects'].items():
+                data = zlib.decompress(base64.b64decode(data))
+                if hashlib.sha256(data).hexdigest() != digest:
+                    raise AgentError(f"Fragment {digest[:12]} does not match its digest")
+                fetched[digest] = data
+        return fetched
+
+    def _report(self, **report):
+        status, _, _ = self.transport.request('POST', '/agent/report', report)
+        if status != 204:
+            logger.warning(f"Portal rejected the apply report (HTTP {status})")
+
+    def sync(self):
+        """
+        Polls the portal once and applies a changed ruleset. Returns None
+        when nothing changed, else a summary dict: revision, mode, apply_ms,
+        fetched and total fragment counts.
+        """
+        for attempt in range(3):
+            headers = {'If-None-Match': f'"{self.manifest}"'} if self.manifest and self._applied else {}
+            status, _, manifest = self.transport.request('GET', '/agent/manifest', headers=headers)
+            if status == 304:
+                return None
+            if status != 200:
+                raise AgentError(f"Fetching the manifest failed with HTTP {status}")
+            wanted = manifest['fragments'] + ([manifest['ipsets']] if manifest['ipsets'] else [])
+            missing = [d for d in dict.fromkeys(wanted) if d not in self._objects]
+            try:
+                fetched = self._fetch(missing)
+            except ManifestChanged:
+                logger.info("Manifest changed while fetching, retrying")
+                continue
+            break
+        else:
+            raise AgentError("Manifest kept changing while fetching fragments")
+
+        objects = {d: self._objects[d] if d in self._objects else fetched[d] for d in wanted}
+        content = b"".join(objects[d] for d in manifest['fragments']).decode()
+        ipsets = json.loads(objects[manifest['ipsets']]) if manifest['ipsets'] else {}
+
+        started = time.perf_counter()
+        try:
+            result = self._backend(manifest['backend']).apply_compiled(
+                content, ipsets, incremental=True, revision=manifest['revision'])
+        except Exception as e:
+            apply_ms = (time.perf_counter() - started) * 1000
+            self._report(revision=manifest['revision'], manifest=manifest['manifest'], apply_ms=apply_ms,
+                         mode='failed', error=str(e) or type(e).__name__)
+            raise
+        apply_ms = (time.perf_counter() - started) * 1000
+
+        self.manifest = manifest['manifest']
+        self.revision = manifest['revision']
+        self._save_state(objects)
+        self._objects = objects
+        self._applied = True
+        self._report(revision=self.revision, manifest=self.manifest, apply_ms=apply_ms, mode=result['mode'])
+        summary = {'revision': self.revision, 'mode': result['mode'], 'apply_ms': apply_ms,
+                   'fetched': len(missing), 'total': len(set(wanted))}
+        logger.info(f"Applied revision {self.revision} ({result['mode']}) in {apply_ms:.0f} ms, "
+                    f"fetched {len(missing)} of {len(set(wanted))} fragments")
+        return summary
+
+    def run(self, interval=POLL_INTERVAL):
+        while True:
+            try:
+                self.sync()
+            except Exception:
+                logger.exception("Sync failed")
+            time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--portal', required=True, help="Portal base URL")
+    parser.add_argument('--token', default=os.environ.get('FWM_AGENT_TOKEN'),
+                        help="Gateway token (default: $FWM_AGENT_TOKEN)")
+    parser.add_argument('--state-dir', default=STATE_DIR)
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL)
+    parser.add_argument('--once', action='store_true', help="Sync once, print the summary and exit")
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error("--token or FWM_AGENT_TOKEN is required")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    agent = GatewayAgent(HttpTransport(args.portal, args.token), args.state_dir)
+    if args.once:
+        print(json.dumps(agent.sync()))
+        return
+    agent.run(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import base64
+import hashlib
+import logging
+import secrets
+import threading
+
+from models import db, Gateway
+from firewall_backend import create_backend
+from ruleset_cache import ruleset_cache, current_revision
+import ruleset_history
+
+logger = logging.getLogger(__name__)
+
+# Snapshots kept per gateway in the ruleset history
+GATEWAY_HISTORY_LIMIT = 20
+
+
+def new_token():
+    return secrets.token_urlsafe(32)
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def authenticate(authorization):
+    """
+    Returns the Gateway for an "Authorization: Bearer <token>" header, or None.
+    """
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    return Gateway.query.filter_by(token_hash=hash_token(token.strip())).first()
+
+
+def history_key(gateway):
+    # RulesetSnapshot.backend of a gateway's snapshots, kept apart from the
+    # portal's own history and rollback
+    return f"gateway:{gateway.id}"
+
+
+class GatewayRulesets:
+    """
+    Per-process cache of each gateway's current manifest.
+
+    A gateway's ruleset is compiled from the cached per-user fragments (see
+    ruleset_cache) for the users bound to it, with a backend of the
+    gateway's type, and stored as a history snapshot: fragments the agent
+    already holds are shared with its previous ruleset, so after a change
+    the agent downloads only the fragments that changed. Between changes
+    a poll costs one revision read.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._backends = {}
+        # {gateway_id: (revision, {'revision', 'backend', 'manifest', 'fragments', 'ipsets'})}
+        self._manifests = {}
+
+    def clear(self):
+        with self._lock:
+            self._manifests = {}
+
+    def backend(self, gateway, dispatch='flat', optimize=False):
+        key = (gateway.backend, dispatch, optimize)
+        if key not in self._backends:
+            # Compile only; the agent applies and keeps the snapshot
+            self._backends[key] = create_backend(gateway.backend, dispatch=dispatch, optimize=optimize)
+        return self._backends[key]
+
+    def manifest(self, gateway, dispatch='flat', optimize=False):
+        """
+        Returns the current manifest of `gateway`: its revision, the
+        manifest digest (the agent's ETag) and the digests of the fragments
+        and ipsets object to fetch. Commits when a new snapshot is stored.
+        """
+        with self._lock:
+            revision = current_revision()
+            cached = self._manifests.get(gateway.id)
+            if cached is not None and cached[0] == revision:
+                return cached[1]
+            backend = self.backend(gateway, dispatch, optimize)
+            revision, content, ipsets, _ = ruleset_cache.build(backend, gateway_id=gateway.id)
+            snapshot = ruleset_history.record(history_key(gateway), revision, content, ipsets,
+                                              limit=GATEWAY_HISTORY_LIMIT)
+            db.session.commit()
+            stored = ruleset_history.load_manifest(snapshot.manifest)
+            manifest = {
+                'revision': revision,
+                'backend': gateway.backend,
+                'manifest': snapshot.manifest,
+                'fragments': stored['fragments'],
+                'ipsets': stored['ipsets'],
+            }
+            self._manifests[gateway.id] = (revision, manifest)
+            return manifest
+
+
+def manifest_objects(manifest):
+    """
+    Digests an agent may fetch for `manifest`.
+    """
+    return set(manifest['fragments']) | ({manifest['ipsets']} if manifest['ipsets'] else set())
+
+
+def encode_objects(digests):
+    """
+    Returns {digest: base64 zlib data} for the stored objects `digests`.
+    """
+    return {digest: base64.b64encode(data).decode()
+            for digest, data in ruleset_history.export_objects(digests).items()}
+
+
+gateway_rulesets = GatewayRulesets()
@@ -0,0 +1,28 @@
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# Request handling is mostly database bound, so the usual 2 x cores + 1
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+
+# Bulk imports and synchronous applies can take a while on large rulesets
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = 30
+
+# Import the app (and create tables) once in the master; workers fork from it
+preload_app = True
+
+# Recycle workers now and then to bound memory growth
+max_requests = 5000
+max_requests_jitter = 500
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    from app import init_worker
+    init_worker()
@@ -1,39 +1,43 @@
-import shutil
-import socket
 import logging
-import subprocess
+
+from system_probe import find_tools, system_probe
 
 logger = logging.getLogger(__name__)
 
-def check_system_dependencies():
+def check_system_dependencies(backend='iptables', tools=None):
     """
-    Checks if required system dependencies (iptables) are installed.
+    Checks if required system dependencies (iptables, or nft for the
+    nftables backend) are installed. `tools` maps tool names to their
+    paths (system_probe results); without it PATH is searched.
     Returns True if all dependencies are met, False otherwise.
     """
-    iptables_path = shutil.which("iptables")
+    if tools is None:
+        tools = find_tools()
+    if backend == 'nftables':
+        if not tools.get("nft"):
+            logger.error("nft not found. Please install nftables.")
+            return False
+        return True
+
+    iptables_path = tools.get("iptables")
     if not iptables_path:
         logger.error("iptables not found. Please install iptables.")
         return False
         
     # Check for persistence tools (optional but recommended)
-    if not shutil.which("netfilter-persistent") and not shutil.which("iptables-save"):
+    if not tools.get("netfilter-persistent") and not tools.get("iptables-save"):
          logger.warning("Persistence tools (netfilter-persistent or iptables-save) not found. Rules may not survive reboot.")
          
     return True
 
 def get_host_ip():
     """
-    Auto-detects the host's private IP address.
+    Auto-detects the host's private IP address from the local interfaces
+    (the default route's interface first), without any network traffic.
     Returns the IP address as a string, or None if detection fails.
     """
     try:
-        # Connect to a public DNS server to determine the local IP used for routing
-        # We don't actually send data, just establish the socket to get the local endpoint
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
+        return system_probe.get().host_ip
     except Exception as e:
         logger.error(f"Error detecting host IP: {e}")
         return None
@@ -0,0 +1,276 @@
+import ipaddress
+import logging
+
+from sqlalchemy import func
+
+from models import db, User, IpPool, IpFreeRange
+
+logger = logging.getLogger(__name__)
+
+# Attempts before giving up when concurrent requests race for the same range
+MAX_RETRIES = 5
+
+
+def _host_bounds(network):
+    first, last = int(network.network_address), int(network.broadcast_address)
+    if network.prefixlen < 31:
+        # Skip the network and broadcast addresses
+        first, last = first + 1, last - 1
+    return first, last
+
+
+def _network(config):
+    network = ipaddress.ip_network(config.user_network_cidr)
+    if network.version != 4:
+        raise ValueError("The address pool only supports IPv4 networks")
+    return network
+
+
+def _used_addresses(config):
+    used = set()
+    for (ip_str,) in db.session.query(User.ip_address):
+        try:
+            used.add(int(ipaddress.ip_address(ip_str)))
+        except ValueError:
+            continue
+    if config.host_ip:
+        used.add(int(ipaddress.ip_address(config.host_ip)))
+    return used
+
+
+def _free_ranges(first, last, used):
+    """
+    Yields the (start, end) gaps between the `used` addresses within
+    [first, last], in ascending order.
+    """
+    cursor = first
+    for addr in sorted(a for a in used if first <= a <= last):
+        if addr > cursor:
+            yield cursor, addr - 1
+        cursor = addr + 1
+    if cursor <= last:
+        yield cursor, last
+
+
+def rebuild_pool(config):
+    """
+    Rebuilds the free-range table for config.user_network_cidr from the
+    addresses currently held by users and the host. Runs once per network
+    change, in O(users log users).
+    """
+    network = _network(config)
+    first, last = _host_bounds(network)
+    used = _used_addresses(config)
+
+    IpFreeRange.query.delete()
+    IpPool.query.delete()
+
+    ranges = [{'start': start, 'end': end} for start, end in _free_ranges(first, last, used)]
+    if ranges:
+        db.session.execute(IpFreeRange.__table__.insert(), ranges)
+    db.session.add(IpPool(network_cidr=config.user_network_cidr))
+    db.session.commit()
+    logger.info(f"Address pool for {network} rebuilt with {len(ranges)} free ranges")
+
+
+def ensure_pool(config):
+    """
+    Builds the pool on first use or after the user network changed.
+    """
+    pool = IpPool.query.first()
+    if pool is None or pool.network_cidr != config.user_network_cidr:
+        rebuild_pool(config)
+
+
+def _take(addr):
+    """
+    Removes a single address from the free ranges. Returns False if it is not
+    free. Uses conditional updates so a concurrent writer that changed the
+    same range makes this attempt fail instead of double-allocating.
+    """
+    rng = IpFreeRange.query.filter(IpFreeRange.start <= addr) \
+        .order_by(IpFreeRange.start.desc()).first()
+    if rng is None or rng.end < addr:
+        return False
+    start, end = rng.start, rng.end
+    table = IpFreeRange.__table__
+    guard = (table.c.id == rng.id) & (table.c.start == start) & (table.c.end == end)
+
+    if start == end:
+        result = db.session.execute(table.delete().where(guard))
+    elif addr == start:
+        result = db.session.execute(table.update().where(guard).values(start=start + 1))
+    elif addr == end:
+        result = db.session.execute(table.update().where(guard).values(end=end - 1))
+    else:
+        result = db.session.execute(table.update().where(guard).values(end=addr - 1))
+        if result.rowcount == 1:
+            db.session.execute(table.insert().values(start=addr + 1, end=end))
+    db.session.expire_all()
+    return result.rowcount == 1
+
+
+def _give_back(addr):
+    """
+    Returns an address to the free ranges, merging with its neighbours.
+    """
+    table = IpFreeRange.__table__
+    containing = IpFreeRange.query.filter(IpFreeRange.start <= addr) \
+        .order_by(IpFreeRange.start.desc()).first()
+    if containing is not None and containing.end >= addr:
+        return
+    below = IpFreeRange.query.filter_by(end=addr - 1).first()
+    above = IpFreeRange.query.filter_by(start=addr + 1).first()
+    if below and above:
+        db.session.execute(table.delete().where(table.c.id == above.id))
+        db.session.execute(table.update().where(table.c.id == below.id).values(end=above.end))
+    elif below:
+        db.session.execute(table.update().where(table.c.id == below.id).values(end=addr))
+    elif above:
+        db.session.execute(table.update().where(table.c.id == above.id).values(start=addr))
+    else:
+        db.session.execute(table.insert().values(start=addr, end=addr))
+    db.session.expire_all()
+
+
+def _in_pool(config, addr):
+    first, last = _host_bounds(ipaddress.ip_network(config.user_network_cidr))
+    return first <= addr <= last
+
+
+def suggest_ip(config):
+    """
+    The lowest free address of the user network, without holding it: the
+    add-user form offers it and claim_ip() takes it when the form is
+    saved. Only reads, so rendering the form never writes. Returns None
+    if nothing is free.
+    """
+    pool = IpPool.query.first()
+    if pool is None or pool.network_cidr != config.user_network_cidr:
+        # Not built yet: the first gap between the users' addresses,
+        # without building the pool here
+        first, last = _host_bounds(_network(config))
+        addr = next((start for start, _ in _free_ranges(first, last, _used_addresses(config))), None)
+    else:
+        addr = db.session.query(func.min(IpFreeRange.start)).scalar()
+    return str(ipaddress.ip_address(addr)) if addr is not None else None
+
+
+def claim_ip(config, ip_str):
+    """
+    Marks ip_str as allocated to a user being saved. Succeeds if the address
+    is still free or lies outside the pool. Concurrent claims of the same
+    address are decided by the conditional update in _take(), so only one
+    succeeds. Does not commit; the caller commits together with the user row.
+    """
+    ensure_pool(config)
+    addr = int(ipaddress.ip_address(ip_str))
+    if not _in_pool(config, addr):
+        return True
+    return _take(addr)
+
+
+def release_ip(config, ip_str):
+    """
+    Returns an address to the pool. Does not commit.
+    """
+    ensure_pool(config)
+    try:
+        addr = int(ipaddress.ip_address(ip_str))
+    except ValueError:
+        return
+    if not _in_pool(config, addr):
+        return
+    _give_back(addr)
+
+
+def release_bulk(config, ip_strs):
+    """
+    Returns many addresses to the pool in one pass, e.g. those of purged
+    users: the free ranges are read once, merged with the addresses and
+    written back with one delete and one insert. Call ensure_pool() before
+    the surrounding transaction; this does not build the pool or commit.
+    Returns the number of addresses released.
+    """
+    addrs = set()
+    for ip_str in ip_strs:
+        try:
+            addr = int(ipaddress.ip_address(ip_str))
+        except ValueError:
+            continue
+        if _in_pool(config, addr):
+            addrs.add(addr)
+    if not addrs:
+        return 0
+
+    ranges = [(r.start, r.end) for r in
+              IpFreeRange.query.order_by(IpFreeRange.start).with_for_update()]
+    merged = []
+    for start, end in sorted(ranges + [(addr, addr) for addr in addrs]):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    IpFreeRange.query.delete()
+    db.session.execute(IpFreeRange.__table__.insert(), [{'start': start, 'end': end} for start, end in merged])
+    db.session.expire_all()
+    return len(addrs)
+
+
+def allocate_bulk(config, explicit_ips, count):
+    """
+    Allocates many addresses in one pass for bulk imports: removes every
+    in-pool address of `explicit_ips` from the free ranges and takes the
+    `count` lowest remaining ones. Free ranges are read once (locked where
+    the database supports it) and written back in a single statement each
+    for delete and insert.
+
+    Returns (allocated_ips, unavailable_ips). Nothing is changed if any
+    explicit address is unavailable. Does not commit.
+    """
+    ensure_pool(config)
+
+    wanted = {}
+    for ip_str in explicit_ips:
+        addr = int(ipaddress.ip_address(ip_str))
+        if _in_pool(config, addr):
+            wanted[addr] = ip_str
+
+    ranges = [(r.start, r.end) for r in
+              IpFreeRange.query.order_by(IpFreeRange.start).with_for_update()]
+
+    remaining = []
+    taken = set()
+    for start, end in ranges:
+        cursor = start
+        for addr in sorted(a for a in wanted if start <= a <= end):
+            if addr > cursor:
+                remaining.append([cursor, addr - 1])
+            taken.add(addr)
+            cursor = addr + 1
+        if cursor <= end:
+            remaining.append([cursor, end])
+
+    unavailable = [wanted[a] for a in wanted if a not in taken]
+    if unavailable:
+        return [], unavailable
+
+    allocated = []
+    new_ranges = []
+    for start, end in remaining:
+        need = count - len(allocated)
+        if need > 0:
+            last = min(end, start + need - 1)
+            allocated.extend(str(ipaddress.ip_address(a)) for a in range(start, last + 1))
+            start = last + 1
+        if start <= end:
+            new_ranges.append({'start': start, 'end': end})
+    if len(allocated) < count:
+        raise ValueError(f"Address pool exhausted: {count} addresses requested, {len(allocated)} free")
+
+    IpFreeRange.query.delete()
+    if new_ranges:
+        db.session.execute(IpFreeRange.__table__.insert(), new_ranges)
+    db.session.expire_all()
+    return allocated, []
@@ -1,120 +1,587 @@
 import subprocess
+import hashlib
+import json
 import logging
+import difflib
+import os
+import ipaddress
+import re
+
+from ruleset_optimizer import optimize_ruleset, generate_ipset_content
+from firewall_backend import FirewallBackend, RULE_COMMENT_PREFIX, pipe_lines, rule_comment
+import drift
+import metrics
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class IptablesManager:
-    def __init__(self):
+# Chain names used by the 'tree' dispatch mode (iptables allows 28 chars)
+USER_CHAIN_PREFIX = "FWM_U_"
+NAT_USER_CHAIN_PREFIX = "FWM_N_"
+TREE_CHAIN_PREFIX = "FWM_T_"
+NAT_TREE_CHAIN_PREFIX = "FWM_NT_"
+# Below this many users a tree node just lists its users' jumps
+DISPATCH_LEAF_SIZE = 8
+
+# "[packets:bytes] -A CHAIN ... --comment fwm:r<id> ..." from iptables-save -c
+COUNTER_LINE = re.compile(r'^\[(\d+):(\d+)\] -A \S+ .*--comment "?' + re.escape(RULE_COMMENT_PREFIX) + r'(\d+)')
+
+
+def _covering_network(addrs):
+    """
+    Smallest CIDR containing every integer IPv4 address in the sorted list.
+    """
+    lo, hi = addrs[0], addrs[-1]
+    prefixlen = 32 - (lo ^ hi).bit_length()
+    return ipaddress.ip_network((lo, prefixlen), strict=False)
+
+
+def build_dispatch_tree(targets, parent_chain, prefix, leaf_size=DISPATCH_LEAF_SIZE):
+    """
+    Builds a binary tree of source-CIDR jump chains that routes a packet from
+    `parent_chain` to the chain of the user owning its source address.
+
+    targets is a list of (ip_address, user_chain). Every level splits the
+    covering network of its users on the first differing bit, so lookup cost
+    is bounded by the tree depth (<= 32, ~log2(n) for dense pools) instead of
+    the number of users.
+    Returns (chain_names, rule_lines).
+    """
+    if not targets:
+        return [], []
+    entries = sorted((int(ipaddress.ip_address(ip)), chain) for ip, chain in targets)
+    chains = []
+    rules = []
+
+    def node_chain(net):
+        return f"{prefix}{int(net.network_address):08x}_{net.prefixlen}"
+
+    def emit(chain, entries):
+        if len(entries) <= leaf_size:
+            for addr, target in entries:
+                rules.append(f"-A {chain} -s {ipaddress.ip_address(addr)} -j {target}")
+            return
+        net = _covering_network([addr for addr, _ in entries])
+        split = int(net.network_address) | (1 << (31 - net.prefixlen))
+        for half in ([e for e in entries if e[0] < split], [e for e in entries if e[0] >= split]):
+            if len(half) == 1:
+                addr, target = half[0]
+                rules.append(f"-A {chain} -s {ipaddress.ip_address(addr)} -j {target}")
+                continue
+            child_net = _covering_network([addr for addr, _ in half])
+            child = node_chain(child_net)
+            chains.append(child)
+            rules.append(f"-A {chain} -s {child_net} -j {child}")
+            emit(child, half)
+
+    root_net = _covering_network([addr for addr, _ in entries])
+    root = node_chain(root_net)
+    chains.append(root)
+    rules.append(f"-A {parent_chain} -s {root_net} -j {root}")
+    emit(root, entries)
+    return chains, rules
+
+
+def parse_rule_counters(output):
+    """
+    Returns {rule_id: (packets, bytes)} from `iptables-save -c` output,
+    summing rules that carry the same id.
+    """
+    counters = {}
+    for line in output.splitlines():
+        match = COUNTER_LINE.match(line)
+        if match:
+            packets, byte_count, rule_id = (int(g) for g in match.groups())
+            old_packets, old_bytes = counters.get(rule_id, (0, 0))
+            counters[rule_id] = (old_packets + packets, old_bytes + byte_count)
+    return counters
+
+
+def ruleset_digest(content, ipsets=None):
+    """
+    Identifies exactly what an apply loads: the restore input and the sets.
+    """
+    digest = hashlib.sha256(content.encode())
+    digest.update(json.dumps(ipsets or {}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def parse_restore_content(content):
+    """
+    Parses iptables-restore content into {table: {chain: [rule_spec, ...]}}.
+    Every chain that is declared, flushed or appended to is included, so an
+    empty list means "chain exists and is empty".
+    """
+    tables = {}
+    chains = None
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or line == 'COMMIT':
+            continue
+        if line.startswith('*'):
+            chains = tables.setdefault(line[1:], {})
+        elif line.startswith(':'):
+            chains.setdefault(line[1:].split()[0], [])
+        elif line.startswith('-F '):
+            chains[line.split()[1]] = []
+        elif line.startswith('-A '):
+            _, chain, spec = line.split(' ', 2)
+            chains.setdefault(chain, []).append(spec)
+    return tables
+
+
+def diff_rulesets(old, new):
+    """
+    Computes the minimal restore commands that turn the `old` parsed ruleset
+    into `new` (both as returned by parse_restore_content).
+    Returns (content, added, removed); content is None if nothing changed.
+    """
+    lines = []
+    added = removed = 0
+
+    for table in sorted(set(old) | set(new)):
+        old_chains = old.get(table, {})
+        new_chains = new.get(table, {})
+        body = []
+
+        # New user-defined chains have to exist before anything jumps to them
+        for chain in new_chains:
+            if chain not in old_chains:
+                body.append(f":{chain} - [0:0]")
+
+        deletes = []
+        inserts = []
+        for chain, new_specs in new_chains.items():
+            old_specs = old_chains.get(chain, [])
+            matcher = difflib.SequenceMatcher(None, old_specs, new_specs, autojunk=False)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                if tag in ('delete', 'replace'):
+                    deletes.extend((chain, i) for i in range(i1, i2))
+                if tag in ('insert', 'replace'):
+                    inserts.extend((chain, j, new_specs[j]) for j in range(j1, j2))
+
+        # Delete by rule number, highest first so earlier numbers stay valid.
+        # Once only the common subsequence is left, inserting in ascending
+        # target position rebuilds the new order exactly.
+        for chain, i in sorted(deletes, key=lambda d: (d[0], -d[1])):
+            body.append(f"-D {chain} {i + 1}")
+        for chain, j, spec in inserts:
+            body.append(f"-I {chain} {j + 1} {spec}")
+
+        # Chains that disappeared: references are gone by now, drop them
+        stale = [chain for chain in old_chains if chain not in new_chains]
+        for chain in stale:
+            body.append(f"-F {chain}")
+            removed += len(old_chains[chain])
+        for chain in stale:
+            body.append(f"-X {chain}")
+
+        added += len(inserts)
+        removed += len(deletes)
+        if body:
+            lines.append(f"*{table}")
+            lines.extend(body)
+            lines.append("COMMIT")
+
+    if not lines:
+        return None, 0, 0
+    return "\n".join(lines) + "\n", added, removed
+
+
+class IptablesManager(FirewallBackend):
+    name = 'iptables'
+
+    def __init__(self, snapshot_path=None, dispatch='flat', optimize=False):
+        # dispatch is 'flat' or 'tree', see generate_iptables_file_content
+        super().__init__(snapshot_path, dispatch, optimize)
         self.chain_name = "FIREWALL_MANAGER"
 
-    def generate_iptables_file_content(self, users):
+    def generate_iptables_file_content(self, users, dispatch=None):
         """
         Generates the content for an iptables-restore file.
+
+        dispatch='flat' puts every rule straight into FORWARD/POSTROUTING.
+        dispatch='tree' gives each user their own chain and reaches it through
+        a binary tree of source-CIDR jumps, so a packet only walks O(log n)
+        dispatch rules plus its own user's rules.
         """
-        filter_rules = []
-        nat_rules = []
+        return "\n".join(self.iter_iptables_lines(users, dispatch)) + "\n"
+
+    def iter_lines(self, users):
+        return self.iter_iptables_lines(users)
+
+    def iter_iptables_lines(self, users, dispatch=None):
+        """
+        Yields the iptables-restore lines one at a time.
+
+        `users` is iterated once per table (twice more in tree mode), so it
+        can be a re-iterable cursor-backed object instead of a list; only one
+        user's rules need to be in memory at a time. Every iteration must
+        yield the same users, or a rule may target an undeclared chain.
+        """
+        dispatch = dispatch or self.dispatch
+        if dispatch not in ('flat', 'tree'):
+            raise ValueError(f"Unknown dispatch mode: {dispatch}")
 
-        for user in users:
-            for rule in user.rules:
-                if user.forward_mode == 'NAT':
-                    # NAT (Masquerade)
-                    # -A POSTROUTING -s <user_ip> -d <dest_ip> -j MASQUERADE
-                    cmd = ["-A", "POSTROUTING"]
-                    cmd.extend(["-s", user.ip_address])
-                    cmd.extend(["-d", rule.destination_ip])
-                    
-                    if rule.protocol != 'all':
-                        cmd.extend(["-p", rule.protocol])
-                        if rule.destination_port:
-                            cmd.extend(["--dport", str(rule.destination_port)])
-                            
-                    cmd.extend(["-j", "MASQUERADE"])
-                    nat_rules.append(" ".join(cmd))
-                    
-                else: # ROUTE
-                    # Forwarding
-                    # -A FORWARD -s <user_ip> -d <dest_ip> -j <action>
-                    cmd = ["-A", "FORWARD"]
-                    cmd.extend(["-s", user.ip_address])
-                    cmd.extend(["-d", rule.destination_ip])
-                    
-                    if rule.protocol != 'all':
-                        cmd.extend(["-p", rule.protocol])
-                        if rule.destination_port:
-                            cmd.extend(["--dport", str(rule.destination_port)])
-                            
-                    cmd.extend(["-j", rule.action])
-                    filter_rules.append(" ".join(cmd))
-        
-        # Build the content
-        lines = []
-        
         # Filter Table
-        lines.append("*filter")
+        yield "*filter"
+        jumps = []
+        if dispatch == 'tree':
+            # Declaring a user-defined chain creates it, or flushes it if it exists
+            targets = []
+            for user in users:
+                if user.forward_mode != 'NAT' and self._has_own_chain(user):
+                    chain = f"{USER_CHAIN_PREFIX}{user.id}"
+                    targets.append((user.ip_address, chain))
+                    yield f":{chain} - [0:0]"
+            decls, jumps = build_dispatch_tree(targets, "FORWARD", TREE_CHAIN_PREFIX)
+            for chain in decls:
+                yield f":{chain} - [0:0]"
+
         # We do NOT set policies here to avoid overriding existing ones if using -n
         # But we DO flush the chains we manage
-        lines.append("-F FORWARD")
-        lines.append("-F INPUT") # Manage INPUT to ensure access
+        yield "-F FORWARD"
+        yield "-F INPUT" # Manage INPUT to ensure access
         
         # System Access Rules (INPUT)
         # 1. Allow Loopback
-        lines.append("-A INPUT -i lo -j ACCEPT")
+        yield "-A INPUT -i lo -j ACCEPT"
         # 2. Allow Established/Related
-        lines.append("-A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT")
+        yield "-A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT"
         # 3. Allow SSH
-        lines.append("-A INPUT -p tcp --dport 22 -j ACCEPT")
+        yield "-A INPUT -p tcp --dport 22 -j ACCEPT"
         # 4. Allow Portal (Flask default 5000, plus standard web ports)
-        lines.append("-A INPUT -p tcp --dport 5000 -j ACCEPT")
-        lines.append("-A INPUT -p tcp --dport 80 -j ACCEPT")
-        lines.append("-A INPUT -p tcp --dport 443 -j ACCEPT")
-        
-        lines.extend(filter_rules)
-        lines.append("COMMIT")
-        
+        yield "-A INPUT -p tcp --dport 5000 -j ACCEPT"
+        yield "-A INPUT -p tcp --dport 80 -j ACCEPT"
+        yield "-A INPUT -p tcp --dport 443 -j ACCEPT"
+
+        yield from jumps
+        for user in users:
+            if user.forward_mode == 'NAT' or not user.rules:
+                continue
+            # Forwarding
+            # -A FORWARD -s <user_ip> -d <dest_ip> -j <action>
+            if dispatch == 'tree' and self._has_own_chain(user):
+                chain, source = f"{USER_CHAIN_PREFIX}{user.id}", []
+            else:
+                chain, source = "FORWARD", self._source_args(user)
+            for rule in user.rules:
+                cmd = ["-A", chain] + source + self._rule_match_args(rule) + self._comment_args(user, rule)
+                cmd.extend(["-j", rule.action])
+                yield " ".join(cmd)
+        yield "COMMIT"
+
         # NAT Table
-        lines.append("*nat")
-        lines.append("-F POSTROUTING")
-        lines.extend(nat_rules)
-        lines.append("COMMIT")
-        
-        return "\n".join(lines) + "\n"
+        yield "*nat"
+        jumps = []
+        if dispatch == 'tree':
+            targets = []
+            for user in users:
+                if user.forward_mode == 'NAT' and self._has_own_chain(user):
+                    chain = f"{NAT_USER_CHAIN_PREFIX}{user.id}"
+                    targets.append((user.ip_address, chain))
+                    yield f":{chain} - [0:0]"
+            decls, jumps = build_dispatch_tree(targets, "POSTROUTING", NAT_TREE_CHAIN_PREFIX)
+            for chain in decls:
+                yield f":{chain} - [0:0]"
+
+        yield "-F POSTROUTING"
+        yield from jumps
+        for user in users:
+            if user.forward_mode != 'NAT' or not user.rules:
+                continue
+            # NAT (Masquerade)
+            # -A POSTROUTING -s <user_ip> -d <dest_ip> -j MASQUERADE
+            if dispatch == 'tree' and self._has_own_chain(user):
+                chain, source = f"{NAT_USER_CHAIN_PREFIX}{user.id}", []
+            else:
+                chain, source = "POSTROUTING", self._source_args(user)
+            for rule in user.rules:
+                cmd = ["-A", chain] + source + self._rule_match_args(rule) + self._comment_args(user, rule)
+                cmd.extend(["-j", "MASQUERADE"])
+                yield " ".join(cmd)
+        yield "COMMIT"
+
+    @staticmethod
+    def _has_own_chain(user):
+        # Optimizer groups (ipset sources) stay in the built-in chain
+        return bool(user.rules) and not getattr(user, 'source_set', None)
+
+    @staticmethod
+    def _source_args(user):
+        # Users collapsed by the optimizer are matched through an ipset
+        source_set = getattr(user, 'source_set', None)
+        if source_set:
+            return ["-m", "set", "--match-set", source_set, "src"]
+        return ["-s", user.ip_address]
+
+    @staticmethod
+    def _rule_match_args(rule):
+        args = ["-d", rule.destination_ip]
+        if rule.protocol != 'all':
+            args.extend(["-p", rule.protocol])
+            ports = getattr(rule, 'ports', None)
+            if ports and len(ports) > 1:
+                args.extend(["-m", "multiport", "--dports", ",".join(str(p) for p in ports)])
+            elif rule.destination_port:
+                args.extend(["--dport", str(rule.destination_port)])
+        return args
 
-    def apply_rules(self, users):
+    @staticmethod
+    def _comment_args(user, rule):
+        # Rules shared by an optimizer group cannot be attributed to one user
+        comment = None if getattr(user, 'source_set', None) else rule_comment(rule)
+        return ["-m", "comment", "--comment", comment] if comment else []
+
+    def build_ruleset(self, users):
+        """
+        Runs the optimizer (if enabled) and the generator.
+        Returns (content, ipsets, stats); ipsets maps set names to member IPs
+        and stats is None when the optimizer is disabled.
+        """
+        if not self.optimize:
+            return self.generate_iptables_file_content(users), {}, None
+        # Per-user chains already make the source implicit, so collapsing
+        # users into ipsets only pays off with flat dispatch
+        optimized = optimize_ruleset(users, collapse_sources=self.dispatch == 'flat')
+        content = self.generate_iptables_file_content(optimized.users)
+        return content, optimized.ipsets, optimized.stats
+
+    def apply_rules(self, users, incremental=False):
         """
         Generates the rules file and applies it using iptables-restore.
+
+        With incremental=True only the difference against the last applied
+        snapshot is restored, provided the kernel still matches that snapshot.
+        Otherwise (first run, drift, missing iptables-save) a full restore is
+        done. Returns a summary dict: mode ('full', 'incremental' or 'noop'),
+        added and removed rule counts.
         """
-        content = self.generate_iptables_file_content(users)
-        
+        content, ipsets, _ = self.build_ruleset(users)
+        return self.apply_compiled(content, ipsets, incremental=incremental)
+
+    def apply_compiled(self, content, ipsets=None, incremental=False, revision=None):
+        """
+        Applies an already generated ruleset (see apply_rules).
+
+        `revision` identifies the data the ruleset was compiled from and is
+        recorded in the snapshot. When the content and sets are exactly the
+        ones last applied (whatever the dispatch, optimizer or generator
+        that produced them) and the kernel still matches, nothing is
+        parsed, diffed or restored.
+        """
+        ipsets = ipsets or {}
+        digest = ruleset_digest(content, ipsets)
+        previous = self._load_snapshot()
+        snapshot = previous if incremental else None
+        if snapshot and not self._kernel_matches(snapshot):
+            logger.warning("Kernel rules drifted from last applied snapshot, doing a full restore")
+            snapshot = None
+
+        if snapshot and snapshot.get('digest') == digest:
+            logger.info(f"Ruleset of revision {revision} is already applied")
+            if snapshot.get('revision') != revision:
+                self._write_snapshot(dict(snapshot, revision=revision))
+            return {'mode': 'noop', 'added': 0, 'removed': 0}
+
+        new_tables = parse_restore_content(content)
+
+        old_ipsets = previous.get('ipsets', {}) if previous else {}
+        # Sets must exist before rules referencing them are restored
+        if ipsets and (snapshot is None or ipsets != old_ipsets):
+            self._restore_ipsets(generate_ipset_content(ipsets))
+
+        if snapshot:
+            delta, added, removed = diff_rulesets(snapshot['tables'], new_tables)
+            if delta is None and ipsets == old_ipsets:
+                logger.info("Ruleset unchanged, nothing to apply")
+                self._save_snapshot(new_tables, ipsets, revision, digest)
+                return {'mode': 'noop', 'added': 0, 'removed': 0}
+            if delta is not None:
+                self._restore(delta)
+            result = {'mode': 'incremental', 'added': added, 'removed': removed}
+        else:
+            # Chains we created last time but no longer generate would linger
+            if previous:
+                content = self._append_stale_chain_cleanup(content, previous['tables'], new_tables)
+            self._restore(content)
+            result = {
+                'mode': 'full',
+                'added': sum(len(r) for chains in new_tables.values() for r in chains.values()),
+                'removed': 0,
+            }
+
+        # Only now are stale sets no longer referenced by any rule
+        stale_sets = [name for name in old_ipsets if name not in ipsets]
+        if stale_sets:
+            self._restore_ipsets("".join(f"destroy {name}\n" for name in stale_sets))
+
+        self._save_snapshot(new_tables, ipsets, revision, digest)
+        return result
+
+    def _restore_ipsets(self, content):
+        """
+        Feeds content to ipset restore.
+        """
+        logger.info("Running: ipset restore -exist")
         try:
-            # Write to a temporary file
-            import tempfile
-            import os
-            
-            fd, path = tempfile.mkstemp(text=True)
-            try:
-                with os.fdopen(fd, 'w') as tmp:
-                    tmp.write(content)
-                
-                # Apply using iptables-restore -n (no flush of other chains)
-                cmd = f"iptables-restore -n < {path}"
-                logger.info(f"Running: {cmd}")
-                
-                # In a real environment, we would run this:
-                # subprocess.run(cmd, shell=True, check=True, stderr=subprocess.PIPE)
-                
-                # For this environment/demo, we simulate or try-catch
-                subprocess.run(cmd, shell=True, check=True, stderr=subprocess.PIPE)
-                
-            finally:
-                os.remove(path)
-                
+            with metrics.restore_timer("ipset"):
+                subprocess.run(["ipset", "restore", "-exist"], input=content.encode(),
+                               check=True, stderr=subprocess.PIPE)
         except subprocess.CalledProcessError as e:
-            logger.error(f"Error applying rules: {e}")
+            logger.error(f"Error loading ipsets: {e}")
             if e.stderr:
                 logger.error(f"Stderr: {e.stderr.decode()}")
             raise e
-        except Exception as e:
-            logger.error(f"An error occurred: {e}")
-            raise e
+
+    def _restore(self, content):
+        """
+        Feeds content to iptables-restore -n.
+        """
+        self._restore_lines(content.splitlines())
+
+    def _restore_lines(self, lines):
+        """
+        Streams restore lines into iptables-restore -n (no flush of other
+        chains), so memory stays flat however large the ruleset is.
+        """
+        pipe_lines(["iptables-restore", "-n"], lines)
+
+    def apply_rules_stream(self, users):
+        """
+        Full restore that streams generated lines straight into
+        iptables-restore. Unlike apply_rules it never holds the whole ruleset
+        in memory, so no snapshot is kept; the previous snapshot is discarded
+        so the next incremental apply starts with a full restore.
+        """
+        lines = self.iter_iptables_lines(users)
+        previous = self._load_snapshot()
+        if previous:
+            lines = self._with_stale_chain_cleanup(lines, previous['tables'])
+        self._restore_lines(lines)
+        if previous:
+            os.remove(self.snapshot_path)
+        return {'mode': 'stream', 'added': None, 'removed': 0}
+
+    @staticmethod
+    def _with_stale_chain_cleanup(lines, old_tables):
+        """
+        Passes `lines` through, then flushes and deletes chains of
+        `old_tables` that the stream did not declare or flush.
+        """
+        seen = {}
+        table = None
+        for line in lines:
+            if line.startswith('*'):
+                table = line[1:]
+                seen.setdefault(table, set())
+            elif line.startswith(':'):
+                seen[table].add(line[1:].split()[0])
+            elif line.startswith('-F '):
+                seen[table].add(line.split()[1])
+            yield line
+        for table, chains in old_tables.items():
+            stale = [c for c in chains if c not in seen.get(table, ())]
+            if stale:
+                yield f"*{table}"
+                yield from (f"-F {c}" for c in stale)
+                yield from (f"-X {c}" for c in stale)
+                yield "COMMIT"
+
+    @staticmethod
+    def _append_stale_chain_cleanup(content, old_tables, new_tables):
+        """
+        Appends flush/delete commands for user-defined chains that exist in the
+        previous snapshot but not in the new ruleset.
+        """
+        out = content
+        for table, chains in old_tables.items():
+            stale = [c for c in chains if c not in new_tables.get(table, {})]
+            if stale:
+                lines = [f"*{table}"]
+                lines.extend(f"-F {c}" for c in stale)
+                lines.extend(f"-X {c}" for c in stale)
+                lines.append("COMMIT")
+                out += "\n".join(lines) + "\n"
+        return out
+
+    def read_rule_counters(self):
+        try:
+            proc = subprocess.run(["iptables-save", "-c"], check=True,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Could not read rule counters: {e}")
+            return None
+        return parse_rule_counters(proc.stdout.decode())
+
+    def check_drift(self):
+        """
+        Compares one iptables-save listing of every table with the chains of
+        the last applied snapshot (see drift.compare).
+        """
+        snapshot = self._load_snapshot()
+        if not snapshot:
+            return None
+        try:
+            proc = subprocess.run(["iptables-save"], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Could not read kernel rules: {e}")
+            return None
+        return drift.compare(snapshot['tables'], drift.parse_save(proc.stdout.decode()))
+
+    def repair_drift(self, report):
+        """
+        Rewrites only the drifted chains from the last applied snapshot with
+        iptables-restore -n, then records the kernel's rendering again so
+        the next apply can stay incremental.
+        """
+        snapshot = self._load_snapshot()
+        if not snapshot or not report or not report.chains:
+            return 0
+        if snapshot.get('ipsets'):
+            # Rewritten rules may match sets that were destroyed as well
+            self._restore_ipsets(generate_ipset_content(snapshot['ipsets']))
+        self._restore(drift.repair_content(snapshot['tables'], report.chains))
+        self._save_snapshot(snapshot['tables'], snapshot.get('ipsets'), snapshot.get('revision'),
+                            snapshot.get('digest'))
+        self._keep_applied_users(snapshot)
+        logger.info(f"Repaired {len(report.chains)} drifted chains")
+        return len(report.chains)
+
+    def _read_kernel_chains(self, tables):
+        """
+        Returns {table: {chain: [rule_line, ...]}} for the chains in `tables`
+        as currently loaded in the kernel, or None if iptables-save failed.
+        """
+        state = {}
+        for table, chains in tables.items():
+            try:
+                proc = subprocess.run(["iptables-save", "-t", table], check=True,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning(f"Could not read kernel rules for table {table}: {e}")
+                return None
+            owned = {chain: [] for chain in chains}
+            for line in proc.stdout.decode().splitlines():
+                if line.startswith('-A '):
+                    chain = line.split(' ', 2)[1]
+                    if chain in owned:
+                        owned[chain].append(line)
+            state[table] = owned
+        return state
+
+    def _kernel_matches(self, snapshot):
+        kernel = snapshot.get('kernel')
+        if kernel is None:
+            return False
+        return self._read_kernel_chains(snapshot['tables']) == kernel
+
+    def _save_snapshot(self, tables, ipsets=None, revision=None, digest=None):
+        if not self.snapshot_path:
+            return
+        # Record the kernel's own rendering of our chains so drift can be
+        # detected by plain comparison next time.
+        snapshot = {'tables': tables, 'ipsets': ipsets or {}, 'revision': revision, 'digest': digest,
+                    'kernel': self._read_kernel_chains(tables)}
+        self._write_snapshot(snapshot)
@@ -0,0 +1,445 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds between writes of a process's values to the shared directory
+DUMP_INTERVAL = 1.0
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.registry = None
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.label_names)
+
+    def _changed(self):
+        if self.registry is not None:
+            self.registry.changed()
+
+    def reset(self):
+        # Also replaces a lock a forking thread may have held
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def state(self):
+        """
+        This process's values as JSON-ready [key, value] pairs.
+        """
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, states):
+        """
+        Combines the state() of every process into {key: value}.
+        """
+        merged = {}
+        for state in states:
+            for key, value in state:
+                key = tuple(key)
+                merged[key] = self._combine(merged[key], value) if key in merged else value
+        return merged
+
+    def _combine(self, a, b):
+        return a + b
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self._changed()
+
+
+class Gauge(_Metric):
+    """
+    Across processes the most recently set value wins, so a gauge set by
+    whichever worker ran a check or an apply is reported by all of them.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._updated = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+            self._updated[key] = time.time()
+        self._changed()
+
+    def reset(self):
+        super().reset()
+        self._updated = {}
+
+    def state(self):
+        with self._lock:
+            return [[list(key), [value, self._updated.get(key, 0)]] for key, value in self._values.items()]
+
+    def merge(self, states):
+        latest = super().merge(states)
+        return {key: value for key, (value, _) in latest.items()}
+
+    def _combine(self, a, b):
+        return b if b[1] >= a[1] else a
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+        self._changed()
+
+    def state(self):
+        with self._lock:
+            return [[list(key), [list(counts), total, count]]
+                    for key, (counts, total, count) in self._values.items()]
+
+    def _combine(self, a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+
+    def _render_value(self, key, state):
+        counts, total, count = state
+        lines = []
+        for bound, n in zip(self.buckets, counts):
+            le = 'le="' + _format_value(bound) + '"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {n}")
+        lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class Registry:
+    """
+    Minimal Prometheus registry. While `enabled` is False every hook below
+    returns after a single attribute check, so instrumentation costs next
+    to nothing when metrics are off.
+
+    With a `directory`, values are shared between worker processes: each
+    process writes its values to its own file there (at most every
+    DUMP_INTERVAL seconds, from a timer after a change) and render()
+    merges every file, so a scrape reaching any worker reports counters
+    and histograms summed over all of them. Files of exited workers are
+    kept, so counters never go backwards; clear_directory() at server
+    start drops them.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self._metrics = []
+        self._dump_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dumped_at = 0.0
+        self._timer = None
+        self._file = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _add(self, metric):
+        metric.registry = self
+        self._metrics.append(metric)
+        return metric
+
+    def _after_fork(self):
+        # A worker starts from zero; what the parent counted is in the
+        # parent's own file
+        for metric in self._metrics:
+            metric.reset()
+        self._dump_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dumped_at = 0.0
+        self._timer = None
+        self._file = None
+
+    def changed(self):
+        """
+        Called after every update; schedules writing this process's file.
+        """
+        if self.directory is None:
+            return
+        with self._dump_lock:
+            if self._timer is not None:
+                return
+            delay = self._dumped_at + DUMP_INTERVAL - time.monotonic()
+            if delay > 0:
+                self._timer = threading.Timer(delay, self.dump)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self.dump()
+
+    def dump(self):
+        """
+        Writes this process's values to its file in `directory`.
+        """
+        with self._dump_lock:
+            self._timer = None
+            if self.directory is None:
+                return
+            self._dumped_at = time.monotonic()
+            if self._file is None:
+                self._file = f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+        state = {metric.name: metric.state() for metric in self._metrics}
+        path = os.path.join(self.directory, self._file)
+        with self._write_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(path + '.tmp', path)
+
+    def _load_states(self):
+        states = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    states.append(json.load(f))
+            except (OSError, ValueError):
+                # Written by a worker that died mid-write; replaced atomically otherwise
+                continue
+        return states
+
+    def clear_directory(self):
+        if self.directory is None or not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(('.json', '.tmp')):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        if self.directory is None:
+            lines = []
+            for metric in self._metrics:
+                lines.extend(metric.render())
+            return "\n".join(lines) + "\n"
+        self.dump()
+        states = self._load_states()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(metric.merge(state.get(metric.name, ()) for state in states)))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    'fwm_http_request_duration_seconds', 'Request latency per endpoint.', ('endpoint', 'method', 'status'))
+REQUEST_QUERIES = registry.histogram(
+    'fwm_http_request_db_queries', 'Database queries per request.', ('endpoint',), QUERY_COUNT_BUCKETS)
+REQUEST_DB_SECONDS = registry.histogram(
+    'fwm_http_request_db_seconds', 'Time spent in database queries per request.', ('endpoint',))
+GENERATE_SECONDS = registry.histogram(
+    'fwm_ruleset_generate_seconds', 'Ruleset generation time.', ('backend',))
+RULESET_LINES = registry.gauge(
+    'fwm_ruleset_lines', 'Lines per table in the last generated ruleset.', ('backend', 'table'))
+RESTORE_SECONDS = registry.histogram(
+    'fwm_restore_duration_seconds', 'Wall time of ruleset loader runs.', ('command',))
+RESTORE_TOTAL = registry.counter(
+    'fwm_restore_total', 'Ruleset loader runs by exit status.', ('command', 'status'))
+USERS = registry.gauge('fwm_users', 'Number of users.')
+RULES = registry.gauge('fwm_rules', 'Number of rules.')
+LAST_APPLY_TIMESTAMP = registry.gauge(
+    'fwm_last_apply_timestamp_seconds', 'Unix time of the last successful apply.')
+LAST_APPLY_REVISION = registry.gauge(
+    'fwm_last_apply_revision', 'Ruleset revision of the last successful apply.')
+GATEWAY_APPLIED_REVISION = registry.gauge(
+    'fwm_gateway_applied_revision', 'Ruleset revision last applied by each gateway agent.', ('gateway',))
+GATEWAY_APPLY_SECONDS = registry.gauge(
+    'fwm_gateway_apply_seconds', 'Duration of the last apply reported by each gateway agent.', ('gateway',))
+DRIFT_RULES = registry.gauge(
+    'fwm_ruleset_drift_rules', 'Rules missing from or extra in the kernel at the last drift check.',
+    ('backend', 'kind'))
+DRIFT_CHAINS = registry.gauge(
+    'fwm_ruleset_drift_chains', 'Chains differing from the applied ruleset at the last drift check.', ('backend',))
+
+
+@contextmanager
+def _timed(histogram, labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+
+@contextmanager
+def _noop():
+    yield
+
+
+def timer(histogram, **labels):
+    """
+    Context manager observing the elapsed time of its block into `histogram`.
+    """
+    if not registry.enabled:
+        return _noop()
+    return _timed(histogram, labels)
+
+
+def record_ruleset(backend, line_counts):
+    """
+    Records the per-table line counts of a generated ruleset.
+    `line_counts` is only called when metrics are enabled.
+    """
+    if not registry.enabled:
+        return
+    for table, lines in line_counts().items():
+        RULESET_LINES.set(lines, backend=backend, table=table)
+
+
+@contextmanager
+def restore_timer(command):
+    """
+    Times a ruleset loader run and counts it by exit status
+    ('0' or the loader's return code, 'error' for other failures).
+    """
+    if not registry.enabled:
+        yield
+        return
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        yield
+        status = '0'
+    except Exception as e:
+        status = str(getattr(e, 'returncode', 'error'))
+        raise
+    finally:
+        RESTORE_SECONDS.observe(time.perf_counter() - started, command=command)
+        RESTORE_TOTAL.inc(command=command, status=status)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if registry.enabled and has_request_context():
+        conn.info.setdefault('fwm_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not registry.enabled or not has_request_context():
+        return
+    starts = conn.info.get('fwm_query_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    g.fwm_queries = g.get('fwm_queries', 0) + 1
+    g.fwm_query_seconds = g.get('fwm_query_seconds', 0.0) + elapsed
+
+
+def init_app(app, collect=None):
+    """
+    Installs the request and query hooks and the /metrics endpoint.
+    `collect()` is called on each scrape to refresh gauges read from the
+    database. Metrics are enabled by app.config['METRICS_ENABLED'];
+    app.config['METRICS_DIR'] makes worker processes share their values.
+    """
+    registry.enabled = bool(app.config.get('METRICS_ENABLED'))
+    if registry.enabled:
+        registry.directory = app.config.get('METRICS_DIR') or None
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def _start_timer():
+        if registry.enabled:
+            g.fwm_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        started = g.get('fwm_started') if registry.enabled else None
+        if started is not None:
+            endpoint = request.endpoint or 'unknown'
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint,
+                                    method=request.method, status=response.status_code)
+            REQUEST_QUERIES.observe(g.get('fwm_queries', 0), endpoint=endpoint)
+            REQUEST_DB_SECONDS.observe(g.get('fwm_query_seconds', 0.0), endpoint=endpoint)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        if not registry.enabled:
+            return Response("Metrics are disabled\n", status=404, mimetype='text/plain')
+        if collect:
+            collect()
+        return Response(registry.render(), content_type=CONTENT_TYPE)
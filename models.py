@@ -8,6 +8,8 @@ class SystemConfig(db.Model):
     host_ip = db.Column(db.String(45), nullable=False)
     user_network_cidr = db.Column(db.String(45), nullable=False)
     is_configured = db.Column(db.Boolean, default=False)
+    # Bumped on every change so cached copies in other processes reload
+    version = db.Column(db.Integer, nullable=False, default=1)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class User(db.Model):
@@ -20,20 +22,211 @@ class User(db.Model):
     forward_mode = db.Column(db.String(10), default='ROUTE') # ROUTE, NAT
     ip_address = db.Column(db.String(45), unique=True, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bumped whenever the user or their rules change; keys the compiled
+    # per-user fragment in ruleset_cache
+    revision = db.Column(db.Integer, nullable=False, default=1)
+    # Gateway whose agent applies this user's rules; None for the portal host
+    gateway_id = db.Column(db.Integer, db.ForeignKey('gateway.id'), nullable=True, index=True)
+    # Optional access window (UTC); outside it none of the user's rules are
+    # applied. See rule_schedule.py.
+    valid_from = db.Column(db.DateTime, nullable=True, index=True)
+    expires_at = db.Column(db.DateTime, nullable=True, index=True)
     rules = db.relationship('Rule', backref='user', lazy=True, cascade="all, delete-orphan")
 
     def __repr__(self):
         return f'<User {self.username}>'
 
+class Gateway(db.Model):
+    """
+    A VPN gateway whose agent (gateway_agent.py) pulls and applies the
+    rules of the users bound to it. The agent reports what it applied.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True, nullable=False)
+    backend = db.Column(db.String(20), nullable=False, default='iptables')
+    # sha256 of the agent's bearer token; the token itself is never stored
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    applied_revision = db.Column(db.Integer, nullable=True)
+    applied_manifest = db.Column(db.String(64), nullable=True)
+    apply_ms = db.Column(db.Float, nullable=True)
+    apply_mode = db.Column(db.String(20), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    last_seen = db.Column(db.DateTime, nullable=True)
+    reported_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    users = db.relationship('User', backref='gateway', lazy=True)
+
+    def __repr__(self):
+        return f'<Gateway {self.name}>'
+
 class Rule(db.Model):
+    __table_args__ = (
+        # Per-user rule scans in id order (compiling, streaming, listings)
+        db.Index('ix_rule_user_id_id', 'user_id', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    destination_ip = db.Column(db.String(45), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    destination_ip = db.Column(db.String(45), nullable=False, index=True)
     destination_port = db.Column(db.Integer, nullable=True)
-    protocol = db.Column(db.String(10), nullable=False, default='tcp') # tcp, udp, all
-    action = db.Column(db.String(10), nullable=False, default='ACCEPT') # ACCEPT, DROP
+    protocol = db.Column(db.String(10), nullable=False, default='tcp', index=True) # tcp, udp, all
+    action = db.Column(db.String(10), nullable=False, default='ACCEPT', index=True) # ACCEPT, DROP
     # forward_type removed as it is now per-user
+    # Optional window (UTC) in which the rule is applied
+    valid_from = db.Column(db.DateTime, nullable=True, index=True)
+    expires_at = db.Column(db.DateTime, nullable=True, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __repr__(self):
         return f'<Rule {self.id} for User {self.user_id}>'
+
+class RulesetRevision(db.Model):
+    """
+    Single-row counter bumped by every write that changes the ruleset.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    revision = db.Column(db.Integer, nullable=False, default=0)
+
+class ApplyJob(db.Model):
+    """
+    A request to apply the ruleset to the kernel, processed by the
+    background apply worker (see apply_queue.py).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(10), nullable=False, default='queued', index=True) # queued, running, done, failed
+    requested_revision = db.Column(db.Integer)
+    applied_revision = db.Column(db.Integer)
+    mode = db.Column(db.String(20)) # full, incremental, noop, stream
+    added = db.Column(db.Integer)
+    removed = db.Column(db.Integer)
+    error = db.Column(db.Text)
+    requested_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    duration = db.Column(db.Float)
+
+class SnapshotObject(db.Model):
+    """
+    Content-addressed, zlib-compressed blob of the ruleset history: a
+    fragment of an applied ruleset, an ipset listing or a snapshot manifest.
+    Shared by every snapshot that contains the same bytes.
+    """
+    digest = db.Column(db.String(64), primary_key=True) # sha256 of the uncompressed data
+    data = db.Column(db.LargeBinary, nullable=False)
+
+class RulesetSnapshot(db.Model):
+    """
+    A ruleset as successfully applied to the kernel (see ruleset_history.py).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    revision = db.Column(db.Integer)
+    backend = db.Column(db.String(20), nullable=False, index=True)
+    manifest = db.Column(db.String(64), nullable=False) # SnapshotObject digest
+    lines = db.Column(db.Integer, nullable=False)
+    size = db.Column(db.Integer, nullable=False) # uncompressed bytes
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class RuleCounter(db.Model):
+    """
+    Last kernel packet/byte counter read for a rule, kept to compute the
+    delta at the next collection (see traffic.py).
+    """
+    rule_id = db.Column(db.Integer, primary_key=True)
+    packets = db.Column(db.BigInteger, nullable=False, default=0)
+    bytes = db.Column(db.BigInteger, nullable=False, default=0)
+
+class TrafficSample(db.Model):
+    """
+    Traffic of one rule during one time bucket. Rows are only written for
+    buckets that saw traffic; minute buckets are rolled up into hourly ones
+    as they age.
+    """
+    __table_args__ = (
+        db.Index('ix_traffic_sample_user', 'resolution', 'user_id', 'bucket'),
+        db.Index('ix_traffic_sample_rule', 'resolution', 'rule_id', 'bucket'),
+        db.Index('ix_traffic_sample_bucket', 'resolution', 'bucket'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.Integer, nullable=False) # bucket width in seconds
+    bucket = db.Column(db.Integer, nullable=False) # bucket start, Unix time
+    user_id = db.Column(db.Integer, nullable=False)
+    rule_id = db.Column(db.Integer, nullable=False)
+    packets = db.Column(db.BigInteger, nullable=False, default=0)
+    bytes = db.Column(db.BigInteger, nullable=False, default=0)
+
+class TrafficCollectorState(db.Model):
+    """
+    Single row recording the last collection, so only one process collects
+    per interval.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    last_run = db.Column(db.Integer, nullable=False, default=0)
+
+class ScheduleState(db.Model):
+    """
+    Single row recording up to when rule and user window transitions have
+    been processed, so only one process handles each transition.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    processed_until = db.Column(db.DateTime, nullable=False)
+    purged_at = db.Column(db.DateTime, nullable=True)
+
+class AuditEntry(db.Model):
+    """
+    One change or apply, appended by audit.AuditLog and never updated.
+    `data` is compact JSON: {field: [before, after]} for the fields a
+    change touched, or the details of an apply. No foreign keys, so
+    entries outlive the users and rules they describe.
+    """
+    __table_args__ = (
+        db.Index('ix_audit_entry_user', 'user_id', 'timestamp'),
+        db.Index('ix_audit_entry_revision', 'revision'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.Integer, nullable=False) # Unix time
+    action = db.Column(db.String(20), nullable=False) # e.g. user.edit, rule.add, apply
+    user_id = db.Column(db.Integer, nullable=True)
+    rule_id = db.Column(db.Integer, nullable=True)
+    revision = db.Column(db.Integer, nullable=True) # ruleset revision the change created
+    actor = db.Column(db.String(64), nullable=True)
+    data = db.Column(db.Text, nullable=True)
+
+class AuditPartition(db.Model):
+    """
+    First AuditEntry id of a calendar month. Entries are appended in time
+    order, so a month is an id range and retention deletes whole ranges
+    by primary key.
+    """
+    period = db.Column(db.Integer, primary_key=True, autoincrement=False) # YYYYMM, UTC
+    first_id = db.Column(db.Integer, nullable=False)
+
+class SchemaMigration(db.Model):
+    """
+    A migration from db_migration.py that has been applied.
+    """
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(120), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class MigrationCheckpoint(db.Model):
+    """
+    Last primary key copied by an interrupted batched data copy, so a
+    rerun of the migration resumes after it.
+    """
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    last_id = db.Column(db.BigInteger, nullable=False)
+
+class IpPool(db.Model):
+    """
+    Marks which network the free-range table below was built for.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    network_cidr = db.Column(db.String(45), nullable=False)
+    built_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class IpFreeRange(db.Model):
+    """
+    An inclusive interval of unallocated IPv4 addresses, stored as integers.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    start = db.Column(db.BigInteger, nullable=False, unique=True, index=True)
+    end = db.Column(db.BigInteger, nullable=False, unique=True, index=True)
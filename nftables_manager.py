@@ -0,0 +1,282 @@
+import hashlib
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import subprocess
+
+from firewall_backend import FirewallBackend, RULE_COMMENT_PREFIX, pipe_lines, rule_comment
+from ruleset_optimizer import optimize_ruleset
+import drift
+
+logger = logging.getLogger(__name__)
+
+# Everything lives in one table of our own, replaced atomically on apply;
+# other tables (including iptables-nft's) are left alone
+TABLE = "ip firewall_manager"
+# Source address -> jump to the user's chain, one hash lookup per packet
+FORWARD_MAP = "fwd_users"
+NAT_MAP = "nat_users"
+USER_CHAIN_PREFIX = "user_"
+NAT_USER_CHAIN_PREFIX = "nat_user_"
+# INPUT ports always allowed: SSH and the portal (5000 plus standard web ports)
+SYSTEM_PORTS = (22, 80, 443, 5000)
+
+VERDICTS = {'ACCEPT': 'accept', 'DROP': 'drop'}
+
+
+def parse_rule_counters(output):
+    """
+    Returns {rule_id: (packets, bytes)} from `nft -j list table` output,
+    for rules with both a counter and one of our comments.
+    """
+    counters = {}
+    for item in json.loads(output).get('nftables', []):
+        rule = item.get('rule')
+        if not rule or not str(rule.get('comment', '')).startswith(RULE_COMMENT_PREFIX):
+            continue
+        counter = next((expr['counter'] for expr in rule.get('expr', [])
+                        if isinstance(expr, dict) and 'counter' in expr), None)
+        if counter is None:
+            continue
+        rule_id = int(rule['comment'][len(RULE_COMMENT_PREFIX):])
+        old_packets, old_bytes = counters.get(rule_id, (0, 0))
+        counters[rule_id] = (old_packets + counter['packets'], old_bytes + counter['bytes'])
+    return counters
+
+
+def _destination_elements(destinations):
+    """
+    Collapses destination addresses/CIDRs into non-overlapping set elements
+    (interval sets reject overlapping elements). Unparsable values are passed
+    through for nft to report.
+    """
+    try:
+        networks = [ipaddress.ip_network(d, strict=False) for d in destinations]
+        collapsed = ipaddress.collapse_addresses(networks)
+    except (ValueError, TypeError):
+        return list(dict.fromkeys(destinations))
+    return [str(n.network_address) if n.prefixlen == n.max_prefixlen else str(n) for n in collapsed]
+
+
+class NftablesManager(FirewallBackend):
+    """
+    Generates and applies the ruleset as a single `nft -f` transaction.
+
+    Each user's rules go into their own chain, reached from the forward (or
+    NAT postrouting) chain through a verdict map keyed by source address.
+    Consecutive rules of a user with the same verdict are folded into one
+    rule matching a named set of destinations, or of destination . port
+    concatenations for TCP/UDP rules with ports, so matching is a hash or
+    interval lookup in the kernel while first-match order is preserved.
+
+    The dispatch setting does not apply: the verdict map already gives
+    constant-time dispatch.
+    """
+    name = 'nftables'
+
+    def generate_nft_content(self, users):
+        return "\n".join(self.iter_lines(users)) + "\n"
+
+    def iter_lines(self, users):
+        """
+        Yields the `nft -f` script lines. `users` is iterated once.
+        """
+        # Adding first makes the delete valid on the very first apply
+        yield f"add table {TABLE}"
+        yield f"delete table {TABLE}"
+        yield f"add table {TABLE}"
+        yield f"add map {TABLE} {FORWARD_MAP} {{ type ipv4_addr : verdict ; }}"
+        yield f"add map {TABLE} {NAT_MAP} {{ type ipv4_addr : verdict ; }}"
+
+        # System Access Rules (INPUT)
+        yield f"add chain {TABLE} input {{ type filter hook input priority 0 ; policy accept ; }}"
+        yield f"add rule {TABLE} input iifname \"lo\" accept"
+        yield f"add rule {TABLE} input ct state established,related accept"
+        ports = ", ".join(str(p) for p in SYSTEM_PORTS)
+        yield f"add rule {TABLE} input tcp dport {{ {ports} }} accept"
+
+        yield f"add chain {TABLE} forward {{ type filter hook forward priority 0 ; policy accept ; }}"
+        yield f"add rule {TABLE} forward ip saddr vmap @{FORWARD_MAP}"
+        yield f"add chain {TABLE} postrouting {{ type nat hook postrouting priority 100 ; policy accept ; }}"
+        yield f"add rule {TABLE} postrouting ip saddr vmap @{NAT_MAP}"
+
+        for user in users:
+            if not user.rules:
+                continue
+            if user.forward_mode == 'NAT':
+                chain, dispatch_map = f"{NAT_USER_CHAIN_PREFIX}{user.id}", NAT_MAP
+                verdict_of = lambda rule: 'masquerade'
+            else:
+                chain, dispatch_map = f"{USER_CHAIN_PREFIX}{user.id}", FORWARD_MAP
+                verdict_of = lambda rule: VERDICTS.get(rule.action, rule.action.lower())
+            yield f"add chain {TABLE} {chain}"
+            yield from self._user_rule_lines(chain, user.rules, verdict_of)
+            yield f"add element {TABLE} {dispatch_map} {{ {user.ip_address} : jump {chain} }}"
+
+    @staticmethod
+    def _user_rule_lines(chain, rules, verdict_of):
+        set_index = 0
+        # Within a run of equal verdicts rule order does not matter, so the
+        # run can be matched as a union
+        for verdict, run in itertools.groupby(rules, key=verdict_of):
+            buckets = {}
+            comments = {}
+            for rule in run:
+                protocol = rule.protocol
+                ports = getattr(rule, 'ports', None) or (
+                    [rule.destination_port] if rule.destination_port else [])
+                bucket_key = (protocol, bool(protocol in ('tcp', 'udp') and ports))
+                comments.setdefault(bucket_key, rule_comment(rule))
+                if bucket_key[1]:
+                    bucket = buckets.setdefault(bucket_key, {})
+                    for port in ports:
+                        bucket.setdefault(int(port), []).append(rule.destination_ip)
+                else:
+                    buckets.setdefault(bucket_key, {}).setdefault(None, []).append(rule.destination_ip)
+
+            for (protocol, with_ports), by_port in buckets.items():
+                # Counted and tagged with the first rule of the bucket
+                comment = comments[(protocol, with_ports)]
+                action = f"counter {verdict}" + (f" comment \"{comment}\"" if comment else "")
+                elements = []
+                for port, destinations in sorted(by_port.items(), key=lambda item: item[0] or 0):
+                    for destination in _destination_elements(destinations):
+                        elements.append((destination, port))
+
+                if len(elements) == 1:
+                    destination, port = elements[0]
+                    if with_ports:
+                        match = f"ip daddr {destination} {protocol} dport {port}"
+                    elif protocol != 'all':
+                        match = f"ip protocol {protocol} ip daddr {destination}"
+                    else:
+                        match = f"ip daddr {destination}"
+                    yield f"add rule {TABLE} {chain} {match} {action}"
+                    continue
+
+                name = f"{chain}_{set_index}"
+                set_index += 1
+                if with_ports:
+                    set_type, key = "ipv4_addr . inet_service", f"ip daddr . {protocol} dport"
+                    members = ", ".join(f"{d} . {p}" for d, p in elements)
+                else:
+                    set_type, key = "ipv4_addr", "ip daddr"
+                    if protocol != 'all':
+                        key = f"ip protocol {protocol} {key}"
+                    members = ", ".join(d for d, _ in elements)
+                yield f"add set {TABLE} {name} {{ type {set_type} ; flags interval ; }}"
+                yield f"add element {TABLE} {name} {{ {members} }}"
+                yield f"add rule {TABLE} {chain} {key} @{name} {action}"
+
+    def table_line_counts(self, content):
+        return {TABLE.split()[1]: content.count("\n")}
+
+    def build_ruleset(self, users):
+        """
+        Returns (content, ipsets, stats) like IptablesManager.build_ruleset.
+        Source sets are never needed (the verdict map makes the source
+        implicit), so ipsets is always empty.
+        """
+        if not self.optimize:
+            return self.generate_nft_content(users), {}, None
+        optimized = optimize_ruleset(users, collapse_sources=False)
+        return self.generate_nft_content(optimized.users), {}, optimized.stats
+
+    def apply_compiled(self, content, ipsets=None, incremental=False, revision=None):
+        """
+        Loads `content` with `nft -f`. The script replaces our table in one
+        kernel transaction, so there is no separate incremental mode: with
+        incremental=True the load is only skipped (mode 'noop') when the
+        script is identical to the last applied one and the kernel still
+        holds the table as it was left.
+        """
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        rules = sum(1 for line in content.splitlines() if line.startswith("add rule "))
+        previous = self._load_snapshot()
+
+        if incremental and previous and previous.get('digest') == digest and self._kernel_matches(previous):
+            logger.info("Ruleset unchanged, nothing to apply")
+            if previous.get('revision') != revision or 'content' not in previous:
+                self._save_snapshot(digest, rules, revision, content)
+            return {'mode': 'noop', 'added': 0, 'removed': 0}
+
+        self._restore(content)
+        self._save_snapshot(digest, rules, revision, content)
+        return {'mode': 'full', 'added': rules, 'removed': previous.get('rules', 0) if previous else 0}
+
+    def apply_rules_stream(self, users):
+        """
+        Streams the generated script into nft. No snapshot is kept, so the
+        next incremental apply always loads.
+        """
+        self._restore_lines(self.iter_lines(users))
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            os.remove(self.snapshot_path)
+        return {'mode': 'stream', 'added': None, 'removed': 0}
+
+    def _restore(self, content):
+        self._restore_lines(content.splitlines())
+
+    def _restore_lines(self, lines):
+        pipe_lines(["nft", "-f", "-"], lines)
+
+    def read_rule_counters(self):
+        try:
+            proc = subprocess.run(["nft", "-j", "list", "table"] + TABLE.split(), check=True,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return parse_rule_counters(proc.stdout.decode())
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError) as e:
+            logger.warning(f"Could not read rule counters: {e}")
+            return None
+
+    def _read_kernel_table(self):
+        """
+        Returns the kernel's listing of our table, or None if it cannot be read.
+        Stateless (-s), so rule counters do not make it differ.
+        """
+        try:
+            proc = subprocess.run(["nft", "-s", "list", "table"] + TABLE.split(), check=True,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Could not read nftables table {TABLE}: {e}")
+            return None
+        return proc.stdout.decode()
+
+    def check_drift(self):
+        """
+        Compares the kernel's listing of our table with the one recorded
+        after the last apply, chain by chain.
+        """
+        snapshot = self._load_snapshot()
+        if not snapshot or snapshot.get('kernel') is None:
+            return None
+        listing = self._read_kernel_table()
+        if listing is None:
+            return None
+        return drift.compare_listings(snapshot['kernel'], listing, TABLE)
+
+    def repair_drift(self, report):
+        """
+        Reloads the last applied script. It replaces the whole table in one
+        transaction, so the drifted chains cannot be reloaded on their own.
+        """
+        snapshot = self._load_snapshot()
+        if not snapshot or not snapshot.get('content') or not report or not report.chains:
+            return 0
+        self._restore(snapshot['content'])
+        self._save_snapshot(snapshot['digest'], snapshot['rules'], snapshot.get('revision'), snapshot['content'])
+        self._keep_applied_users(snapshot)
+        return len(report.chains)
+
+    def _kernel_matches(self, snapshot):
+        kernel = snapshot.get('kernel')
+        return kernel is not None and self._read_kernel_table() == kernel
+
+    def _save_snapshot(self, digest, rules, revision=None, content=None):
+        if not self.snapshot_path:
+            return
+        # The script is kept for drift repair
+        self._write_snapshot({'digest': digest, 'rules': rules, 'revision': revision,
+                              'content': content, 'kernel': self._read_kernel_table()})
@@ -0,0 +1,88 @@
+import base64
+import json
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the list encoded by encode_cursor, or None for a missing or
+    malformed cursor (which simply restarts at the first page).
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except ValueError:
+        return None
+    return values if isinstance(values, list) and len(values) == 2 else None
+
+
+def page_size(value):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+class Page:
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def keyset_page(query, sort_col, id_col, after=None, before=None, descending=False,
+                limit=DEFAULT_PAGE_SIZE, key=None):
+    """
+    Fetches one page of `query` ordered by (sort_col, id_col) using keyset
+    pagination: the cursor holds the sort key of the last (or first) row
+    seen, so every page costs one index range scan however deep it is.
+
+    `key(row)` must return [sort_value, id] for a result row.
+    Returns a Page whose cursors are None at either end of the listing.
+    """
+    key = key or (lambda row: [getattr(row, sort_col.key), getattr(row, id_col.key)])
+    after, before = decode_cursor(after), decode_cursor(before)
+    backwards = before is not None and after is None
+
+    def greater(cursor):
+        value, row_id = cursor
+        return (sort_col > value) | ((sort_col == value) & (id_col > row_id))
+
+    def smaller(cursor):
+        value, row_id = cursor
+        return (sort_col < value) | ((sort_col == value) & (id_col < row_id))
+
+    forward_after = greater if not descending else smaller
+    forward_before = smaller if not descending else greater
+    ascending = descending == backwards
+
+    if after is not None:
+        query = query.filter(forward_after(after))
+    elif backwards:
+        query = query.filter(forward_before(before))
+
+    order = [sort_col.asc(), id_col.asc()] if ascending else [sort_col.desc(), id_col.desc()]
+    rows = query.order_by(*order).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    if not rows:
+        return Page([], None, None)
+    if backwards:
+        next_cursor = encode_cursor(key(rows[-1]))
+        prev_cursor = encode_cursor(key(rows[0])) if has_more else None
+    else:
+        next_cursor = encode_cursor(key(rows[-1])) if has_more else None
+        prev_cursor = encode_cursor(key(rows[0])) if after is not None else None
+    return Page(rows, next_cursor, prev_cursor)
@@ -0,0 +1,115 @@
+import hashlib
+import json
+from datetime import datetime
+
+from models import db, User, Rule
+from pagination import keyset_page, page_size, decode_cursor
+
+NDJSON = 'application/x-ndjson'
+
+# Rows fetched per round trip when streaming a collection as NDJSON
+STREAM_BATCH = 1000
+
+USER_FIELDS = ('id', 'username', 'full_name', 'email', 'contact', 'user_type', 'forward_mode',
+               'ip_address', 'gateway_id', 'valid_from', 'expires_at', 'created_at')
+RULE_FIELDS = ('id', 'user_id', 'destination_ip', 'destination_port', 'protocol', 'action',
+               'valid_from', 'expires_at')
+
+COLLECTIONS = {
+    'users': (User, USER_FIELDS),
+    'rules': (Rule, RULE_FIELDS),
+}
+
+
+class ApiError(ValueError):
+    pass
+
+
+def select_fields(name, requested):
+    """
+    Parses `?fields=a,b` against the fields of collection `name`. `id` is
+    always included (it is the pagination key). Raises ApiError for
+    unknown fields.
+    """
+    available = COLLECTIONS[name][1]
+    if not requested:
+        return available
+    fields = [f.strip() for f in requested.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        raise ApiError(f"Unknown fields: {', '.join(unknown)}")
+    return ('id',) + tuple(dict.fromkeys(f for f in fields if f != 'id'))
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def serialize(fields, row):
+    return {field: _value(value) for field, value in zip(fields, row)}
+
+
+def etag(scope, version, request, *settings):
+    """
+    Strong ETag for a response built from data at `version`: the same
+    version, path, query, format and `settings` always produce the same
+    bytes.
+    """
+    args = sorted(request.args.items(multi=True))
+    key = [request.path, args, wants_ndjson(request), list(settings)]
+    digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+    return f"{scope}{version}-{digest[:16]}"
+
+
+def not_modified(request, tag):
+    return request.if_none_match.contains_weak(tag)
+
+
+def wants_ndjson(request):
+    if request.args.get('format'):
+        return request.args.get('format') == 'ndjson'
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+def collection_query(name, fields, filters):
+    model = COLLECTIONS[name][0]
+    query = db.session.query(*[getattr(model, f) for f in fields])
+    if name == 'rules' and filters.get('user_id'):
+        query = query.filter(Rule.user_id == filters.get('user_id', type=int))
+    if name == 'users' and filters.get('gateway_id'):
+        query = query.filter(User.gateway_id == filters.get('gateway_id', type=int))
+    return query
+
+
+def collection_page(name, fields, args):
+    """
+    One page of a collection in id order: {"items", "next"}. `next` is the
+    cursor for ?after= (None on the last page). Only the selected columns
+    are read.
+    """
+    model = COLLECTIONS[name][0]
+    query = collection_query(name, fields, args)
+    page = keyset_page(query, model.id, model.id, after=args.get('after'),
+                       limit=page_size(args.get('limit')), key=lambda row: [row.id, row.id])
+    return {'items': [serialize(fields, row) for row in page.items], 'next': page.next_cursor}
+
+
+def collection_lines(name, fields, args, batch_size=STREAM_BATCH):
+    """
+    Yields every row of a collection (after the optional ?after= cursor)
+    as JSON lines, read through a streaming cursor.
+    """
+    model = COLLECTIONS[name][0]
+    query = collection_query(name, fields, args)
+    cursor = decode_cursor(args.get('after'))
+    if cursor is not None:
+        query = query.filter(model.id > cursor[1])
+    rows = query.order_by(model.id).execution_options(stream_results=True, yield_per=batch_size)
+    for row in rows:
+        yield json.dumps(serialize(fields, row)) + "\n"
+
+
+def item(name, item_id, fields):
+    model = COLLECTIONS[name][0]
+    row = db.session.query(*[getattr(model, f) for f in fields]).filter(model.id == item_id).first()
+    return serialize(fields, row) if row is not None else None
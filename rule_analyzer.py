@@ -0,0 +1,232 @@
+import ipaddress
+from collections import namedtuple
+
+# kind: 'duplicate' (same destination, protocol, ports and verdict as an
+# earlier rule), 'redundant' (never matches, an earlier rule with the same
+# verdict already does the same), 'shadowed' (never matches, an earlier rule
+# with another verdict takes all its traffic) or 'conflict' (partly overlaps
+# an earlier rule with another verdict, so rule order decides)
+Finding = namedtuple('Finding', 'kind rule_id other_id message')
+
+ANY = None
+
+
+def _rule_id(rule):
+    rule_ids = getattr(rule, 'rule_ids', None)
+    return rule_ids[0] if rule_ids else getattr(rule, 'id', None)
+
+
+def _ports(rule):
+    """
+    Destination ports a rule matches, ANY for every port.
+    """
+    if rule.protocol == 'all':
+        return ANY
+    ports = getattr(rule, 'ports', None) or ([rule.destination_port] if rule.destination_port else [])
+    return frozenset(int(p) for p in ports) or ANY
+
+
+def describe(rule):
+    ports = _ports(rule)
+    service = rule.protocol if ports is ANY else f"{rule.protocol}/{','.join(str(p) for p in sorted(ports))}"
+    return f"{rule.action} {rule.destination_ip} {service}"
+
+
+class _Entry:
+    __slots__ = ('index', 'rule_id', 'protocol', 'ports', 'verdict', 'rule')
+
+    def __init__(self, index, rule, verdict):
+        self.index = index
+        self.rule_id = _rule_id(rule)
+        self.protocol = rule.protocol
+        self.ports = _ports(rule)
+        self.verdict = verdict
+        self.rule = rule
+
+    def covers(self, other):
+        if self.protocol != 'all' and self.protocol != other.protocol:
+            return False
+        return self.ports is ANY or (other.ports is not ANY and other.ports <= self.ports)
+
+    def overlaps(self, other):
+        if self.protocol != 'all' and other.protocol != 'all' and self.protocol != other.protocol:
+            return False
+        return self.ports is ANY or other.ports is ANY or bool(self.ports & other.ports)
+
+
+class _Node:
+    """
+    Prefix trie node. `entries` are the rules for exactly this prefix;
+    `ports` indexes them by (protocol, port) for cover lookups (port ANY
+    for any port) and `verdicts` counts the verdicts of every rule in the
+    subtree, so overlap searches skip subtrees with nothing to conflict with.
+    """
+    __slots__ = ('children', 'entries', 'ports', 'verdicts')
+
+    def __init__(self):
+        self.children = [None, None]
+        self.entries = []
+        self.ports = {}
+        self.verdicts = {}
+
+
+class RuleIndex:
+    """
+    One user's rules in first-match order, indexed for checking a further
+    rule against all of them: a binary trie over destination prefixes (one
+    per IP version) with per-node port indexes.
+
+    check() walks the new rule's prefix (at most 32 or 128 nodes) for
+    covering and overlapping earlier rules, then the subtree below it for
+    more specific ones, pruned by verdict counts. Rules that never match
+    are not added, since they can neither shadow nor conflict.
+    """
+    def __init__(self, nat=False):
+        # Every NAT rule masquerades, so verdicts never differ
+        self.nat = nat
+        self._roots = {4: _Node(), 6: _Node()}
+        # Destinations that are not addresses or networks: exact matches only
+        self._other = {}
+        self._count = 0
+
+    def _verdict(self, rule):
+        return 'MASQUERADE' if self.nat else rule.action
+
+    def _path(self, network):
+        """
+        Yields the trie nodes from the root down to `network`'s prefix,
+        creating them as needed.
+        """
+        node = self._roots[network.version]
+        yield node
+        address = int(network.network_address)
+        width = network.max_prefixlen
+        for bit in range(network.prefixlen):
+            side = (address >> (width - 1 - bit)) & 1
+            if node.children[side] is None:
+                node.children[side] = _Node()
+            node = node.children[side]
+            yield node
+
+    def check(self, rule):
+        """
+        Returns the Finding for `rule` if it were added after the indexed
+        rules, or None.
+        """
+        entry = _Entry(self._count, rule, self._verdict(rule))
+        try:
+            network = ipaddress.ip_network(rule.destination_ip, strict=False)
+        except (ValueError, TypeError):
+            return self._check_other(entry)
+
+        cover = conflict = None
+        path = list(self._path(network))
+        for node in path:
+            for key in self._cover_keys(entry):
+                earlier = node.ports.get(key)
+                if earlier is not None and earlier.covers(entry) and (cover is None or earlier.index < cover.index):
+                    cover = earlier
+            if cover is None and any(v != entry.verdict for v in node.verdicts):
+                for earlier in node.entries:
+                    if earlier.verdict != entry.verdict and earlier.overlaps(entry):
+                        if conflict is None or earlier.index < conflict.index:
+                            conflict = earlier
+                        break
+        # The first match decides, so the earliest covering rule is the one
+        # reported. Several earlier rules covering it together are not
+        # detected.
+        if cover is not None:
+            return self._covered(entry, cover)
+        for earlier in self._subtree_conflicts(path[-1], entry):
+            if conflict is None or earlier.index < conflict.index:
+                conflict = earlier
+            break
+        if conflict is not None:
+            return Finding('conflict', entry.rule_id, conflict.rule_id,
+                           f"partly overlaps earlier rule #{conflict.rule_id} ({describe(conflict.rule)}); "
+                           f"that rule wins where they overlap")
+        return None
+
+    @staticmethod
+    def _cover_keys(entry):
+        if entry.protocol == 'all':
+            return [('all', ANY)]
+        keys = [('all', ANY), (entry.protocol, ANY)]
+        if entry.ports is not ANY and len(entry.ports) == 1:
+            keys.append((entry.protocol, next(iter(entry.ports))))
+        return keys
+
+    @staticmethod
+    def _covered(entry, earlier):
+        if earlier.verdict == entry.verdict:
+            same = (earlier.protocol, earlier.ports) == (entry.protocol, entry.ports) \
+                and earlier.rule.destination_ip == entry.rule.destination_ip
+            if same:
+                return Finding('duplicate', entry.rule_id, earlier.rule_id,
+                               f"duplicates earlier rule #{earlier.rule_id} ({describe(earlier.rule)})")
+            return Finding('redundant', entry.rule_id, earlier.rule_id,
+                           f"is already covered by earlier rule #{earlier.rule_id} ({describe(earlier.rule)})")
+        return Finding('shadowed', entry.rule_id, earlier.rule_id,
+                       f"never matches: earlier rule #{earlier.rule_id} ({describe(earlier.rule)}) "
+                       f"takes all of its traffic")
+
+    @staticmethod
+    def _subtree_conflicts(node, entry):
+        """
+        Yields earlier rules strictly below `node` overlapping `entry` with
+        another verdict.
+        """
+        stack = [child for child in node.children if child is not None]
+        while stack:
+            node = stack.pop()
+            if not any(v != entry.verdict for v in node.verdicts):
+                continue
+            for earlier in node.entries:
+                if earlier.verdict != entry.verdict and earlier.overlaps(entry):
+                    yield earlier
+            stack.extend(child for child in node.children if child is not None)
+
+    def _check_other(self, entry):
+        for earlier in self._other.get(entry.rule.destination_ip, ()):
+            if earlier.covers(entry):
+                return self._covered(entry, earlier)
+        return None
+
+    def add(self, rule):
+        """
+        Appends `rule`. Returns its Finding, or None.
+        """
+        finding = self.check(rule)
+        entry = _Entry(self._count, rule, self._verdict(rule))
+        self._count += 1
+        if finding is not None and finding.kind != 'conflict':
+            return finding
+        try:
+            network = ipaddress.ip_network(rule.destination_ip, strict=False)
+        except (ValueError, TypeError):
+            self._other.setdefault(rule.destination_ip, []).append(entry)
+            return finding
+        for node in self._path(network):
+            node.verdicts[entry.verdict] = node.verdicts.get(entry.verdict, 0) + 1
+        node.entries.append(entry)
+        if entry.protocol == 'all':
+            node.ports.setdefault(('all', ANY), entry)
+        elif entry.ports is ANY:
+            node.ports.setdefault((entry.protocol, ANY), entry)
+        else:
+            for port in entry.ports:
+                node.ports.setdefault((entry.protocol, port), entry)
+        return finding
+
+
+def analyze_rules(rules, nat=False):
+    """
+    Returns the Findings for one user's rules, given in first-match order.
+    """
+    index = RuleIndex(nat=nat)
+    findings = []
+    for rule in rules:
+        finding = index.add(rule)
+        if finding is not None:
+            findings.append(finding)
+    return findings
@@ -0,0 +1,288 @@
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, or_
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Rule, ScheduleState
+from ruleset_cache import bump_revision, bump_user_revisions
+import audit
+import ip_pool
+
+logger = logging.getLogger(__name__)
+
+# Window boundaries loaded into the scheduler's heap at a time
+HEAP_SIZE = 1000
+
+# Longest the scheduler sleeps without a boundary; picks up windows
+# written by other processes
+MAX_SLEEP = 3600
+
+# Expired rules and users are kept this long (for reference on the rules
+# pages), then purged
+PURGE_AFTER = timedelta(days=7)
+PURGE_INTERVAL = timedelta(hours=1)
+
+# Rows per DELETE ... IN (...), below SQLite's bound parameter limit
+BATCH_SIZE = 500
+
+BOUNDARY_COLUMNS = (Rule.valid_from, Rule.expires_at, User.valid_from, User.expires_at)
+
+
+def active_filter(model, now):
+    """
+    SQL condition equivalent to ruleset_cache.is_active() for `model`
+    (Rule or User).
+    """
+    return and_(or_(model.valid_from.is_(None), model.valid_from <= now),
+                or_(model.expires_at.is_(None), model.expires_at > now))
+
+
+def parse_window(valid_from, expires_at):
+    """
+    Parses the optional window of a form ("YYYY-MM-DDTHH:MM", UTC).
+    Returns (valid_from, expires_at); raises ValueError if a value is
+    malformed or the window is empty.
+    """
+    start = datetime.fromisoformat(valid_from) if valid_from else None
+    end = datetime.fromisoformat(expires_at) if expires_at else None
+    if start is not None and end is not None and end <= start:
+        raise ValueError("the window must end after it starts")
+    return start, end
+
+
+def upcoming(after, limit=HEAP_SIZE):
+    """
+    The earliest `limit` distinct window boundaries later than `after`,
+    ascending. One index range scan per boundary column.
+    """
+    times = set()
+    for column in BOUNDARY_COLUMNS:
+        times.update(t for (t,) in db.session.query(column).filter(column > after)
+                     .distinct().order_by(column).limit(limit))
+    return sorted(times)[:limit]
+
+
+def affected_users(start, end):
+    """
+    Ids of users whose own window or one of whose rules' windows has a
+    boundary in (start, end].
+    """
+    user_ids = set()
+    for column in (Rule.valid_from, Rule.expires_at):
+        user_ids.update(uid for (uid,) in db.session.query(Rule.user_id)
+                        .filter(column > start, column <= end).distinct())
+    for column in (User.valid_from, User.expires_at):
+        user_ids.update(uid for (uid,) in db.session.query(User.id).filter(column > start, column <= end))
+    return user_ids
+
+
+def _state(now):
+    state = db.session.get(ScheduleState, 1)
+    if state is not None:
+        return state
+    try:
+        with db.session.begin_nested():
+            # Every window was compiled against the clock when it was
+            # written, so nothing before now is pending
+            db.session.add(ScheduleState(id=1, processed_until=now))
+    except IntegrityError:
+        pass
+    return db.session.get(ScheduleState, 1)
+
+
+def process_due(now=None):
+    """
+    Handles the window boundaries passed since the last run: every
+    affected user's revision is bumped, so only their compiled fragments
+    are rebuilt (with rules that started, without rules that ended) and
+    the next apply restores only their lines. Claims the interval with a
+    conditional update, so concurrent processes never handle it twice.
+    Commits. Returns the affected user ids.
+    """
+    now = now or datetime.utcnow()
+    previous = _state(now).processed_until
+    if previous >= now:
+        db.session.commit()
+        return set()
+    claimed = db.session.query(ScheduleState) \
+        .filter(ScheduleState.id == 1, ScheduleState.processed_until == previous) \
+        .update({ScheduleState.processed_until: now}, synchronize_session=False)
+    if not claimed:
+        db.session.rollback()
+        return set()
+    user_ids = affected_users(previous, now)
+    if user_ids:
+        revision = bump_revision()
+        bump_user_revisions(user_ids, revision)
+        logger.info(f"Window boundaries reached for {len(user_ids)} users")
+    db.session.commit()
+    return user_ids
+
+
+def _delete_batched(model, ids):
+    ids = list(ids)
+    for i in range(0, len(ids), BATCH_SIZE):
+        db.session.execute(delete(model).where(model.id.in_(ids[i:i + BATCH_SIZE])))
+
+
+def _deleted_entries(model, ids, fields):
+    """
+    audit.AuditLog.record_many() entries for the rows of `model` about to
+    be deleted, read in batches.
+    """
+    columns = [model.id] + [getattr(model, field) for field in fields]
+    entries = []
+    for i in range(0, len(ids), BATCH_SIZE):
+        for row in db.session.query(*columns).filter(model.id.in_(ids[i:i + BATCH_SIZE])).order_by(model.id):
+            entries.append({'user_id': row.user_id if model is Rule else row.id,
+                            'rule_id': row.id if model is Rule else None,
+                            'changes': audit.diff(audit.values(row, fields), {})})
+    return entries
+
+
+def purge_expired(config, now=None, keep=PURGE_AFTER, audit_log=None):
+    """
+    Deletes rules and users that expired more than `keep` ago, in batched
+    DELETE statements, and returns purged users' addresses to the pool in
+    the same transaction. Their rules are already absent from the applied
+    ruleset, so this changes no kernel state. With `audit_log`, one entry
+    per deleted user and rule is buffered once committed. Nothing is
+    purged without a `config` (before setup). Commits. Returns (rules,
+    users) purged.
+    """
+    if config is None:
+        return 0, 0
+    now = now or datetime.utcnow()
+    cutoff = now - keep
+    # May rebuild the pool and commit, so before anything is deleted
+    ip_pool.ensure_pool(config)
+
+    users = db.session.query(User.id, User.ip_address) \
+        .filter(User.expires_at.isnot(None), User.expires_at < cutoff).all()
+    user_ids = [uid for uid, _ in users]
+    rule_ids, owners = [], set()
+    for rule_id, user_id in db.session.query(Rule.id, Rule.user_id) \
+            .filter(Rule.expires_at.isnot(None), Rule.expires_at < cutoff):
+        rule_ids.append(rule_id)
+        owners.add(user_id)
+    for i in range(0, len(user_ids), BATCH_SIZE):
+        rule_ids.extend(rid for (rid,) in db.session.query(Rule.id)
+                        .filter(Rule.user_id.in_(user_ids[i:i + BATCH_SIZE])))
+    if not rule_ids and not user_ids:
+        return 0, 0
+
+    rule_ids = list(dict.fromkeys(rule_ids))
+    if audit_log is not None:
+        rule_entries = _deleted_entries(Rule, rule_ids, audit.RULE_FIELDS)
+        user_entries = _deleted_entries(User, user_ids, audit.USER_FIELDS)
+    _delete_batched(Rule, rule_ids)
+    _delete_batched(User, user_ids)
+    ip_pool.release_bulk(config, [ip_address for _, ip_address in users])
+    revision = bump_revision()
+    bump_user_revisions(owners - set(user_ids), revision)
+    db.session.commit()
+    if audit_log is not None:
+        audit_log.record_many('rule.delete', rule_entries, revision, actor='purge')
+        audit_log.record_many('user.delete', user_entries, revision, actor='purge')
+    logger.info(f"Purged {len(rule_ids)} expired rules and {len(user_ids)} expired users")
+    return len(rule_ids), len(user_ids)
+
+
+def _claim_purge(now, interval=PURGE_INTERVAL):
+    claimed = db.session.query(ScheduleState) \
+        .filter(ScheduleState.id == 1,
+                or_(ScheduleState.purged_at.is_(None), ScheduleState.purged_at <= now - interval)) \
+        .update({ScheduleState.purged_at: now}, synchronize_session=False)
+    db.session.commit()
+    return bool(claimed)
+
+
+class RuleScheduler:
+    """
+    Background thread that sleeps until the next window boundary.
+
+    Upcoming boundaries are kept in a min-heap (loaded from the indexed
+    window columns, HEAP_SIZE at a time); the thread wakes when the
+    earliest one is due, processes it (process_due) and calls
+    `on_change(user_ids)`, e.g. to apply those users. schedule() pushes the
+    boundaries of a window just written in this process. Every worker
+    process may run one; ScheduleState lets only one handle each boundary.
+    """
+    def __init__(self, app, on_change=None, config=None, purge_after=PURGE_AFTER, max_sleep=MAX_SLEEP,
+                 audit_log=None):
+        self.app = app
+        self.on_change = on_change
+        # Purged rows are recorded here (see audit.AuditLog)
+        self.audit_log = audit_log
+        # Returns the SystemConfig used when purged users' addresses are
+        # released (None before setup); without it nothing is purged
+        self.config = config
+        self.purge_after = purge_after
+        self.max_sleep = max_sleep
+        self._heap = []
+        self._heap_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def start(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name='rule-scheduler', daemon=True)
+                self._thread.start()
+
+    def schedule(self, *times):
+        """
+        Adds window boundaries written in this process and wakes the thread
+        if one is earlier than what it sleeps for.
+        """
+        now = datetime.utcnow()
+        with self._heap_lock:
+            earliest = self._heap[0] if self._heap else None
+            for when in times:
+                if when is not None and when > now:
+                    heapq.heappush(self._heap, when)
+            if self._heap and (earliest is None or self._heap[0] < earliest):
+                self._wake.set()
+
+    def next_boundary(self):
+        with self._heap_lock:
+            return self._heap[0] if self._heap else None
+
+    def run_once(self, now=None):
+        """
+        Processes due boundaries, purges if due and refills the heap.
+        Call inside an app context.
+        """
+        now = now or datetime.utcnow()
+        user_ids = process_due(now)
+        if user_ids and self.on_change is not None:
+            self.on_change(user_ids)
+        config = self.config() if self.config is not None else None
+        if config is not None and _claim_purge(now):
+            purge_expired(config, now, self.purge_after, self.audit_log)
+        # Reloaded every run so windows written by other processes are seen;
+        # a sorted list is a valid heap
+        boundaries = upcoming(now)
+        with self._heap_lock:
+            self._heap = boundaries
+        return user_ids
+
+    def _sleep_seconds(self):
+        when = self.next_boundary()
+        if when is None:
+            return self.max_sleep
+        return min(max((when - datetime.utcnow()).total_seconds(), 0), self.max_sleep)
+
+    def _loop(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.run_once()
+            except Exception:
+                logger.exception("Rule scheduler iteration failed")
+            self._wake.wait(self._sleep_seconds())
+            self._wake.clear()
@@ -0,0 +1,264 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, selectinload
+
+from models import db, User, RulesetRevision
+from ruleset_optimizer import CompiledUser, CompiledRule
+from rule_analyzer import analyze_rules
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Users loaded per query when recompiling stale fragments
+LOAD_CHUNK = 500
+
+
+def current_revision():
+    return db.session.query(RulesetRevision.revision).filter_by(id=1).scalar() or 0
+
+
+def bump_revision(*users):
+    """
+    Records a ruleset change: increments the global revision and stamps
+    each given user with it so their compiled fragment is rebuilt. Stamping
+    with the global value (rather than user.revision + 1) keeps fragment
+    keys unique even when a deleted user's id is reused.
+    Call before committing the change. Returns the new revision.
+    """
+    updated = db.session.query(RulesetRevision).filter_by(id=1) \
+        .update({RulesetRevision.revision: RulesetRevision.revision + 1}, synchronize_session=False)
+    if not updated:
+        db.session.add(RulesetRevision(id=1, revision=1))
+        db.session.flush()
+    revision = current_revision()
+    for user in users:
+        if user is not None:
+            user.revision = revision
+    # Picked up by revision_cache once the change is committed
+    db.session.info['revision_changed'] = True
+    return revision
+
+
+def bump_user_revisions(user_ids, revision, batch_size=LOAD_CHUNK):
+    """
+    Stamps many users with `revision` (from bump_revision) in batched
+    UPDATE statements, for bulk writes that bypass the ORM objects.
+    """
+    user_ids = list(user_ids)
+    for i in range(0, len(user_ids), batch_size):
+        chunk = user_ids[i:i + batch_size]
+        db.session.query(User).filter(User.id.in_(chunk)) \
+            .update({User.revision: revision}, synchronize_session=False)
+
+
+class RevisionCache:
+    """
+    Process-wide copy of the global revision for ETag checks.
+
+    Within `ttl` seconds of the last read the cached value is returned
+    without touching the database, so conditional requests that still
+    match cost nothing. Commits in this process that bumped the revision
+    drop the copy right away; changes made by other processes are seen
+    after at most `ttl` seconds.
+    """
+    def __init__(self, ttl=2.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._revision = None
+        self._checked_at = None
+
+    def get(self):
+        checked_at = self._checked_at
+        if checked_at is not None and time.monotonic() - checked_at < self.ttl:
+            return self._revision
+        with self._lock:
+            self._revision = current_revision()
+            self._checked_at = time.monotonic()
+            return self._revision
+
+    def invalidate(self):
+        with self._lock:
+            self._revision = None
+            self._checked_at = None
+
+
+revision_cache = RevisionCache()
+
+
+@event.listens_for(Session, 'after_commit')
+def _revision_committed(session):
+    if session.info.pop('revision_changed', False):
+        revision_cache.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _revision_rolled_back(session):
+    session.info.pop('revision_changed', None)
+
+
+def is_active(row, now):
+    """
+    Whether a Rule or User with an optional window is applied at `now`.
+    """
+    return (row.valid_from is None or row.valid_from <= now) and (row.expires_at is None or row.expires_at > now)
+
+
+def compile_user(user, now=None):
+    """
+    Returns the user's CompiledUser with the rules active at `now`, or
+    None if the user is outside their own window. Window boundaries bump
+    the user's revision (see rule_schedule), so the result stays valid
+    until the next one.
+    """
+    now = now or datetime.utcnow()
+    if not is_active(user, now):
+        return None
+    rules = [CompiledRule(r.destination_ip, r.protocol, r.action,
+                          ports=[r.destination_port] if r.destination_port else None, rule_ids=[r.id])
+             for r in sorted(user.rules, key=lambda r: r.id) if is_active(r, now)]
+    return CompiledUser(user.id, user.ip_address, user.forward_mode, rules)
+
+
+def compile_users(user_ids, gateway_id=None, now=None):
+    """
+    Compiles the given users straight from the database, bypassing the
+    cache. Returns {user_id: CompiledUser or None}, None for a user who is
+    outside their window, deleted or bound to another gateway.
+    """
+    now = now or datetime.utcnow()
+    user_ids = list(user_ids)
+    compiled = dict.fromkeys(user_ids)
+    for i in range(0, len(user_ids), LOAD_CHUNK):
+        for user in User.query.options(selectinload(User.rules)) \
+                .filter(User.id.in_(user_ids[i:i + LOAD_CHUNK]), User.gateway_id == gateway_id):
+            compiled[user.id] = compile_user(user, now)
+    return compiled
+
+
+class CompiledRulesetCache:
+    """
+    Caches per-user compiled fragments (CompiledUser, keyed by
+    User.revision) and the last generated ruleset (keyed by the global
+    revision and the generator settings).
+
+    Repeated /validate or /apply calls with no writes in between only read
+    the revision counter. After a write only the changed users are reloaded
+    from the database; everyone else is served from their fragment.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fragments = {}
+        # {user_id: gateway_id} as of the last users() call
+        self._gateways = {}
+        # {(backend settings, gateway_id): (revision, result)}
+        self._compiled = {}
+        self._users = None
+        self._findings = {}
+        self._analysis = None
+
+    def clear(self):
+        with self._lock:
+            self._fragments = {}
+            self._gateways = {}
+            self._compiled = {}
+            self._users = None
+            self._findings = {}
+            self._analysis = None
+
+    def users(self):
+        """
+        Returns CompiledUser fragments for all users, in id order,
+        recompiling only those whose revision changed.
+        """
+        rows = db.session.query(User.id, User.revision, User.gateway_id).order_by(User.id).all()
+        self._gateways = {uid: gateway_id for uid, _, gateway_id in rows}
+        stale = [uid for uid, rev, _ in rows
+                 if uid not in self._fragments or self._fragments[uid][0] != rev]
+        now = datetime.utcnow()
+        for i in range(0, len(stale), LOAD_CHUNK):
+            chunk = stale[i:i + LOAD_CHUNK]
+            for user in User.query.options(selectinload(User.rules)).filter(User.id.in_(chunk)):
+                self._fragments[user.id] = (user.revision, compile_user(user, now))
+        if len(self._fragments) > len(rows):
+            live = {uid for uid, _, _ in rows}
+            for uid in [uid for uid in self._fragments if uid not in live]:
+                del self._fragments[uid]
+        if stale:
+            logger.info(f"Recompiled {len(stale)} of {len(rows)} user fragments")
+        # Users outside their window compile to None
+        return [self._fragments[uid][1] for uid, _, _ in rows
+                if uid in self._fragments and self._fragments[uid][1] is not None]
+
+    def findings(self, revision=None):
+        """
+        Returns {user_id: [rule_analyzer.Finding]} for users whose rules
+        shadow, duplicate or conflict with each other. Like the fragments,
+        a user's findings are only recomputed after their revision changes.
+        Pass the global `revision` just read by build() to reuse its users.
+        """
+        with self._lock:
+            if revision is None:
+                revision = current_revision()
+            if self._analysis is not None and self._analysis[0] == revision:
+                return self._analysis[1]
+            if self._users is not None and self._users[0] == revision:
+                users = self._users[1]
+            else:
+                users = self.users()
+            result = {}
+            for user in users:
+                user_revision = self._fragments[user.id][0]
+                cached = self._findings.get(user.id)
+                if cached is None or cached[0] != user_revision:
+                    cached = (user_revision, analyze_rules(user.rules, nat=user.forward_mode == 'NAT'))
+                    self._findings[user.id] = cached
+                if cached[1]:
+                    result[user.id] = cached[1]
+            if len(self._findings) > len(users):
+                live = {user.id for user in users}
+                self._findings = {uid: f for uid, f in self._findings.items() if uid in live}
+            self._analysis = (revision, result)
+            return result
+
+    def build(self, manager, gateway_id=None):
+        """
+        Returns (revision, content, ipsets, stats) for the current data,
+        generated with `manager`'s settings. Only users bound to
+        `gateway_id` are included; None is the portal host itself.
+        """
+        with self._lock:
+            revision = current_revision()
+            key = (manager.name, manager.dispatch, manager.optimize, gateway_id)
+            cached = self._compiled.get(key)
+            if cached is not None and cached[0] == revision:
+                return (revision,) + cached[1]
+            if self._users is not None and self._users[0] == revision:
+                users = self._users[1]
+            else:
+                users = self.users()
+                self._users = (revision, users)
+            users = [user for user in users if self._gateways.get(user.id) == gateway_id]
+            with metrics.timer(metrics.GENERATE_SECONDS, backend=manager.name):
+                content, ipsets, stats = manager.build_ruleset(users)
+            if gateway_id is None:
+                metrics.record_ruleset(manager.name, lambda: manager.table_line_counts(content))
+            self._compiled[key] = (revision, (content, ipsets, stats), users)
+            return revision, content, ipsets, stats
+
+    def built_users(self, manager, revision, gateway_id=None):
+        """
+        The CompiledUser fragments build() generated `revision` from with
+        `manager`'s settings, or None if that build is no longer cached.
+        """
+        with self._lock:
+            cached = self._compiled.get((manager.name, manager.dispatch, manager.optimize, gateway_id))
+            if cached is None or cached[0] != revision:
+                return None
+            return cached[2]
+
+
+ruleset_cache = CompiledRulesetCache()
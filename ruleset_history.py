@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import re
+import zlib
+
+from sqlalchemy import delete, insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, RulesetSnapshot, SnapshotObject
+
+logger = logging.getLogger(__name__)
+
+# Snapshots kept per backend; older ones, and objects only they used, are pruned
+HISTORY_LIMIT = 200
+
+# Average number of users whose lines share a fragment. Larger fragments
+# mean fewer objects to fetch on rollback, smaller ones finer dedup.
+FRAGMENT_OWNERS = 16
+
+# Digests per IN (...) lookup, below SQLite's bound parameter limit
+BATCH_SIZE = 500
+
+# The user a generated line belongs to: its source address (flat
+# iptables) or its per-user chain (tree iptables, nftables)
+OWNER = re.compile(r'-s (\S+)|\b(FWM_[UN]_\d+|(?:nat_)?user_\d+)')
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _is_boundary(owner):
+    return int(hashlib.md5(owner.encode()).hexdigest()[:8], 16) % FRAGMENT_OWNERS == 0
+
+
+def split_fragments(content):
+    """
+    Splits a generated ruleset into fragments of whole lines. A user's
+    lines never straddle two fragments, and whether a fragment ends before
+    a user depends only on that user's own key, so editing, adding or
+    removing one user changes one fragment and every other fragment is
+    shared with the previous snapshot.
+    """
+    fragments, current, owner = [], [], None
+    for line in content.splitlines(keepends=True):
+        match = OWNER.search(line)
+        line_owner = (match.group(1) or match.group(2)) if match else None
+        if line_owner != owner:
+            if current and (owner is None or line_owner is None or _is_boundary(line_owner)):
+                fragments.append("".join(current))
+                current = []
+            owner = line_owner
+        current.append(line)
+    if current:
+        fragments.append("".join(current))
+    return fragments
+
+
+def _insert_objects():
+    """
+    INSERT of SnapshotObject rows that skips digests already stored, so
+    blobs written concurrently by another process (e.g. two agents
+    fetching a new manifest) do not fail the statement. They hold the same
+    bytes.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return sqlite_insert(SnapshotObject).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        return postgresql_insert(SnapshotObject).on_conflict_do_nothing()
+    if dialect in ('mysql', 'mariadb'):
+        return insert(SnapshotObject).prefix_with('IGNORE')
+    return insert(SnapshotObject)
+
+
+def _store_objects(blobs):
+    """
+    Inserts the {digest: data} blobs not already stored.
+    """
+    digests = list(blobs)
+    existing = set()
+    for i in range(0, len(digests), BATCH_SIZE):
+        existing.update(d for (d,) in db.session.query(SnapshotObject.digest)
+                        .filter(SnapshotObject.digest.in_(digests[i:i + BATCH_SIZE])))
+    rows = [{'digest': d, 'data': zlib.compress(data)} for d, data in blobs.items() if d not in existing]
+    statement = _insert_objects()
+    for i in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(statement, rows[i:i + BATCH_SIZE])
+    return len(rows)
+
+
+def export_objects(digests):
+    """
+    Returns {digest: zlib-compressed data} for `digests`, as stored.
+    Raises LookupError if one is missing.
+    """
+    wanted = list(dict.fromkeys(digests))
+    found = {}
+    for i in range(0, len(wanted), BATCH_SIZE):
+        found.update(db.session.query(SnapshotObject.digest, SnapshotObject.data)
+                     .filter(SnapshotObject.digest.in_(wanted[i:i + BATCH_SIZE])))
+    missing = [d for d in wanted if d not in found]
+    if missing:
+        raise LookupError(f"Ruleset history is missing {len(missing)} objects")
+    return found
+
+
+def _load_objects(digests):
+    """
+    Returns {digest: data} for `digests`. Raises LookupError if one is missing.
+    """
+    return {digest: zlib.decompress(data) for digest, data in export_objects(digests).items()}
+
+
+def record(backend, revision, content, ipsets=None, limit=HISTORY_LIMIT):
+    """
+    Stores an applied ruleset as a snapshot of `backend`. Fragments already
+    stored for earlier snapshots are not written again, and a ruleset
+    identical to the latest snapshot is not recorded twice. Flushes;
+    returns the RulesetSnapshot.
+    """
+    blobs = {}
+    fragments = []
+    for fragment in split_fragments(content):
+        data = fragment.encode()
+        digest = _digest(data)
+        blobs[digest] = data
+        fragments.append(digest)
+    ipsets_digest = None
+    if ipsets:
+        data = json.dumps(ipsets, sort_keys=True).encode()
+        ipsets_digest = _digest(data)
+        blobs[ipsets_digest] = data
+    manifest = json.dumps({'fragments': fragments, 'ipsets': ipsets_digest}).encode()
+    manifest_digest = _digest(manifest)
+
+    latest = RulesetSnapshot.query.filter_by(backend=backend).order_by(RulesetSnapshot.id.desc()).first()
+    if latest is not None and latest.manifest == manifest_digest:
+        return latest
+
+    blobs[manifest_digest] = manifest
+    stored = _store_objects(blobs)
+    snapshot = RulesetSnapshot(revision=revision, backend=backend, manifest=manifest_digest,
+                               lines=content.count("\n"), size=len(content))
+    db.session.add(snapshot)
+    db.session.flush()
+    logger.info(f"Recorded ruleset snapshot #{snapshot.id}: {len(fragments)} fragments, {stored} new objects")
+    prune(backend, limit)
+    return snapshot
+
+
+def load_manifest(digest):
+    """
+    Returns a snapshot manifest: {'fragments': [digest, ...], 'ipsets': digest or None}.
+    """
+    return json.loads(_load_objects([digest])[digest])
+
+
+def load(snapshot):
+    """
+    Returns (content, ipsets) of a recorded snapshot.
+    """
+    manifest = load_manifest(snapshot.manifest)
+    digests = manifest['fragments'] + ([manifest['ipsets']] if manifest['ipsets'] else [])
+    objects = _load_objects(digests)
+    content = b"".join(objects[d] for d in manifest['fragments']).decode()
+    ipsets = json.loads(objects[manifest['ipsets']]) if manifest['ipsets'] else {}
+    return content, ipsets
+
+
+def prune(backend, limit=HISTORY_LIMIT):
+    """
+    Deletes all but the `limit` latest snapshots of `backend` and the
+    objects no remaining snapshot refers to.
+    """
+    old_ids = [i for (i,) in db.session.query(RulesetSnapshot.id).filter_by(backend=backend)
+               .order_by(RulesetSnapshot.id.desc()).offset(limit)]
+    if not old_ids:
+        return 0
+    for i in range(0, len(old_ids), BATCH_SIZE):
+        db.session.execute(delete(RulesetSnapshot).where(RulesetSnapshot.id.in_(old_ids[i:i + BATCH_SIZE])))
+
+    manifests = [m for (m,) in db.session.query(RulesetSnapshot.manifest).distinct()]
+    referenced = set(manifests)
+    for data in _load_objects(manifests).values():
+        manifest = json.loads(data)
+        referenced.update(manifest['fragments'])
+        if manifest['ipsets']:
+            referenced.add(manifest['ipsets'])
+    unreferenced = [d for (d,) in db.session.query(SnapshotObject.digest) if d not in referenced]
+    for i in range(0, len(unreferenced), BATCH_SIZE):
+        db.session.execute(delete(SnapshotObject).where(SnapshotObject.digest.in_(unreferenced[i:i + BATCH_SIZE])))
+    return len(old_ids)
@@ -0,0 +1,239 @@
+import hashlib
+import ipaddress
+import logging
+
+logger = logging.getLogger(__name__)
+
+# iptables multiport accepts at most 15 ports per rule
+MULTIPORT_MAX_PORTS = 15
+# Minimum number of users sharing a rule before it moves into an ipset
+IPSET_MIN_MEMBERS = 2
+IPSET_PREFIX = "fwm_"
+
+
+class CompiledUser:
+    """
+    A user (or, with source_set, a group of users) as seen by the generator.
+    Mirrors the attributes of models.User that the generator reads.
+    """
+    def __init__(self, id, ip_address, forward_mode, rules, source_set=None):
+        self.id = id
+        self.ip_address = ip_address
+        self.forward_mode = forward_mode
+        self.rules = rules
+        self.source_set = source_set
+
+    def to_json(self):
+        return [self.id, self.ip_address, self.forward_mode, [rule.to_json() for rule in self.rules]]
+
+    @classmethod
+    def from_json(cls, data):
+        id, ip_address, forward_mode, rules = data
+        return cls(id, ip_address, forward_mode, [CompiledRule.from_json(rule) for rule in rules])
+
+
+class CompiledRule:
+    """
+    A kernel rule produced from one or more models.Rule rows.
+    """
+    def __init__(self, destination_ip, protocol, action, ports=None, rule_ids=()):
+        self.destination_ip = destination_ip
+        self.protocol = protocol
+        self.action = action
+        self.ports = list(ports or [])
+        self.rule_ids = list(rule_ids)
+
+    @property
+    def destination_port(self):
+        return self.ports[0] if len(self.ports) == 1 else None
+
+    def to_json(self):
+        return [self.destination_ip, self.protocol, self.action, self.ports, self.rule_ids]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(*data)
+
+
+class OptimizedRuleset:
+    def __init__(self, users, ipsets, stats):
+        self.users = users
+        # {set_name: [member_ip, ...]} to be loaded with ipset restore
+        self.ipsets = ipsets
+        self.stats = stats
+
+
+def _network(destination):
+    try:
+        return ipaddress.ip_network(destination, strict=False)
+    except ValueError:
+        return None
+
+
+def _effective_port(protocol, port):
+    # The generator ignores the port for protocol 'all'
+    return None if protocol == 'all' or not port else int(port)
+
+
+def _covers(outer, inner):
+    """
+    True if every packet matched by `inner` is also matched by `outer`.
+    """
+    if outer.protocol != 'all' and outer.protocol != inner.protocol:
+        return False
+    if outer.ports and (not inner.ports or set(inner.ports) - set(outer.ports)):
+        return False
+    if outer.destination_ip == inner.destination_ip:
+        return True
+    outer_net, inner_net = _network(outer.destination_ip), _network(inner.destination_ip)
+    return (outer_net is not None and inner_net is not None
+            and outer_net.version == inner_net.version and inner_net.subnet_of(outer_net))
+
+
+def _overlaps(a, b):
+    if a.protocol != 'all' and b.protocol != 'all' and a.protocol != b.protocol:
+        return False
+    if a.ports and b.ports and not set(a.ports) & set(b.ports):
+        return False
+    if a.destination_ip == b.destination_ip:
+        return True
+    a_net, b_net = _network(a.destination_ip), _network(b.destination_ip)
+    if a_net is None or b_net is None or a_net.version != b_net.version:
+        return False
+    return a_net.overlaps(b_net)
+
+
+def _drop_shadowed(rules):
+    """
+    Removes rules that can never match because an earlier rule of the same
+    user already matches everything they would, whatever either verdict is.
+    """
+    kept = []
+    dropped = 0
+    for rule in rules:
+        if any(_covers(earlier, rule) for earlier in kept):
+            dropped += 1
+            continue
+        kept.append(rule)
+    return kept, dropped
+
+
+def _merge_ports(rules):
+    """
+    Folds runs of consecutive rules that differ only in port into multiport
+    rules of up to MULTIPORT_MAX_PORTS ports.
+    """
+    merged = []
+    for rule in rules:
+        prev = merged[-1] if merged else None
+        if (prev is not None and rule.ports and prev.ports
+                and rule.protocol in ('tcp', 'udp')
+                and (prev.destination_ip, prev.protocol, prev.action)
+                == (rule.destination_ip, rule.protocol, rule.action)
+                and len(prev.ports) + len(rule.ports) <= MULTIPORT_MAX_PORTS):
+            prev.ports.extend(p for p in rule.ports if p not in prev.ports)
+            prev.rule_ids.extend(rule.rule_ids)
+            continue
+        merged.append(rule)
+    return merged
+
+
+def _order_free(rule, rules, nat):
+    """
+    A rule may be moved relative to its siblings when no overlapping sibling
+    has a different verdict.
+    """
+    if nat:
+        return True
+    return not any(other is not rule and other.action != rule.action and _overlaps(rule, other)
+                   for other in rules)
+
+
+def _set_name(key):
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:12]
+    return f"{IPSET_PREFIX}{digest}"
+
+
+def optimize_ruleset(users, collapse_sources=True):
+    """
+    Compacts the rules of `users` before they are handed to
+    IptablesManager.generate_iptables_file_content:
+
+    1. drops rules shadowed by an earlier, broader rule of the same user,
+    2. merges consecutive rules differing only in port into multiport rules,
+    3. if collapse_sources, replaces identical order-independent rules shared
+       by several users with one rule matching an ipset of their addresses.
+
+    Returns an OptimizedRuleset whose stats report before/after rule counts.
+    """
+    compiled = []
+    before = shadowed = 0
+
+    for user in users:
+        rules = []
+        for rule in user.rules:
+            port = _effective_port(rule.protocol, rule.destination_port)
+            rules.append(CompiledRule(rule.destination_ip, rule.protocol, rule.action,
+                                      ports=[port] if port else None,
+                                      rule_ids=[getattr(rule, 'id', None)]))
+        before += len(rules)
+        rules, dropped = _drop_shadowed(rules)
+        shadowed += dropped
+        rules = _merge_ports(rules)
+        compiled.append(CompiledUser(user.id, user.ip_address, user.forward_mode, rules))
+
+    ipsets = {}
+    groups = []
+    if collapse_sources:
+        # key -> [(compiled_user, rule), ...]
+        candidates = {}
+        for cuser in compiled:
+            nat = cuser.forward_mode == 'NAT'
+            for rule in cuser.rules:
+                if _order_free(rule, cuser.rules, nat):
+                    key = (cuser.forward_mode, rule.destination_ip, rule.protocol,
+                           tuple(rule.ports), None if nat else rule.action)
+                    candidates.setdefault(key, []).append((cuser, rule))
+
+        collapsed = set()
+        for key, members in candidates.items():
+            if len(members) < IPSET_MIN_MEMBERS:
+                continue
+            name = _set_name(key)
+            ipsets[name] = [cuser.ip_address for cuser, _ in members]
+            first = members[0][1]
+            rule = CompiledRule(first.destination_ip, first.protocol, first.action, ports=first.ports,
+                                rule_ids=[rid for _, r in members for rid in r.rule_ids])
+            groups.append(CompiledUser(None, None, key[0], [rule], source_set=name))
+            collapsed.update(id(r) for _, r in members)
+
+        for cuser in compiled:
+            cuser.rules = [r for r in cuser.rules if id(r) not in collapsed]
+
+    result_users = groups + [cuser for cuser in compiled if cuser.rules]
+    stats = {
+        'rules_before': before,
+        'rules_after': sum(len(u.rules) for u in result_users),
+        'shadowed': shadowed,
+        'ipsets': len(ipsets),
+    }
+    logger.info(f"Ruleset optimizer: {stats['rules_before']} -> {stats['rules_after']} rules "
+                f"({stats['shadowed']} shadowed, {stats['ipsets']} ipsets)")
+    return OptimizedRuleset(result_users, ipsets, stats)
+
+
+def generate_ipset_content(ipsets):
+    """
+    Generates `ipset restore` input that (re)builds each set atomically by
+    filling a temporary set and swapping it in.
+    """
+    lines = []
+    for name, members in sorted(ipsets.items()):
+        tmp = f"{name}_t"
+        lines.append(f"create {name} hash:ip -exist")
+        lines.append(f"create {tmp} hash:ip -exist")
+        lines.append(f"flush {tmp}")
+        lines.extend(f"add {tmp} {ip}" for ip in members)
+        lines.append(f"swap {tmp} {name}")
+        lines.append(f"destroy {tmp}")
+    return "\n".join(lines) + "\n" if lines else ""
@@ -8,7 +8,7 @@ echo "Starting Firewall Manager Deployment Setup..."
 # 1. Install Dependencies
 echo "Installing system dependencies..."
 sudo apt-get update
-sudo apt-get install -y python3-venv python3-pip iptables netfilter-persistent iptables-persistent
+sudo apt-get install -y python3-venv python3-pip iptables netfilter-persistent iptables-persistent nftables
 
 # 2. Create Service User
 echo "Creating service user 'fwmanager'..."
@@ -43,7 +43,6 @@ fi
 if [ -f "requirements.txt" ]; then
     echo "Installing Python requirements..."
     sudo $APP_DIR/venv/bin/pip install -r requirements.txt
-    sudo $APP_DIR/venv/bin/pip install gunicorn  # Install gunicorn for production
 else
     echo "WARNING: requirements.txt not found. Please install dependencies manually."
 fi
@@ -56,7 +55,7 @@ sudo chown -R fwmanager:fwmanager $APP_DIR
 echo "Configuring sudo access for iptables..."
 SUDOERS_FILE="/etc/sudoers.d/fwmanager-iptables"
 if [ ! -f "$SUDOERS_FILE" ]; then
-    echo "fwmanager ALL=(ALL) NOPASSWD: /usr/sbin/iptables, /usr/sbin/iptables-restore, /usr/sbin/iptables-save" | sudo tee $SUDOERS_FILE
+    echo "fwmanager ALL=(ALL) NOPASSWD: /usr/sbin/iptables, /usr/sbin/iptables-restore, /usr/sbin/iptables-save, /usr/sbin/nft" | sudo tee $SUDOERS_FILE
     sudo chmod 440 $SUDOERS_FILE
     echo "Sudoers file created."
 else
@@ -77,4 +76,4 @@ else
 fi
 
 echo "Setup Complete!"
-echo "NOTE: You may need to adjust the ExecStart in /etc/systemd/system/firewall-manager.service if using Gunicorn."
+echo "NOTE: The service runs gunicorn (gunicorn.conf.py); set WEB_CONCURRENCY in the unit to change the worker count."
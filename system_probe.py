@@ -0,0 +1,235 @@
+import fcntl
+import ipaddress
+import logging
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds a probe result is trusted before the next get() re-runs it
+PROBE_TTL = 600
+
+# Tools looked up on PATH
+TOOLS = ('iptables', 'iptables-save', 'iptables-restore', 'iptables-legacy', 'iptables-nft',
+         'netfilter-persistent', 'nft', 'ipset')
+
+PROC_NET = '/proc/net'
+
+# ioctl requests for an interface's IPv4 address and netmask (linux/sockios.h)
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+
+Interface = namedtuple('Interface', 'name address prefixlen')
+
+# tools: {name: path or None}; backends: {'iptables-legacy', 'iptables-nft',
+# 'nft', 'ipset': bool}; probed_at: time.time() of the probe
+ProbeResult = namedtuple('ProbeResult', 'host_ip default_interface interfaces tools iptables_variant backends probed_at')
+
+
+def find_tools():
+    return {name: shutil.which(name) for name in TOOLS}
+
+
+def iptables_variant(path):
+    """
+    Returns 'legacy' or 'nf_tables' from `iptables -V` ("iptables v1.8.7
+    (nf_tables)"), or None if unknown.
+    """
+    if not path:
+        return None
+    try:
+        output = subprocess.run([path, '-V'], capture_output=True, text=True, timeout=5).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if '(nf_tables)' in output:
+        return 'nf_tables'
+    if '(legacy)' in output or output.startswith('iptables v'):
+        # Releases before 1.8 have no suffix and are always legacy
+        return 'legacy'
+    return None
+
+
+def detect_backends(tools, variant):
+    return {
+        'iptables-legacy': bool(tools.get('iptables-legacy') or (tools.get('iptables') and variant == 'legacy')),
+        'iptables-nft': bool(tools.get('iptables-nft') or (tools.get('iptables') and variant == 'nf_tables')),
+        'nft': bool(tools.get('nft')),
+        'ipset': bool(tools.get('ipset')),
+    }
+
+
+def parse_default_route(text):
+    """
+    Returns the interface of the IPv4 default route in /proc/net/route, or
+    None. Among several defaults the lowest metric wins.
+    """
+    best = None
+    for line in text.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) < 8 or fields[1] != '00000000' or fields[7] != '00000000':
+            continue
+        metric = int(fields[6])
+        if best is None or metric < best[0]:
+            best = (metric, fields[0])
+    return best[1] if best else None
+
+
+def parse_interface_names(text):
+    """
+    Interface names listed in /proc/net/dev.
+    """
+    return [line.split(':', 1)[0].strip() for line in text.splitlines()[2:] if ':' in line]
+
+
+def parse_if_inet6(text):
+    """
+    Global IPv6 addresses from /proc/net/if_inet6 as Interfaces.
+    """
+    interfaces = []
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 6 or fields[3] != '00':
+            # Scope 00 is global; skip link-local and host addresses
+            continue
+        address = ipaddress.IPv6Address(int(fields[0], 16))
+        interfaces.append(Interface(fields[5], str(address), int(fields[2], 16)))
+    return interfaces
+
+
+def _ipv4_interface(sock, name):
+    request = struct.pack('256s', name.encode()[:15])
+    try:
+        address = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)[20:24])
+        netmask = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFNETMASK, request)[20:24])
+    except OSError:
+        # No IPv4 address
+        return None
+    return Interface(name, address, ipaddress.IPv4Network(f'0.0.0.0/{netmask}').prefixlen)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return ''
+
+
+def read_interfaces(proc=PROC_NET):
+    """
+    Local interface addresses: IPv4 through SIOCGIFADDR on an unconnected
+    socket for each interface in /proc/net/dev, IPv6 from /proc/net/if_inet6.
+    Nothing is sent on the network.
+    """
+    interfaces = []
+    names = parse_interface_names(_read(os.path.join(proc, 'dev')))
+    if names:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for name in names:
+                interface = _ipv4_interface(sock, name)
+                if interface is not None:
+                    interfaces.append(interface)
+    interfaces.extend(parse_if_inet6(_read(os.path.join(proc, 'if_inet6'))))
+    return interfaces
+
+
+def pick_host_ip(interfaces, default_interface):
+    """
+    The IPv4 address of the default route's interface, else the first
+    non-loopback IPv4 address, else None.
+    """
+    candidates = [i for i in interfaces if ipaddress.ip_address(i.address).version == 4
+                  and not ipaddress.ip_address(i.address).is_loopback]
+    for interface in candidates:
+        if interface.name == default_interface:
+            return interface.address
+    return candidates[0].address if candidates else None
+
+
+def probe(proc=PROC_NET):
+    """
+    Runs every probe. Returns a ProbeResult.
+    """
+    tools = find_tools()
+    variant = iptables_variant(tools.get('iptables'))
+    default_interface = parse_default_route(_read(os.path.join(proc, 'route')))
+    interfaces = read_interfaces(proc)
+    return ProbeResult(host_ip=pick_host_ip(interfaces, default_interface),
+                       default_interface=default_interface,
+                       interfaces=interfaces,
+                       tools=tools,
+                       iptables_variant=variant,
+                       backends=detect_backends(tools, variant),
+                       probed_at=time.time())
+
+
+class ProbeCache:
+    """
+    Process-wide cache of the system probes (tools on PATH, backend
+    variants, interface addresses). Computed once at startup; after `ttl`
+    seconds get() still returns the cached result and re-runs the probes
+    in a background thread, so page loads never scan PATH or open sockets.
+    refresh() re-runs them right away, e.g. after installing nft.
+    """
+    def __init__(self, ttl=PROBE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._result = None
+        self._checked_at = None
+        self._refreshing = False
+
+    def get(self):
+        """
+        Returns the latest ProbeResult. Only the very first call (when
+        nothing ran at startup) waits for the probes.
+        """
+        result, checked_at = self._result, self._checked_at
+        if result is None:
+            with self._lock:
+                if self._result is None:
+                    self._probe()
+                return self._result
+        if time.monotonic() - checked_at >= self.ttl:
+            self._refresh_in_background()
+        return result
+
+    def refresh(self):
+        with self._lock:
+            self._probe()
+            return self._result
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, name='system-probe', daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception("System probe failed")
+        finally:
+            self._refreshing = False
+
+    def _probe(self):
+        started = time.monotonic()
+        self._result = probe()
+        self._checked_at = time.monotonic()
+        logger.info(f"System probe took {self._checked_at - started:.3f}s: host {self._result.host_ip}, "
+                    f"backends {[name for name, ok in self._result.backends.items() if ok]}")
+
+    def invalidate(self):
+        with self._lock:
+            self._result = None
+            self._checked_at = None
+
+
+system_probe = ProbeCache()
@@ -1,15 +1,64 @@
 import unittest
+import calendar
+import ipaddress
+import itertools
+import json
+import atexit
 import os
+import shutil
 import sys
-from app import app, db, User, Rule, iptables
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest import mock
+from datetime import datetime, timedelta
+from sqlalchemy import event, func
+
+# The engine is bound when app is imported; every TestCase drops all
+# tables in tearDown, so never let the suite touch instance/firewall.db
+TEST_DB_DIR = tempfile.mkdtemp(prefix='fwm-tests-')
+atexit.register(shutil.rmtree, TEST_DB_DIR, ignore_errors=True)
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(TEST_DB_DIR, 'test.db')}"
+
+from app import app, db, User, Rule, SystemConfig, iptables, apply_queue, create_app, StreamedUsers, \
+    run_apply, schedule_apply, audit_log
+from models import ApplyJob, IpFreeRange, Gateway, RuleCounter, TrafficSample, RulesetSnapshot, SnapshotObject, \
+    AuditEntry, AuditPartition
+from config_cache import config_cache, ConfigCache, bump_config_version
+import ip_pool
+from pagination import keyset_page
+from iptables_manager import IptablesManager, parse_restore_content, diff_rulesets, build_dispatch_tree, \
+    parse_rule_counters as iptables_parse_counters
+from nftables_manager import NftablesManager, parse_rule_counters as nftables_parse_counters
+from ruleset_optimizer import optimize_ruleset, CompiledRule
+from ruleset_cache import ruleset_cache, revision_cache, bump_revision, current_revision
+import ruleset_cache as ruleset_cache_module
+import metrics
+from firewall_backend import pipe_lines, FileLock
+import db_engine
+import db_migration
+import system_probe as system_probe_module
+from system_probe import system_probe
+import gateways
+from gateways import gateway_rulesets
+from gateway_agent import GatewayAgent
+import ruleset_history
+import rule_schedule
+import drift
+import audit
+from rule_analyzer import analyze_rules
+import traffic
 
 class FirewallManagerTestCase(unittest.TestCase):
     def setUp(self):
         app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         self.app = app.test_client()
         with app.app_context():
             db.create_all()
+            db.session.add(SystemConfig(host_ip='10.0.0.254', user_network_cidr='10.0.0.0/24', is_configured=True))
+            db.session.commit()
+        config_cache.invalidate()
+        ruleset_cache.clear()
 
     def tearDown(self):
         with app.app_context():
@@ -22,9 +71,11 @@ class FirewallManagerTestCase(unittest.TestCase):
         self.assertIn(b'Firewall Manager', response.data)
 
     def test_add_user(self):
-        response = self.app.post('/user/add', data=dict(
+        response = self.app.post('/user/add/page', data=dict(
             username='testuser',
-            ip_address='10.0.0.1'
+            ip_address='10.0.0.1',
+            user_type='employee',
+            forward_mode='ROUTE'
         ), follow_redirects=True)
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'User added successfully!', response.data)
@@ -33,22 +84,22 @@ class FirewallManagerTestCase(unittest.TestCase):
     def test_add_rule(self):
         # Add user first
         with app.app_context():
-            user = User(username='ruleuser', ip_address='10.0.0.2')
+            user = User(username='ruleuser', ip_address='10.0.0.2', forward_mode='NAT')
             db.session.add(user)
             db.session.commit()
             user_id = user.id
 
         # Add rule
         response = self.app.post(f'/user/{user_id}/rules/add', data=dict(
+            user_id=user_id,
             destination_ip='8.8.8.8',
             destination_port='53',
             protocol='udp',
-            action='ACCEPT',
-            forward_type='NAT'
-        ), follow_redirects=True)
-        
+            action='ACCEPT'
+        ), headers={'Referer': f'/user/{user_id}/rules'}, follow_redirects=True)
+
         self.assertEqual(response.status_code, 200)
-        self.assertIn(b'Rule added!', response.data)
+        self.assertIn(b'Rule added successfully!', response.data)
         self.assertIn(b'8.8.8.8', response.data)
 
     def test_iptables_generation(self):
@@ -62,20 +113,2062 @@ class FirewallManagerTestCase(unittest.TestCase):
                 destination_ip='1.1.1.1',
                 destination_port=80,
                 protocol='tcp',
-                action='ACCEPT',
-                forward_type='ROUTE'
+                action='ACCEPT'
             )
             db.session.add(rule)
             db.session.commit()
             
             users = User.query.all()
-            commands = iptables.generate_rules(users)
+            commands = iptables.generate_iptables_file_content(users).splitlines()
             
             # Verify commands
-            # Expected: iptables -A FORWARD -s 10.0.0.3 -d 1.1.1.1 -p tcp --dport 80 -j ACCEPT
-            expected_part = "-A FORWARD -s 10.0.0.3 -d 1.1.1.1 -p tcp --dport 80 -j ACCEPT"
+            # Expected: iptables -A FORWARD -s 10.0.0.3 -d 1.1.1.1 -p tcp --dport 80 -m comment --comment fwm:r<id> -j ACCEPT
+            expected_part = f"-A FORWARD -s 10.0.0.3 -d 1.1.1.1 -p tcp --dport 80 -m comment --comment fwm:r{rule.id} -j ACCEPT"
             found = any(expected_part in cmd for cmd in commands)
             self.assertTrue(found, f"Command not found in: {commands}")
 
+class QueryCountTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.8.0.1', user_network_cidr='10.8.0.0/24', is_configured=True))
+            db.session.commit()
+            # Warm the config cache so it does not skew the first count
+            config_cache.invalidate()
+            config_cache.get()
+        ruleset_cache.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def add_users(self, start, count):
+        with app.app_context():
+            for i in range(start, start + count):
+                user = User(username=f'user{i}', ip_address=f'10.8.0.{i}')
+                user.rules = [Rule(destination_ip='1.1.1.1', destination_port=p, protocol='tcp') for p in (22, 80)]
+                db.session.add(user)
+                bump_revision(user)
+            db.session.commit()
+
+    def count_queries(self, method, url):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+            try:
+                response = getattr(self.app, method)(url)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertIn(response.status_code, (200, 302))
+        return len(statements)
+
+    def assert_constant_queries(self, method, url, limit):
+        self.add_users(2, 3)
+        small = self.count_queries(method, url)
+        self.add_users(10, 20)
+        large = self.count_queries(method, url)
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, limit)
+
+    def test_users_listing(self):
+        self.assert_constant_queries('get', '/users', 2)
+
+    def test_rules_listing(self):
+        self.assert_constant_queries('get', '/rules', 3)
+
+    def test_validate(self):
+        self.assert_constant_queries('get', '/validate', 4)
+
+    def test_validate_stream_matches_page_content(self):
+        self.add_users(2, 3)
+        with app.app_context():
+            expected = iptables.generate_iptables_file_content(User.query.all())
+        response = self.app.get('/validate?stream=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.get_data(as_text=True), expected)
+
+    def test_stream_reads_one_snapshot(self):
+        self.add_users(2, 2)
+        with app.app_context(), StreamedUsers() as users:
+            lines = iptables.iter_iptables_lines(users, dispatch='tree')
+            declared = set()
+            for line in lines:
+                if line == '-F FORWARD':
+                    break
+                if line.startswith(':'):
+                    declared.add(line[1:].split()[0])
+            # Committed while the stream is between its declaration and rule passes
+            self.add_users(4, 1)
+            rest = list(lines)
+        targets = {line.split()[1] for line in rest[:rest.index('COMMIT')] if line.startswith('-A FWM_')}
+        self.assertEqual(targets, declared)
+        self.assertFalse([line for line in rest if '10.8.0.4' in line])
+
+    def test_stream_revision_is_read_in_its_snapshot(self):
+        self.add_users(2, 1)
+        with app.app_context(), StreamedUsers() as users:
+            revision = users.revision()
+            self.add_users(3, 1)
+            self.assertEqual(current_revision(), revision + 1)
+            self.assertEqual(users.revision(), revision)
+            self.assertEqual([user.id for user in users], [1])
+
+    def test_apply(self):
+        with mock.patch.object(iptables, '_restore'), \
+                mock.patch.object(iptables, '_load_snapshot', return_value=None), \
+                mock.patch.object(iptables, '_save_snapshot'), \
+                mock.patch.dict(app.config, {'APPLY_ASYNC': False}):
+            # Includes recording the applied ruleset in the history
+            self.assert_constant_queries('post', '/apply', 20)
+
+class PaginationTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.8.0.1', user_network_cidr='10.8.0.0/24', is_configured=True))
+            for i in range(2, 27):
+                user = User(username=f'user{i:02d}', ip_address=f'10.8.0.{i}')
+                user.rules = [Rule(destination_ip=f'172.16.{i}.1', destination_port=443)]
+                db.session.add(user)
+            db.session.commit()
+        config_cache.invalidate()
+        ruleset_cache.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def walk(self, query, items):
+        with app.app_context():
+            seen = []
+            after = None
+            while True:
+                page = keyset_page(query(), User.username, User.id, after=after, limit=10)
+                seen.extend(items(page))
+                if not page.next_cursor:
+                    return seen, page
+                after = page.next_cursor
+
+    def test_keyset_walk_covers_every_row_once(self):
+        seen, last = self.walk(lambda: db.session.query(User), lambda p: [u.username for u in p.items])
+        self.assertEqual(seen, [f'user{i:02d}' for i in range(2, 27)])
+        with app.app_context():
+            back = keyset_page(db.session.query(User), User.username, User.id, before=last.prev_cursor, limit=10)
+            self.assertEqual(back.items[-1].username, 'user21')
+
+    def test_users_page_search_and_cursor(self):
+        response = self.app.get('/users?limit=10&sort=-username')
+        body = response.get_data(as_text=True)
+        self.assertIn('user26', body)
+        self.assertNotIn('user16', body)
+        self.assertIn('after=', body)
+        body = self.app.get('/users?q=user1').get_data(as_text=True)
+        self.assertIn('user19', body)
+        self.assertNotIn('user20', body)
+
+    def test_rules_search_by_destination(self):
+        body = self.app.get('/rules?q=172.16.25.').get_data(as_text=True)
+        self.assertIn('172.16.25.1', body)
+        self.assertNotIn('172.16.24.1', body)
+
+    def test_user_lookup(self):
+        users = self.app.get('/users/lookup?q=10.8.0.2').get_json()
+        self.assertEqual([u['username'] for u in users], ['user02', 'user20', 'user21', 'user22', 'user23',
+                                                          'user24', 'user25', 'user26'])
+
+    def test_search_wildcards_are_literal(self):
+        with app.app_context():
+            db.session.add(User(username='a_b%c', ip_address='10.8.0.200'))
+            db.session.add(User(username='axb', ip_address='10.8.0.201'))
+            db.session.commit()
+        self.assertEqual(self.app.get('/users/lookup?q=%25').get_json(), [])
+        users = self.app.get('/users/lookup?q=a_').get_json()
+        self.assertEqual([u['username'] for u in users], ['a_b%c'])
+        users = self.app.get('/users/lookup?q=a_b%25').get_json()
+        self.assertEqual([u['username'] for u in users], ['a_b%c'])
+        body = self.app.get('/users?q=_').get_data(as_text=True)
+        self.assertNotIn('user02', body)
+        body = self.app.get('/rules?q=172.16.2_.').get_data(as_text=True)
+        self.assertNotIn('172.16.25.1', body)
+
+class IpPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.config = SystemConfig(host_ip='10.8.0.1', user_network_cidr='10.8.0.0/29', is_configured=True)
+        db.session.add(self.config)
+        db.session.add(User(username='existing', ip_address='10.8.0.3'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_claims_skip_used_and_host_addresses(self):
+        ips = []
+        for _ in range(5):
+            ip = ip_pool.suggest_ip(self.config)
+            ips.append(ip)
+            if ip is not None:
+                self.assertTrue(ip_pool.claim_ip(self.config, ip))
+                db.session.commit()
+        self.assertEqual(ips, ['10.8.0.2', '10.8.0.4', '10.8.0.5', '10.8.0.6', None])
+
+    def test_address_is_claimed_once(self):
+        self.assertTrue(ip_pool.claim_ip(self.config, '10.8.0.4'))
+        db.session.commit()
+        self.assertFalse(ip_pool.claim_ip(self.config, '10.8.0.4'))
+        self.assertFalse(ip_pool.claim_ip(self.config, '10.8.0.3'))
+        self.assertTrue(ip_pool.claim_ip(self.config, '192.0.2.1'))
+
+    def test_release_merges_ranges(self):
+        for ip in ('10.8.0.2', '10.8.0.4', '10.8.0.5'):
+            self.assertTrue(ip_pool.claim_ip(self.config, ip))
+        ip_pool.release_ip(self.config, '10.8.0.4')
+        ip_pool.release_ip(self.config, '10.8.0.5')
+        db.session.commit()
+        ranges = [(r.start, r.end) for r in IpFreeRange.query.order_by(IpFreeRange.start)]
+        self.assertEqual(len(ranges), 1)
+        self.assertEqual(ranges[0][1] - ranges[0][0], 2)
+
+    def test_suggestion_only_reads(self):
+        self.assertEqual(ip_pool.suggest_ip(self.config), '10.8.0.2')
+        self.assertEqual(IpFreeRange.query.count(), 0)
+        ip_pool.ensure_pool(self.config)
+        self.assertTrue(ip_pool.claim_ip(self.config, ip_pool.suggest_ip(self.config)))
+        db.session.commit()
+        self.assertEqual(ip_pool.suggest_ip(self.config), '10.8.0.4')
+
+    def test_suggestion_without_pool_skips_to_the_first_gap(self):
+        config = SystemConfig(host_ip='10.0.0.1', user_network_cidr='10.0.0.0/8', is_configured=True)
+        for i in range(2, 6):
+            db.session.add(User(username=f'u{i}', ip_address=f'10.0.0.{i}'))
+        db.session.commit()
+        # Never walks the /8 address by address
+        with mock.patch('ip_pool.range', create=True, side_effect=AssertionError):
+            self.assertEqual(ip_pool.suggest_ip(config), '10.0.0.6')
+        self.assertEqual(ip_pool.suggest_ip(self.config), '10.8.0.2')
+
+    def test_add_user_form_does_not_write(self):
+        config_cache.invalidate()
+        client = app.test_client()
+        statements = []
+        def record(conn, cursor, statement, *args):
+            if not statement.lstrip().upper().startswith(('SELECT', 'PRAGMA')):
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            for _ in range(3):
+                self.assertIn(b'10.8.0.2', client.get('/user/add/page').data)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(statements, [])
+
+class BulkImportExportTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.8.0.1', user_network_cidr='10.8.0.0/24', is_configured=True))
+            db.session.add(User(username='existing', ip_address='10.8.0.2'))
+            db.session.commit()
+        config_cache.invalidate()
+        ruleset_cache.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_csv_import_allocates_ips(self):
+        body = "username,full_name,ip_address\nalice,Alice,\nbob,Bob,10.8.0.50\ncarol,Carol,\n"
+        response = self.app.post('/api/bulk/import?kind=users&format=csv', data=body)
+        self.assertEqual(response.status_code, 200, response.get_json())
+        self.assertEqual(response.get_json()['users'], 3)
+        with app.app_context():
+            ips = dict(db.session.query(User.username, User.ip_address))
+        self.assertEqual(ips['alice'], '10.8.0.3')
+        self.assertEqual(ips['bob'], '10.8.0.50')
+        self.assertEqual(ips['carol'], '10.8.0.4')
+
+    def test_invalid_batch_writes_nothing(self):
+        body = "\n".join([
+            '{"username": "dave", "rules": [{"destination_ip": "1.1.1.1", "destination_port": 443}]}',
+            '{"username": "existing"}',
+            '{"username": "erin", "rules": [{"destination_ip": "not-an-ip"}]}',
+        ])
+        response = self.app.post('/api/bulk/import?kind=users&format=jsonl', data=body)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([e['record'] for e in response.get_json()['errors']], [2, 3])
+        with app.app_context():
+            self.assertEqual(User.query.count(), 1)
+            self.assertEqual(Rule.query.count(), 0)
+
+    def test_export_round_trip(self):
+        with app.app_context():
+            db.session.add(Gateway(name='edge', backend='iptables', token_hash='x'))
+            db.session.commit()
+        body = json.dumps([{'username': 'frank', 'gateway_id': 1, 'valid_from': '2030-01-01T08:00',
+                            'expires_at': '2030-02-01T08:00',
+                            'rules': [{'destination_ip': '10.0.0.0/8', 'protocol': 'all',
+                                       'expires_at': '2030-01-15T00:00:00'}]}])
+        self.assertEqual(self.app.post('/api/bulk/import?kind=users&format=json', data=body).status_code, 200)
+        users = self.app.get('/api/bulk/export?kind=users&format=jsonl').get_data(as_text=True)
+        exported = [json.loads(l) for l in users.splitlines()]
+        self.assertEqual([u['username'] for u in exported], ['existing', 'frank'])
+        self.assertEqual((exported[1]['gateway_id'], exported[1]['valid_from'], exported[1]['expires_at']),
+                         (1, '2030-01-01T08:00:00', '2030-02-01T08:00:00'))
+        self.assertIsNone(exported[0]['gateway_id'])
+        rules = self.app.get('/api/bulk/export?kind=rules&format=csv').get_data(as_text=True)
+        self.assertEqual(rules.splitlines(), [
+            'username,destination_ip,destination_port,protocol,action,valid_from,expires_at',
+            'frank,10.0.0.0/8,,all,ACCEPT,,2030-01-15T00:00:00'])
+        response = self.app.post('/api/bulk/import?kind=rules&format=csv', data=rules)
+        self.assertEqual(response.get_json()['rules'], 1)
+        with app.app_context():
+            self.assertEqual([r.expires_at for r in Rule.query], [datetime(2030, 1, 15)] * 2)
+
+        with app.app_context():
+            db.session.execute(db.delete(User).where(User.username == 'frank'))
+            db.session.commit()
+        exported[1]['ip_address'] = None
+        response = self.app.post('/api/bulk/import?kind=users&format=json', data=json.dumps(exported[1:]))
+        self.assertEqual(response.status_code, 200, response.get_json())
+        with app.app_context():
+            frank = User.query.filter_by(username='frank').one()
+            self.assertEqual((frank.gateway_id, frank.valid_from), (1, datetime(2030, 1, 1, 8)))
+
+    def test_windows_and_gateways_are_validated(self):
+        body = "\n".join([
+            '{"username": "gina", "gateway_id": 7}',
+            '{"username": "hank", "valid_from": "2030-02-01T00:00", "expires_at": "2030-01-01T00:00"}',
+            '{"username": "ivan", "rules": [{"destination_ip": "1.1.1.1", "valid_from": "soon"}]}',
+        ])
+        response = self.app.post('/api/bulk/import?kind=users&format=jsonl', data=body)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([e['record'] for e in response.get_json()['errors']], [1, 2, 3])
+
+    def test_port_needs_tcp_or_udp(self):
+        body = "\n".join(['username,destination_ip,destination_port,protocol,action',
+                          'existing,1.1.1.1,53,udp,ACCEPT',
+                          'existing,1.1.1.1,8,icmp,ACCEPT',
+                          'existing,1.1.1.1,80,all,DROP'])
+        response = self.app.post('/api/bulk/import?kind=rules&format=csv', data=body)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([e['record'] for e in response.get_json()['errors']], [2, 3])
+        with app.app_context():
+            self.assertEqual(Rule.query.count(), 0)
+            user_id = User.query.one().id
+        self.app.post('/rules/add', data={'user_id': user_id, 'destination_ip': '1.1.1.1',
+                                         'destination_port': '80', 'protocol': 'all', 'action': 'ACCEPT'})
+        with app.app_context():
+            self.assertEqual(Rule.query.count(), 0)
+
+class ConfigCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+        db.session.add(SystemConfig(host_ip='10.8.0.1', user_network_cidr='10.8.0.0/24', is_configured=True))
+        db.session.commit()
+        self.cache = ConfigCache(ttl=60)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def count_queries(self, func):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            result = func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return result, len(statements)
+
+    def test_cached_within_ttl(self):
+        self.assertEqual(self.count_queries(self.cache.get)[1], 1)
+        config, queries = self.count_queries(self.cache.get)
+        self.assertEqual(queries, 0)
+        self.assertEqual(config.user_network_cidr, '10.8.0.0/24')
+
+    def test_version_bump_is_noticed_after_ttl(self):
+        self.cache.get()
+        # Another process changes the config
+        row = SystemConfig.query.first()
+        row.user_network_cidr = '10.9.0.0/24'
+        bump_config_version(row)
+        db.session.commit()
+        self.assertEqual(self.cache.get().user_network_cidr, '10.8.0.0/24')
+        self.cache.ttl = 0
+        self.assertEqual(self.cache.get().user_network_cidr, '10.9.0.0/24')
+        # Unchanged version: only the version column is read
+        config, queries = self.count_queries(self.cache.get)
+        self.assertEqual(queries, 1)
+
+class IncrementalApplyTestCase(unittest.TestCase):
+    OLD = (
+        "*filter\n-F FORWARD\n"
+        "-A FORWARD -s 10.0.0.2 -d 1.1.1.1 -j ACCEPT\n"
+        "-A FORWARD -s 10.0.0.2 -d 2.2.2.2 -j DROP\n"
+        "-A FORWARD -s 10.0.0.3 -d 3.3.3.3 -j ACCEPT\n"
+        "COMMIT\n*nat\n-F POSTROUTING\nCOMMIT\n"
+    )
+
+    def test_parse_restore_content(self):
+        tables = parse_restore_content(self.OLD)
+        self.assertEqual(len(tables['filter']['FORWARD']), 3)
+        self.assertEqual(tables['nat']['POSTROUTING'], [])
+
+    def test_diff_only_touches_changed_rules(self):
+        new = self.OLD.replace("-d 2.2.2.2 -j DROP", "-d 2.2.2.2 -j ACCEPT")
+        delta, added, removed = diff_rulesets(parse_restore_content(self.OLD), parse_restore_content(new))
+        self.assertEqual((added, removed), (1, 1))
+        self.assertEqual(delta, "*filter\n-D FORWARD 2\n-I FORWARD 2 -s 10.0.0.2 -d 2.2.2.2 -j ACCEPT\nCOMMIT\n")
+
+    def test_diff_unchanged_is_empty(self):
+        tables = parse_restore_content(self.OLD)
+        self.assertEqual(diff_rulesets(tables, tables), (None, 0, 0))
+
+    def test_drift_falls_back_to_full_restore(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            manager = IptablesManager(snapshot_path=os.path.join(tmp, 'snapshot.json'))
+            user = SimpleNamespace(id=1, ip_address='10.0.0.2', forward_mode='ROUTE', rules=[
+                SimpleNamespace(destination_ip='1.1.1.1', protocol='all', destination_port=None, action='ACCEPT')])
+            with mock.patch.object(manager, '_restore') as restore, \
+                    mock.patch.object(manager, '_read_kernel_chains', return_value={'filter': {}}):
+                self.assertEqual(manager.apply_rules([user], incremental=True)['mode'], 'full')
+                self.assertEqual(manager.apply_rules([user], incremental=True)['mode'], 'noop')
+                # Someone edited the kernel behind our back
+                manager._read_kernel_chains.return_value = {'filter': {'FORWARD': ['-A FORWARD -j DROP']}}
+                self.assertEqual(manager.apply_rules([user], incremental=True)['mode'], 'full')
+                self.assertEqual(restore.call_count, 2)
+
+class RulesetCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.8.0.1', user_network_cidr='10.8.0.0/24', is_configured=True))
+            for i in range(2, 6):
+                user = User(username=f'user{i}', ip_address=f'10.8.0.{i}')
+                user.rules = [Rule(destination_ip=f'172.16.{i}.1', destination_port=443, protocol='tcp')]
+                db.session.add(user)
+                bump_revision(user)
+            db.session.commit()
+        config_cache.invalidate()
+        ruleset_cache.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_unchanged_revision_reads_only_the_counter(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            first = ruleset_cache.build(iptables)
+            event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+            try:
+                second = ruleset_cache.build(iptables)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(first, second)
+        self.assertEqual(len(statements), 1)
+
+    def test_write_recompiles_only_changed_user(self):
+        with app.app_context():
+            ruleset_cache.build(iptables)
+            user_id = User.query.filter_by(username='user3').first().id
+        self.app.post(f'/user/{user_id}/rules/add', data={
+            'user_id': user_id, 'destination_ip': '9.9.9.9', 'destination_port': '53', 'protocol': 'udp',
+            'action': 'ACCEPT'})
+        with app.app_context(), mock.patch('ruleset_cache.compile_user', wraps=ruleset_cache_module.compile_user) as compile_user:
+            revision, content, _, _ = ruleset_cache.build(iptables)
+        self.assertEqual([c.args[0].username for c in compile_user.call_args_list], ['user3'])
+        self.assertIn('-d 9.9.9.9', content)
+        self.assertIn('-d 172.16.5.1', content)
+
+    def test_deleted_user_is_dropped(self):
+        with app.app_context():
+            ruleset_cache.build(iptables)
+            user_id = User.query.filter_by(username='user4').first().id
+        self.app.post(f'/user/{user_id}/delete')
+        with app.app_context():
+            _, content, _, _ = ruleset_cache.build(iptables)
+        self.assertNotIn('172.16.4.1', content)
+
+    def test_applied_revision_skips_restore(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp, app.app_context():
+            manager = IptablesManager(snapshot_path=os.path.join(tmp, 'snapshot.json'))
+            revision, content, ipsets, _ = ruleset_cache.build(manager)
+            with mock.patch.object(manager, '_restore') as restore, \
+                    mock.patch.object(manager, '_read_kernel_chains', return_value={'filter': {}}), \
+                    mock.patch('iptables_manager.parse_restore_content',
+                               wraps=parse_restore_content) as parse:
+                self.assertEqual(manager.apply_compiled(content, ipsets, True, revision)['mode'], 'full')
+                self.assertEqual(manager.apply_compiled(content, ipsets, True, revision)['mode'], 'noop')
+            self.assertEqual(restore.call_count, 1)
+            self.assertEqual(parse.call_count, 1)
+
+    def test_same_revision_with_other_dispatch_is_applied(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp, app.app_context():
+            path = os.path.join(tmp, 'snapshot.json')
+            flat = IptablesManager(snapshot_path=path)
+            tree = IptablesManager(snapshot_path=path, dispatch='tree')
+            revision, content, ipsets, _ = ruleset_cache.build(flat)
+            ruleset_cache.clear()
+            _, tree_content, tree_ipsets, _ = ruleset_cache.build(tree)
+            self.assertNotEqual(content, tree_content)
+            with mock.patch.object(IptablesManager, '_restore') as restore, \
+                    mock.patch.object(IptablesManager, '_read_kernel_chains', return_value={'filter': {}}):
+                self.assertEqual(flat.apply_compiled(content, ipsets, True, revision)['mode'], 'full')
+                self.assertNotEqual(tree.apply_compiled(tree_content, tree_ipsets, True, revision)['mode'], 'noop')
+            self.assertEqual(restore.call_count, 2)
+
+class ApplyQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.8.0.1', user_network_cidr='10.8.0.0/24', is_configured=True))
+            db.session.commit()
+        config_cache.invalidate()
+        ruleset_cache.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_requests_join_the_queued_job(self):
+        with mock.patch.object(apply_queue, 'notify') as notify, \
+                mock.patch.dict(app.config, {'APPLY_ASYNC': True}):
+            for _ in range(3):
+                self.assertEqual(self.app.post('/apply').status_code, 302)
+        self.assertEqual(notify.call_count, 3)
+        with app.app_context():
+            self.assertEqual(ApplyJob.query.count(), 1)
+        status = self.app.get('/apply/status').get_json()
+        self.assertEqual(status['status'], 'queued')
+        self.assertTrue(status['pending'])
+
+    def test_burst_is_applied_once(self):
+        with app.app_context():
+            db.session.add_all([ApplyJob(status='queued'), ApplyJob(status='queued')])
+            db.session.commit()
+            run = mock.Mock(return_value=(7, {'mode': 'incremental', 'added': 1, 'removed': 0}))
+            with mock.patch.object(apply_queue, 'run', run):
+                self.assertEqual(apply_queue.run_pending(), 2)
+                self.assertEqual(apply_queue.run_pending(), 0)
+            self.assertEqual(run.call_count, 1)
+            jobs = ApplyJob.query.all()
+            self.assertEqual({(j.status, j.applied_revision, j.mode) for j in jobs}, {('done', 7, 'incremental')})
+            self.assertTrue(all(j.duration is not None for j in jobs))
+
+    def test_failure_is_reported(self):
+        with mock.patch.object(apply_queue, 'run', side_effect=RuntimeError('restore failed')), \
+                mock.patch.dict(app.config, {'APPLY_ASYNC': False}):
+            self.app.post('/apply')
+        status = self.app.get('/apply/status').get_json()
+        self.assertEqual((status['status'], status['error']), ('failed', 'restore failed'))
+        self.assertFalse(status['pending'])
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.8.0.1', user_network_cidr='10.8.0.0/24', is_configured=True))
+            for i in (2, 3):
+                user = User(username=f'user{i}', ip_address=f'10.8.0.{i}')
+                user.rules = [Rule(destination_ip='1.1.1.1', destination_port=443, protocol='tcp')]
+                db.session.add(user)
+                bump_revision(user)
+            db.session.commit()
+        config_cache.invalidate()
+        ruleset_cache.clear()
+        metrics.registry.enabled = True
+
+    def tearDown(self):
+        metrics.registry.enabled = False
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_disabled_endpoint_is_not_found(self):
+        metrics.registry.enabled = False
+        self.assertEqual(self.app.get('/metrics').status_code, 404)
+
+    def test_request_generation_and_inventory_metrics(self):
+        self.app.get('/users')
+        self.app.get('/validate')
+        body = self.app.get('/metrics').get_data(as_text=True)
+        self.assertIn('fwm_http_request_duration_seconds_count{endpoint="list_users",method="GET",status="200"}', body)
+        self.assertIn('fwm_http_request_db_queries_count{endpoint="validate_rules"}', body)
+        self.assertIn('fwm_ruleset_generate_seconds_count{backend="iptables"}', body)
+        self.assertIn('fwm_ruleset_lines{backend="iptables",table="filter"} 10', body)
+        self.assertIn('fwm_users 2\n', body)
+        self.assertIn('fwm_rules 2\n', body)
+
+    def test_restore_status_is_counted(self):
+        with self.assertRaises(Exception):
+            pipe_lines(["false"], ["*filter", "COMMIT"])
+        pipe_lines(["true"], [])
+        body = metrics.registry.render()
+        self.assertIn('fwm_restore_total{command="false",status="1"} 1', body)
+        self.assertIn('fwm_restore_total{command="true",status="0"} 1', body)
+
+    def test_values_are_merged_across_worker_processes(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            metrics.registry.directory = tmp
+            try:
+                metrics.RESTORE_TOTAL.inc(command='merged', status='0')
+                metrics.RESTORE_SECONDS.observe(0.2, command='merged')
+                metrics.DRIFT_CHAINS.set(1, backend='merged')
+                metrics.registry.dump()
+                # Another worker with the same counts and a later gauge value
+                with open(os.path.join(tmp, metrics.registry._file)) as f:
+                    state = json.load(f)
+                for key, value in state['fwm_ruleset_drift_chains']:
+                    if key == ['merged']:
+                        value[:] = [3, value[1] + 1]
+                with open(os.path.join(tmp, 'other.json'), 'w') as f:
+                    json.dump(state, f)
+                body = metrics.registry.render()
+            finally:
+                metrics.registry.directory = None
+        self.assertIn('fwm_restore_total{command="merged",status="0"} 2\n', body)
+        self.assertIn('fwm_restore_duration_seconds_count{command="merged"} 2\n', body)
+        self.assertIn('fwm_restore_duration_seconds_sum{command="merged"} 0.4\n', body)
+        self.assertIn('fwm_ruleset_drift_chains{backend="merged"} 3\n', body)
+
+    def test_histogram_exposition(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('op',), buckets=(0.1, 1))
+        histogram.observe(0.5, op='a"b')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{op="a\\"b",le="0.1"} 0',
+            'test_seconds_bucket{op="a\\"b",le="1"} 1',
+            'test_seconds_bucket{op="a\\"b",le="+Inf"} 1',
+            'test_seconds_sum{op="a\\"b"} 0.5',
+            'test_seconds_count{op="a\\"b"} 1',
+        ])
+
+class TrafficTestCase(unittest.TestCase):
+    NOW = 1700000000 - 1700000000 % 3600
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.8.0.1', user_network_cidr='10.8.0.0/24', is_configured=True))
+            user = User(username='alice', ip_address='10.8.0.2')
+            user.rules = [Rule(destination_ip='1.1.1.1', destination_port=80, protocol='tcp'),
+                          Rule(destination_ip='8.8.8.8', destination_port=53, protocol='udp')]
+            db.session.add(user)
+            db.session.commit()
+            self.user_id = user.id
+            self.rule_ids = [r.id for r in user.rules]
+        config_cache.invalidate()
+        ruleset_cache.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_parse_iptables_counters(self):
+        output = "\n".join([
+            "*filter",
+            "[10:1000] -A FORWARD -s 10.8.0.2 -d 1.1.1.1/32 -p tcp -m tcp --dport 80 -m comment --comment fwm:r7 -j ACCEPT",
+            "[5:500] -A FWM_U_1 -d 1.1.1.1/32 -m comment --comment \"fwm:r7\" -j ACCEPT",
+            "[3:300] -A INPUT -i lo -j ACCEPT",
+            "COMMIT",
+        ])
+        self.assertEqual(iptables_parse_counters(output), {7: (15, 1500)})
+
+    def test_parse_nftables_counters(self):
+        output = json.dumps({'nftables': [
+            {'metainfo': {'json_schema_version': 1}},
+            {'rule': {'chain': 'user_1', 'comment': 'fwm:r4',
+                      'expr': [{'match': {}}, {'counter': {'packets': 2, 'bytes': 120}}, {'accept': None}]}},
+            {'rule': {'chain': 'forward', 'expr': [{'vmap': {}}]}},
+        ]})
+        self.assertEqual(nftables_parse_counters(output), {4: (2, 120)})
+
+    def collect(self, counters, now):
+        with mock.patch.object(iptables, 'read_rule_counters', return_value=counters):
+            return traffic.collect(iptables, now=now)
+
+    def test_deltas_and_counter_reset(self):
+        first, second = self.rule_ids
+        with app.app_context():
+            # First reading is only a baseline
+            self.assertEqual(self.collect({first: (10, 1000), second: (1, 60)}, self.NOW), 0)
+            self.assertEqual(self.collect({first: (15, 1600), second: (1, 60)}, self.NOW + 60), 1)
+            # Reloaded rule: counts from zero again
+            self.assertEqual(self.collect({first: (2, 300), second: (1, 60), 999: (1, 1)}, self.NOW + 120), 1)
+            samples = TrafficSample.query.order_by(TrafficSample.bucket).all()
+            self.assertEqual([(s.rule_id, s.user_id, s.bytes) for s in samples],
+                             [(first, self.user_id, 600), (first, self.user_id, 300)])
+            self.assertEqual(db.session.get(RuleCounter, first).bytes, 300)
+            self.assertIsNone(db.session.get(RuleCounter, 999))
+
+    def test_collection_is_claimed_once_per_interval(self):
+        with app.app_context():
+            with mock.patch.object(iptables, 'read_rule_counters', return_value={}) as read:
+                traffic.collect(iptables, now=self.NOW, min_gap=30)
+                self.assertIsNone(traffic.collect(iptables, now=self.NOW + 10, min_gap=30))
+                traffic.collect(iptables, now=self.NOW + 40, min_gap=30)
+            self.assertEqual(read.call_count, 2)
+
+    def test_counters_are_read_outside_a_transaction(self):
+        def read():
+            # The claim is committed, so other writers are not blocked
+            self.assertFalse(db.session().in_transaction())
+            return {}
+        with app.app_context():
+            with mock.patch.object(iptables, 'read_rule_counters', side_effect=read) as reader:
+                self.assertEqual(traffic.collect(iptables, now=self.NOW), 0)
+            self.assertEqual(reader.call_count, 1)
+            self.assertEqual(db.session.get(traffic.TrafficCollectorState, 1).last_run, self.NOW)
+
+    def test_downsample_rolls_up_old_minutes(self):
+        first, _ = self.rule_ids
+        old = self.NOW - traffic.MINUTE_RETENTION - 3600
+        with app.app_context():
+            db.session.add_all([
+                TrafficSample(resolution=60, bucket=old + 60 * i, user_id=self.user_id, rule_id=first,
+                              packets=1, bytes=100) for i in range(3)
+            ] + [TrafficSample(resolution=60, bucket=self.NOW, user_id=self.user_id, rule_id=first,
+                               packets=1, bytes=100),
+                 TrafficSample(resolution=3600, bucket=self.NOW - traffic.HOUR_RETENTION - 3600,
+                               user_id=self.user_id, rule_id=first, packets=1, bytes=1)])
+            db.session.commit()
+            traffic.downsample(self.NOW)
+            db.session.commit()
+            rows = {(s.resolution, s.bucket, s.bytes) for s in TrafficSample.query}
+            self.assertEqual(rows, {(3600, old, 300), (60, self.NOW, 100)})
+
+    def test_pages_show_rates(self):
+        first, _ = self.rule_ids
+        with app.app_context():
+            # 7.5 MB over the 5 minute window: 200 kbit/s
+            db.session.add(TrafficSample(resolution=60, bucket=int(time.time()) // 60 * 60,
+                                         user_id=self.user_id, rule_id=first, packets=1, bytes=7500000))
+            db.session.commit()
+        self.assertIn(b'200.0 kbit/s', self.app.get('/users').data)
+        self.assertIn(b'200.0 kbit/s', self.app.get(f'/user/{self.user_id}/rules').data)
+
+class ProductionServingTestCase(unittest.TestCase):
+    def test_sqlite_uses_wal_and_busy_timeout(self):
+        self.assertEqual(db_engine.engine_options('sqlite:///x.db', busy_timeout=7),
+                         {'connect_args': {'timeout': 7}})
+        self.assertIn('pool_size', db_engine.engine_options('mysql+mysqlconnector://u@h/db'))
+        with app.app_context():
+            with db.engine.connect() as conn:
+                self.assertEqual(conn.exec_driver_sql("PRAGMA journal_mode").scalar(), 'wal')
+
+    def test_kernel_lock_excludes_other_processes(self):
+        import fcntl
+        import subprocess
+        import tempfile
+        probe = ("import fcntl, os, sys\n"
+                 "fd = os.open(sys.argv[1], os.O_RDWR)\n"
+                 "try:\n    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)\nexcept OSError:\n    sys.exit(1)\n")
+        with tempfile.TemporaryDirectory() as tmp:
+            lock = FileLock(os.path.join(tmp, 'kernel.lock'))
+            with lock:
+                self.assertEqual(subprocess.run([sys.executable, '-c', probe, lock.path]).returncode, 1)
+            self.assertEqual(subprocess.run([sys.executable, '-c', probe, lock.path]).returncode, 0)
+
+    def test_create_app_creates_tables(self):
+        with app.app_context():
+            db.drop_all()
+        try:
+            self.assertIs(create_app(), app)
+            with app.app_context():
+                self.assertEqual(User.query.count(), 0)
+        finally:
+            with app.app_context():
+                db.session.remove()
+                db.drop_all()
+
+class RulesetHistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.8.0.1', user_network_cidr='10.8.0.0/24', is_configured=True))
+            db.session.commit()
+        config_cache.invalidate()
+        ruleset_cache.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def users(self, count, changed=None):
+        return [SimpleNamespace(id=i, ip_address=f'10.8.{i // 250}.{i % 250 + 2}', forward_mode='ROUTE', rules=[
+            SimpleNamespace(id=i * 10 + j, destination_ip=f'172.16.{i % 250}.{j + (100 if i == changed else 0)}',
+                            destination_port=443, protocol='tcp', action='ACCEPT') for j in range(3)])
+            for i in range(1, count + 1)]
+
+    def test_round_trip_and_dedup(self):
+        manager = IptablesManager()
+        first = manager.generate_iptables_file_content(self.users(500))
+        second = manager.generate_iptables_file_content(self.users(500, changed=250))
+        ipsets = {'fwm_g1': ['10.8.0.2', '10.8.0.3']}
+        with app.app_context():
+            a = ruleset_history.record('iptables', 1, first, ipsets)
+            objects = SnapshotObject.query.count()
+            b = ruleset_history.record('iptables', 2, second)
+            # Only the fragment holding user 250 (and a new manifest) is new
+            self.assertEqual(SnapshotObject.query.count(), objects + 2)
+            self.assertIs(ruleset_history.record('iptables', 3, second), b)
+            self.assertEqual(ruleset_history.load(a), (first, ipsets))
+            self.assertEqual(ruleset_history.load(b), (second, {}))
+
+    def test_objects_stored_concurrently_are_skipped(self):
+        blobs = {ruleset_history._digest(data): data for data in (b'a\n', b'b\n', b'c\n')}
+        with app.app_context():
+            ruleset_history._store_objects(dict(list(blobs.items())[:2]))
+            db.session.commit()
+            # Another agent's request stored two of them after this one looked
+            with mock.patch.object(db.session, 'query'):
+                ruleset_history._store_objects(blobs)
+            db.session.commit()
+            self.assertEqual(SnapshotObject.query.count(), 3)
+
+    def test_prune_drops_unreferenced_objects(self):
+        manager = IptablesManager()
+        with app.app_context():
+            for changed in range(1, 6):
+                ruleset_history.record('iptables', changed,
+                                       manager.generate_iptables_file_content(self.users(50, changed)), limit=2)
+            snapshots = RulesetSnapshot.query.order_by(RulesetSnapshot.id).all()
+            self.assertEqual([s.revision for s in snapshots], [4, 5])
+            for snapshot in snapshots:
+                ruleset_history.load(snapshot)
+            referenced = len(ruleset_history.split_fragments(ruleset_history.load(snapshots[1])[0]))
+            self.assertLess(SnapshotObject.query.count(), 2 * referenced + 2)
+
+    def test_apply_records_and_rollback_restores_without_regenerating(self):
+        with app.app_context():
+            user = User(username='alice', ip_address='10.8.0.2')
+            user.rules = [Rule(destination_ip='1.1.1.1', destination_port=80, protocol='tcp')]
+            db.session.add(user)
+            bump_revision(user)
+            db.session.commit()
+        with mock.patch.object(iptables, '_restore') as restore, \
+                mock.patch.object(iptables, '_load_snapshot', return_value=None), \
+                mock.patch.object(iptables, '_save_snapshot'), \
+                mock.patch.dict(app.config, {'APPLY_ASYNC': False}):
+            self.app.post('/apply')
+            with app.app_context():
+                snapshot = RulesetSnapshot.query.one()
+                applied = restore.call_args[0][0]
+            self.assertIn(b'#' + str(snapshot.id).encode(), self.app.get('/history').data)
+
+            with mock.patch.object(ruleset_cache, 'build') as build:
+                response = self.app.post(f'/history/{snapshot.id}/rollback', follow_redirects=True)
+            build.assert_not_called()
+            self.assertIn(b'Rolled back to snapshot', response.data)
+            self.assertEqual(restore.call_args[0][0], applied)
+
+class RuleAnalyzerTestCase(unittest.TestCase):
+    def rule(self, rule_id, dest, port=None, protocol='tcp', action='ACCEPT'):
+        return SimpleNamespace(id=rule_id, destination_ip=dest, destination_port=port, protocol=protocol, action=action)
+
+    def kinds(self, rules, nat=False):
+        return [(f.kind, f.rule_id, f.other_id) for f in analyze_rules(rules, nat=nat)]
+
+    def test_shadowed_redundant_duplicate(self):
+        self.assertEqual(self.kinds([
+            self.rule(1, '10.0.0.0/8', protocol='all'),
+            self.rule(2, '10.1.2.3', 22, action='DROP'),
+            self.rule(3, '10.1.0.0/16', 443),
+            self.rule(4, '10.0.0.0/8', protocol='all'),
+            self.rule(5, '192.168.1.1', 22),
+        ]), [('shadowed', 2, 1), ('redundant', 3, 1), ('duplicate', 4, 1)])
+
+    def test_earliest_cover_wins(self):
+        self.assertEqual(self.kinds([
+            self.rule(1, '10.1.2.0/24', 22, action='DROP'),
+            self.rule(2, '10.0.0.0/8', protocol='all'),
+            self.rule(3, '10.1.2.3', 22),
+        ]), [('conflict', 2, 1), ('shadowed', 3, 1)])
+
+    def test_partial_overlaps_conflict(self):
+        self.assertEqual(self.kinds([
+            self.rule(1, '192.168.1.0/24', 80),
+            self.rule(2, '192.168.1.5', protocol='all', action='DROP'),
+            self.rule(3, '192.168.0.0/16', 80, action='DROP'),
+            self.rule(4, '192.168.1.0/24', 81, action='DROP'),
+        ]), [('conflict', 2, 1), ('conflict', 3, 1)])
+
+    def test_nat_rules_never_conflict(self):
+        self.assertEqual(self.kinds([
+            self.rule(1, '10.0.0.0/8', protocol='all'),
+            self.rule(2, '10.1.2.3', 22, action='DROP'),
+        ], nat=True), [('redundant', 2, 1)])
+
+    def test_unparsable_and_ipv6_destinations(self):
+        self.assertEqual(self.kinds([
+            self.rule(1, 'host.example', 80),
+            self.rule(2, 'host.example', 80),
+            self.rule(3, '2001:db8::/32', protocol='all'),
+            self.rule(4, '2001:db8::1', 22, action='DROP'),
+            self.rule(5, '10.0.0.0/8', protocol='all', action='DROP'),
+        ]), [('duplicate', 2, 1), ('shadowed', 4, 3)])
+
+    def test_compiled_rules_use_first_rule_id(self):
+        rules = [CompiledRule('10.0.0.0/8', 'tcp', 'ACCEPT', ports=[22, 80], rule_ids=[7, 8]),
+                 CompiledRule('10.0.0.1', 'tcp', 'DROP', ports=[80], rule_ids=[9])]
+        self.assertEqual(self.kinds(rules), [('shadowed', 9, 7)])
+
+class RuleAnalysisPagesTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.8.0.1', user_network_cidr='10.8.0.0/24', is_configured=True))
+            user = User(username='alice', ip_address='10.8.0.2')
+            user.rules = [Rule(destination_ip='10.0.0.0/8', protocol='all', action='ACCEPT')]
+            db.session.add(user)
+            db.session.commit()
+            self.user_id = user.id
+        config_cache.invalidate()
+        ruleset_cache.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def add_rule(self, dest, port='', protocol='tcp', action='ACCEPT'):
+        return self.app.post('/rules/add', data={'user_id': self.user_id, 'destination_ip': dest,
+                                                 'destination_port': port, 'protocol': protocol,
+                                                 'action': action}, follow_redirects=True)
+
+    def test_add_rule_warns_and_rejects_duplicates(self):
+        response = self.add_rule('10.1.2.3', 22, action='DROP')
+        self.assertIn(b'never matches', response.data)
+        response = self.add_rule('10.0.0.0/8', protocol='all')
+        self.assertIn(b'Rule not added', response.data)
+        with app.app_context():
+            self.assertEqual(Rule.query.count(), 2)
+
+    def test_validate_lists_findings(self):
+        self.add_rule('10.1.2.3', 22, action='DROP')
+        response = self.app.get('/validate')
+        self.assertIn(b'1 shadowed', response.data)
+        self.assertIn(b'alice', response.data)
+
+class MigrationTestCase(unittest.TestCase):
+    OLD_SCHEMA = [
+        "CREATE TABLE system_config (id INTEGER PRIMARY KEY, host_ip VARCHAR(45) NOT NULL, "
+        "user_network_cidr VARCHAR(45) NOT NULL, is_configured BOOLEAN, created_at DATETIME)",
+        "CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(80) NOT NULL UNIQUE, full_name VARCHAR(120), "
+        "email VARCHAR(120), contact VARCHAR(20), user_type VARCHAR(20), ip_address VARCHAR(45) NOT NULL UNIQUE, "
+        "created_at DATETIME)",
+        "CREATE TABLE rule (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES user (id), "
+        "destination_ip VARCHAR(45) NOT NULL, destination_port INTEGER, protocol VARCHAR(10) NOT NULL, "
+        "action VARCHAR(10) NOT NULL, forward_type VARCHAR(10), created_at DATETIME)",
+        "INSERT INTO system_config (id, host_ip, user_network_cidr, is_configured) VALUES (1, '10.0.0.254', '10.0.0.0/24', 1)",
+        "INSERT INTO user (id, username, ip_address) VALUES (1, 'old', '10.0.0.2')",
+    ]
+
+    def setUp(self):
+        import tempfile
+        import sqlalchemy as sa
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engine = sa.create_engine(f"sqlite:///{os.path.join(self.tmp.name, 'old.db')}")
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp.cleanup()
+
+    def create_old_schema(self, rules=3):
+        with self.engine.begin() as conn:
+            for statement in self.OLD_SCHEMA:
+                conn.exec_driver_sql(statement)
+            for i in range(1, rules + 1):
+                conn.exec_driver_sql(f"INSERT INTO rule (id, user_id, destination_ip, destination_port, protocol, "
+                                     f"action, forward_type) VALUES ({i}, 1, '172.16.0.{i}', 443, 'tcp', 'ACCEPT', 'ROUTE')")
+
+    def test_upgrades_old_database_once(self):
+        import sqlalchemy as sa
+        self.create_old_schema()
+        self.assertEqual(db_migration.upgrade(self.engine), [1, 2, 3, 4, 5, 6, 7, 8])
+        columns = lambda table: {c['name'] for c in sa.inspect(self.engine).get_columns(table)}
+        self.assertTrue({'forward_mode', 'revision'} <= columns('user'))
+        self.assertIn('version', columns('system_config'))
+        self.assertNotIn('forward_type', columns('rule'))
+        self.assertIn('ix_rule_user_id_id', {i['name'] for i in sa.inspect(self.engine).get_indexes('rule')})
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql("SELECT forward_mode, revision FROM user").one(), ('ROUTE', 1))
+            self.assertEqual(conn.exec_driver_sql("SELECT COUNT(*) FROM rule").scalar(), 3)
+        self.assertEqual(db_migration.upgrade(self.engine), [])
+
+    def test_reservations_are_dropped_and_the_pool_rebuilt(self):
+        import sqlalchemy as sa
+        self.create_old_schema()
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql("CREATE TABLE ip_reservation (ip BIGINT PRIMARY KEY, token VARCHAR(32))")
+        db.metadata.create_all(self.engine)
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql("INSERT INTO ip_pool (id, network_cidr) VALUES (1, '10.8.0.0/24')")
+        db_migration.upgrade(self.engine)
+        self.assertFalse(sa.inspect(self.engine).has_table('ip_reservation'))
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql("SELECT COUNT(*) FROM ip_pool").scalar(), 0)
+
+    def test_fresh_database_records_every_version(self):
+        self.assertEqual(db_migration.upgrade(self.engine), [1, 2, 3, 4, 5, 6, 7, 8])
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql("SELECT COUNT(*) FROM schema_migration").scalar(), 8)
+
+    def test_interrupted_rebuild_resumes_from_checkpoint(self):
+        self.create_old_schema(rules=10)
+        db.metadata.create_all(self.engine)
+        real_copy = db_migration.copy_table
+        batches = []
+
+        def flaky_copy(engine, version, source, target, columns, batch_size):
+            # Fail once the first batch is committed
+            original = engine.begin
+
+            def begin():
+                if batches:
+                    raise RuntimeError("interrupted")
+                batches.append(1)
+                return original()
+            with mock.patch.object(engine, 'begin', begin):
+                return real_copy(engine, version, source, target, columns, batch_size)
+
+        with mock.patch.object(db_migration, 'copy_table', flaky_copy):
+            with self.assertRaises(RuntimeError):
+                db_migration.rebuild_table(self.engine, 4, Rule, batch_size=4)
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql("SELECT last_id FROM migration_checkpoint").scalar(), 4)
+            self.assertEqual(conn.exec_driver_sql("SELECT COUNT(*) FROM rule_new").scalar(), 4)
+
+        db_migration.rebuild_table(self.engine, 4, Rule, batch_size=4)
+        with self.engine.connect() as conn:
+            self.assertEqual([i for (i,) in conn.exec_driver_sql("SELECT id FROM rule ORDER BY id")],
+                             list(range(1, 11)))
+
+    def test_rebuild_keeps_rows_updated_during_the_copy(self):
+        self.create_old_schema(rules=10)
+        db.metadata.create_all(self.engine)
+        real_copy = db_migration.copy_table
+
+        def copy_then_write(engine, version, source, target, columns, batch_size):
+            copied = real_copy(engine, version, source, target, columns, batch_size)
+            # Writes after their batch was copied, before the swap
+            with engine.begin() as conn:
+                conn.exec_driver_sql("UPDATE rule SET destination_ip = '192.0.2.1' WHERE id = 2")
+                conn.exec_driver_sql("UPDATE rule SET destination_port = NULL WHERE id = 5")
+                conn.exec_driver_sql("DELETE FROM rule WHERE id = 7")
+                conn.exec_driver_sql("INSERT INTO rule (id, user_id, destination_ip, protocol, action, forward_type) "
+                                     "VALUES (11, 1, '172.16.0.11', 'all', 'DROP', 'ROUTE')")
+            return copied
+
+        with mock.patch.object(db_migration, 'copy_table', copy_then_write):
+            db_migration.rebuild_table(self.engine, 4, Rule, batch_size=4)
+        with self.engine.connect() as conn:
+            rows = {r[0]: r[1:] for r in conn.exec_driver_sql(
+                "SELECT id, destination_ip, destination_port FROM rule")}
+        self.assertEqual(sorted(rows), [1, 2, 3, 4, 5, 6, 8, 9, 10, 11])
+        self.assertEqual(rows[2], ('192.0.2.1', 443))
+        self.assertEqual(rows[5], ('172.16.0.5', None))
+        self.assertEqual(rows[3], ('172.16.0.3', 443))
+
+class SystemProbeTestCase(unittest.TestCase):
+    ROUTE = ("Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT\n"
+             "wlan0\t00000000\t0101A8C0\t0003\t0\t0\t600\t00000000\t0\t0\t0\n"
+             "eth0\t00000000\t0100000A\t0003\t0\t0\t100\t00000000\t0\t0\t0\n"
+             "eth0\t0000000A\t00000000\t0001\t0\t0\t100\t00FFFFFF\t0\t0\t0\n")
+    IF_INET6 = ("00000000000000000000000000000001 01 80 10 80       lo\n"
+                "fe800000000000000000000000000001 02 40 20 80     eth0\n"
+                "fd000000000000000000000000000002 02 40 00 80     eth0\n")
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.0.0.254', user_network_cidr='10.0.0.0/24', is_configured=True))
+            db.session.commit()
+        config_cache.invalidate()
+        system_probe.invalidate()
+
+    def tearDown(self):
+        system_probe.invalidate()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def fake_result(self, host_ip='10.0.0.1'):
+        tools = {name: None for name in system_probe_module.TOOLS}
+        tools['nft'] = '/usr/sbin/nft'
+        return system_probe_module.ProbeResult(
+            host_ip=host_ip, default_interface='eth0', interfaces=[], tools=tools, iptables_variant=None,
+            backends=system_probe_module.detect_backends(tools, None), probed_at=time.time())
+
+    def test_proc_parsers(self):
+        self.assertEqual(system_probe_module.parse_default_route(self.ROUTE), 'eth0')
+        self.assertEqual(system_probe_module.parse_if_inet6(self.IF_INET6),
+                         [system_probe_module.Interface('eth0', 'fd00::2', 64)])
+        Interface = system_probe_module.Interface
+        interfaces = [Interface('lo', '127.0.0.1', 8), Interface('wlan0', '192.168.1.5', 24),
+                      Interface('eth0', '10.0.0.7', 8)]
+        self.assertEqual(system_probe_module.pick_host_ip(interfaces, 'eth0'), '10.0.0.7')
+        self.assertEqual(system_probe_module.pick_host_ip(interfaces, None), '192.168.1.5')
+
+    def test_backend_detection(self):
+        tools = {'iptables': '/usr/sbin/iptables', 'ipset': '/usr/sbin/ipset'}
+        self.assertEqual(system_probe_module.detect_backends(tools, 'nf_tables'),
+                         {'iptables-legacy': False, 'iptables-nft': True, 'nft': False, 'ipset': True})
+
+    def test_page_loads_use_cached_probe(self):
+        with mock.patch.object(system_probe_module, 'probe', return_value=self.fake_result()) as probe:
+            system_probe.refresh()
+            with mock.patch('shutil.which', side_effect=AssertionError("PATH scan")), \
+                    mock.patch('socket.socket', side_effect=AssertionError("socket")):
+                self.assertEqual(self.client.get('/').status_code, 200)
+                self.assertIn(b'value="10.0.0.1"', self.client.get('/setup').data)
+        self.assertEqual(probe.call_count, 1)
+
+    def test_stale_probe_refreshes_in_background(self):
+        system_probe.ttl = 0
+        try:
+            with mock.patch.object(system_probe_module, 'probe', side_effect=[self.fake_result('10.0.0.1'),
+                                                                               self.fake_result('10.0.0.2')]):
+                system_probe.refresh()
+                self.assertEqual(system_probe.get().host_ip, '10.0.0.1')
+                for _ in range(100):
+                    if system_probe.get().host_ip == '10.0.0.2':
+                        break
+                    time.sleep(0.01)
+                self.assertEqual(system_probe.get().host_ip, '10.0.0.2')
+        finally:
+            system_probe.ttl = app.config['SYSTEM_PROBE_TTL']
+
+    def test_refresh_endpoint_reruns_probes(self):
+        with mock.patch.object(system_probe_module, 'probe', return_value=self.fake_result('10.0.0.9')) as probe:
+            response = self.client.post('/system/refresh', follow_redirects=True)
+        self.assertEqual(probe.call_count, 1)
+        self.assertIn(b'host IP 10.0.0.9, available: nft', response.data)
+
+class ClientTransport:
+    """
+    gateway_agent transport over the Flask test client.
+    """
+    def __init__(self, client, token):
+        self.client = client
+        self.token = token
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {}, Authorization=f'Bearer {self.token}')
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.headers, response.get_json(silent=True)
+
+class RecordingBackend:
+    def __init__(self):
+        self.applied = []
+
+    def apply_compiled(self, content, ipsets=None, incremental=False, revision=None):
+        self.applied.append((content, revision))
+        return {'mode': 'full' if len(self.applied) == 1 else 'incremental', 'added': 0, 'removed': 0}
+
+class GatewayDistributionTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.tmp = tempfile.TemporaryDirectory()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.0.0.254', user_network_cidr='10.0.0.0/24', is_configured=True))
+            db.session.commit()
+        config_cache.invalidate()
+        ruleset_cache.clear()
+        gateway_rulesets.clear()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def add_gateway(self, name):
+        token = gateways.new_token()
+        gateway = Gateway(name=name, token_hash=gateways.hash_token(token))
+        db.session.add(gateway)
+        db.session.flush()
+        return gateway, token
+
+    def add_user(self, name, ip, gateway=None):
+        user = User(username=name, ip_address=ip, gateway_id=gateway.id if gateway else None)
+        user.rules = [Rule(destination_ip='172.16.0.10', destination_port=443, protocol='tcp', action='ACCEPT')]
+        db.session.add(user)
+        bump_revision(user)
+        return user
+
+    def agent(self, token, name):
+        agent = GatewayAgent(ClientTransport(self.client, token), os.path.join(self.tmp.name, name))
+        agent._backends['iptables'] = RecordingBackend()
+        return agent
+
+    def test_agents_receive_only_their_users(self):
+        with app.app_context():
+            gw1, token1 = self.add_gateway('gw1')
+            gw2, token2 = self.add_gateway('gw2')
+            self.add_user('local', '10.0.0.2')
+            self.add_user('a', '10.0.0.3', gw1)
+            self.add_user('b', '10.0.0.4', gw2)
+            db.session.commit()
+            gw1_id = gw1.id
+
+        agent1 = self.agent(token1, 'gw1')
+        summary = agent1.sync()
+        content = agent1._backends['iptables'].applied[0][0]
+        self.assertIn('-s 10.0.0.3 ', content)
+        self.assertNotIn('10.0.0.2 ', content)
+        self.assertNotIn('10.0.0.4 ', content)
+        with app.app_context():
+            _, local, _, _ = ruleset_cache.build(iptables)
+            self.assertIn('-s 10.0.0.2 ', local)
+            self.assertNotIn('10.0.0.3 ', local)
+            gateway = db.session.get(Gateway, gw1_id)
+            self.assertEqual(gateway.applied_revision, summary['revision'])
+            self.assertEqual(gateway.apply_mode, 'full')
+            self.assertIsNotNone(gateway.apply_ms)
+
+    def test_unchanged_poll_is_not_modified_and_changes_fetch_deltas(self):
+        with app.app_context():
+            gw, token = self.add_gateway('gw')
+            other, _ = self.add_gateway('other')
+            for i in range(40):
+                self.add_user(f'u{i}', f'10.0.1.{i + 1}', gw)
+            self.add_user('elsewhere', '10.0.2.1', other)
+            db.session.commit()
+
+        first = self.agent(token, 'gw').sync()
+        self.assertEqual(first['fetched'], first['total'])
+        # A restarted agent keeps its fragments, but re-applies them once in
+        # case the kernel lost its rules
+        agent = self.agent(token, 'gw')
+        restarted = agent.sync()
+        self.assertEqual((restarted['revision'], restarted['fetched']), (first['revision'], 0))
+        self.assertEqual(len(agent._backends['iptables'].applied), 1)
+        self.assertIsNone(agent.sync())
+
+        with app.app_context():
+            # Changes to another gateway's users do not reach this one
+            elsewhere = User.query.filter_by(username='elsewhere').one()
+            db.session.add(Rule(user_id=elsewhere.id, destination_ip='192.0.2.1', protocol='all', action='DROP'))
+            bump_revision(elsewhere)
+            db.session.commit()
+        self.assertIsNone(agent.sync())
+
+        with app.app_context():
+            user = User.query.filter_by(username='u7').one()
+            db.session.add(Rule(user_id=user.id, destination_ip='192.0.2.1', protocol='all', action='DROP'))
+            bump_revision(user)
+            db.session.commit()
+        summary = agent.sync()
+        self.assertEqual(summary['fetched'], 1)
+        self.assertIn('-s 10.0.1.8 -d 192.0.2.1', agent._backends['iptables'].applied[-1][0])
+
+    def test_agent_endpoints_require_token_and_own_objects(self):
+        with app.app_context():
+            gw, token = self.add_gateway('gw')
+            self.add_user('a', '10.0.0.3', gw)
+            db.session.commit()
+        self.assertEqual(self.client.get('/agent/manifest').status_code, 401)
+        self.assertEqual(self.client.get('/agent/manifest', headers={'Authorization': 'Bearer nope'}).status_code, 401)
+        response = self.client.post('/agent/objects', json={'digests': ['0' * 64]},
+                                    headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 409)
+
+    def test_gateways_page_adds_and_deletes(self):
+        response = self.client.post('/gateways', data={'name': 'edge-1', 'backend': 'nftables'},
+                                    follow_redirects=True)
+        self.assertIn(b'Agent token (shown only once)', response.data)
+        with app.app_context():
+            gateway = Gateway.query.filter_by(name='edge-1').one()
+            user = self.add_user('a', '10.0.0.3', gateway)
+            db.session.commit()
+            gateway_id, user_id = gateway.id, user.id
+        self.assertIn(b'edge-1', self.client.get('/gateways').data)
+        self.client.post(f'/gateways/{gateway_id}/delete')
+        with app.app_context():
+            self.assertIsNone(db.session.get(User, user_id).gateway_id)
+
+    def test_harness_agents_apply_with_stub_binaries(self):
+        import agent_harness
+        with app.app_context():
+            db.session.remove()
+        created = agent_harness.setup_gateways(app, self.tmp.name, agents=2, users=6, rules=2)
+        agents = [(token, directory) for _, token, directory in created]
+        with agent_harness.Portal(app) as portal:
+            summaries = agent_harness.run_agents(portal.url, agents)
+            self.assertEqual([s['mode'] for s in summaries], ['full', 'full'])
+            # Each --once run is a fresh agent: it re-applies from its cache,
+            # which the backend finds already loaded
+            self.assertEqual([(s['mode'], s['fetched']) for s in agent_harness.run_agents(portal.url, agents)],
+                             [('noop', 0), ('noop', 0)])
+        first, second = (agent_harness.restored(directory) for _, directory in agents)
+        self.assertIn('-s 10.64.0.0 ', first)
+        self.assertNotIn('-s 10.64.0.1 ', first)
+        self.assertIn('-s 10.64.0.1 ', second)
+        with app.app_context():
+            self.assertEqual({g.applied_revision for g in Gateway.query}, {summaries[0]['revision']})
+
+class RuleScheduleTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.0.0.254', user_network_cidr='10.0.0.0/24', is_configured=True))
+            db.session.commit()
+        config_cache.invalidate()
+        ruleset_cache.clear()
+        self.now = datetime.utcnow().replace(microsecond=0)
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def add_user(self, name, ip, **window):
+        user = User(username=name, ip_address=ip, **window)
+        db.session.add(user)
+        db.session.flush()
+        bump_revision(user)
+        return user
+
+    def add_rule(self, user, destination, **window):
+        rule = Rule(user_id=user.id, destination_ip=destination, protocol='all', action='ACCEPT', **window)
+        db.session.add(rule)
+        bump_revision(user)
+        return rule
+
+    def test_compile_skips_rules_and_users_outside_their_window(self):
+        hour = timedelta(hours=1)
+        with app.app_context():
+            user = self.add_user('u', '10.0.0.2')
+            self.add_rule(user, '192.0.2.1')
+            self.add_rule(user, '192.0.2.2', valid_from=self.now + hour)
+            self.add_rule(user, '192.0.2.3', expires_at=self.now - hour)
+            self.add_rule(user, '192.0.2.4', valid_from=self.now - hour, expires_at=self.now + hour)
+            later = self.add_user('later', '10.0.0.3', valid_from=self.now + hour)
+            self.add_rule(later, '192.0.2.5')
+            db.session.commit()
+            _, content, _, _ = ruleset_cache.build(iptables)
+        self.assertIn('-d 192.0.2.1 ', content)
+        self.assertIn('-d 192.0.2.4 ', content)
+        self.assertNotIn('192.0.2.2', content)
+        self.assertNotIn('192.0.2.3', content)
+        self.assertNotIn('10.0.0.3', content)
+
+    def test_process_due_bumps_only_affected_users_once(self):
+        minute = timedelta(minutes=1)
+        with app.app_context():
+            rule_schedule.process_due(self.now)
+            starting = self.add_user('starting', '10.0.0.2')
+            rule = self.add_rule(starting, '192.0.2.1', valid_from=self.now + minute)
+            idle = self.add_user('idle', '10.0.0.3')
+            self.add_rule(idle, '192.0.2.2', expires_at=self.now + timedelta(days=1))
+            db.session.commit()
+            _, before, _, _ = ruleset_cache.build(iptables)
+            self.assertNotIn('192.0.2.1', before)
+            idle_revision = db.session.get(User, idle.id).revision
+
+            self.assertEqual(rule_schedule.process_due(self.now + 2 * minute), {starting.id})
+            self.assertEqual(rule_schedule.process_due(self.now + 2 * minute), set())
+            self.assertEqual(db.session.get(User, idle.id).revision, idle_revision)
+            with mock.patch('ruleset_cache.datetime') as clock:
+                clock.utcnow.return_value = self.now + 2 * minute
+                _, after, _, _ = ruleset_cache.build(iptables)
+            self.assertIn('-d 192.0.2.1 ', after)
+            self.assertEqual(rule_schedule.upcoming(self.now), [rule.valid_from, self.now + timedelta(days=1)])
+
+    def test_window_apply_leaves_other_edits_pending(self):
+        minute = timedelta(minutes=1)
+        with tempfile.TemporaryDirectory() as tmp, app.app_context(), \
+                mock.patch.object(iptables, 'snapshot_path', os.path.join(tmp, 'snapshot.json')), \
+                mock.patch.object(IptablesManager, '_restore') as restore, \
+                mock.patch.object(IptablesManager, '_read_kernel_chains', return_value={'filter': {}}):
+            rule_schedule.process_due(self.now)
+            starting = self.add_user('starting', '10.0.0.2')
+            self.add_rule(starting, '192.0.2.1', valid_from=self.now + minute)
+            other = self.add_user('other', '10.0.0.3')
+            self.add_rule(other, '192.0.2.2')
+            db.session.commit()
+            run_apply()
+            # Saved but not applied yet
+            self.add_rule(db.session.get(User, other.id), '192.0.2.3')
+            db.session.commit()
+
+            with mock.patch('ruleset_cache.datetime') as clock:
+                clock.utcnow.return_value = self.now + 2 * minute
+                user_ids = rule_schedule.process_due(self.now + 2 * minute)
+                schedule_apply(user_ids)
+            delta = restore.call_args[0][0]
+            applied = {user.id: [rule.destination_ip for rule in user.rules] for user in iptables.applied_users()}
+            self.assertEqual(user_ids, {starting.id})
+            self.assertEqual(applied, {starting.id: ['192.0.2.1'], other.id: ['192.0.2.2']})
+        self.assertIn('-d 192.0.2.1 ', delta)
+        self.assertNotIn('192.0.2.2', delta)
+        self.assertNotIn('192.0.2.3', delta)
+
+    def test_window_apply_waits_for_a_first_apply(self):
+        with tempfile.TemporaryDirectory() as tmp, app.app_context(), \
+                mock.patch.object(iptables, 'snapshot_path', os.path.join(tmp, 'snapshot.json')), \
+                mock.patch.object(IptablesManager, '_restore') as restore:
+            user = self.add_user('u', '10.0.0.2')
+            self.add_rule(user, '192.0.2.1')
+            db.session.commit()
+            schedule_apply({user.id})
+        restore.assert_not_called()
+
+    def test_scheduler_heap_orders_boundaries(self):
+        scheduler = rule_schedule.RuleScheduler(app)
+        soon, later = self.now + timedelta(minutes=5), self.now + timedelta(hours=5)
+        scheduler.schedule(later, None, self.now - timedelta(minutes=5))
+        self.assertEqual(scheduler.next_boundary(), later)
+        scheduler.schedule(soon)
+        self.assertEqual(scheduler.next_boundary(), soon)
+        self.assertTrue(scheduler._wake.is_set())
+        self.assertLessEqual(scheduler._sleep_seconds(), 300)
+
+    def test_purge_expired_deletes_in_batches_and_releases_addresses(self):
+        old = self.now - timedelta(days=30)
+        with app.app_context():
+            config = config_cache.get()
+            keeper = self.add_user('keeper', '10.0.0.2')
+            kept = self.add_rule(keeper, '192.0.2.1', expires_at=self.now - timedelta(days=1))
+            for i in range(5):
+                self.add_rule(keeper, f'192.0.2.{10 + i}', expires_at=old)
+            gone = self.add_user('gone', '10.0.0.3', expires_at=old)
+            ip_pool.claim_ip(config, '10.0.0.3')
+            self.add_rule(gone, '192.0.2.50')
+            db.session.commit()
+            keeper_id, kept_id, gone_id = keeper.id, kept.id, gone.id
+
+            log = mock.Mock()
+            with mock.patch.object(rule_schedule, 'BATCH_SIZE', 2):
+                self.assertEqual(rule_schedule.purge_expired(config, self.now, audit_log=log), (6, 1))
+            (rules_call, users_call) = log.record_many.call_args_list
+            self.assertEqual(rules_call.args[0], 'rule.delete')
+            self.assertEqual(len(rules_call.args[1]), 6)
+            self.assertEqual(users_call.args[:2], ('user.delete', [{'user_id': gone_id, 'rule_id': None, 'changes': mock.ANY}]))
+            self.assertEqual(users_call.args[1][0]['changes']['ip_address'], ['10.0.0.3', None])
+            self.assertEqual([r.id for r in Rule.query], [kept_id])
+            self.assertEqual([u.id for u in User.query], [keeper_id])
+            self.assertTrue(ip_pool.claim_ip(config, '10.0.0.3'))
+            self.assertEqual(rule_schedule.purge_expired(config, self.now), (0, 0))
+
+    def test_purge_merges_addresses_into_a_pool_built_first(self):
+        old = self.now - timedelta(days=30)
+        with app.app_context():
+            config = config_cache.get()
+            self.add_user('keeper', '10.0.0.2')
+            self.add_user('gone', '10.0.0.3', expires_at=old)
+            self.add_user('gone too', '10.0.0.5', expires_at=old)
+            db.session.commit()
+            self.assertEqual(IpFreeRange.query.count(), 0)
+            statements = []
+            record = lambda conn, cursor, statement, *args: statements.append(statement)
+            commit = lambda conn: statements.append('COMMIT')
+            event.listen(db.engine, 'before_cursor_execute', record)
+            event.listen(db.engine, 'commit', commit)
+            try:
+                self.assertEqual(rule_schedule.purge_expired(config, self.now), (0, 2))
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+                event.remove(db.engine, 'commit', commit)
+            first_delete = next(i for i, s in enumerate(statements) if s.startswith('DELETE FROM user'))
+            self.assertEqual(statements[first_delete:].count('COMMIT'), 1)
+            ranges = [(str(ipaddress.ip_address(r.start)), str(ipaddress.ip_address(r.end)))
+                      for r in IpFreeRange.query.order_by(IpFreeRange.start)]
+        self.assertEqual(ranges, [('10.0.0.1', '10.0.0.1'), ('10.0.0.3', '10.0.0.253')])
+
+    def test_nothing_is_purged_before_setup(self):
+        old = self.now - timedelta(days=30)
+        with app.app_context():
+            self.add_user('gone', '10.0.0.3', expires_at=old)
+            db.session.commit()
+            self.assertEqual(rule_schedule.purge_expired(None, self.now), (0, 0))
+            rule_schedule.RuleScheduler(app, config=lambda: None).run_once(self.now)
+            self.assertEqual(User.query.count(), 1)
+
+    def test_add_rule_form_accepts_and_validates_window(self):
+        with app.app_context():
+            user = self.add_user('u', '10.0.0.2')
+            db.session.commit()
+            user_id = user.id
+        self.client.post('/rules/add', data={'user_id': user_id, 'destination_ip': '192.0.2.1', 'protocol': 'tcp',
+                                             'action': 'ACCEPT', 'expires_at': '2099-01-01T10:30'})
+        response = self.client.post('/rules/add', data={
+            'user_id': user_id, 'destination_ip': '192.0.2.2', 'protocol': 'tcp', 'action': 'ACCEPT',
+            'valid_from': '2099-01-02T00:00', 'expires_at': '2099-01-01T00:00'}, follow_redirects=True)
+        self.assertIn(b'invalid validity window', response.data)
+        with app.app_context():
+            self.assertEqual([(r.destination_ip, r.expires_at) for r in Rule.query],
+                             [('192.0.2.1', datetime(2099, 1, 1, 10, 30))])
+        self.assertIn(b'until 2099-01-01 10:30', self.client.get(f'/user/{user_id}/rules').data)
+
+
+class RestApiTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.0.0.254', user_network_cidr='10.0.0.0/24', is_configured=True))
+            for i in range(5):
+                user = User(username=f'u{i}', ip_address=f'10.0.0.{i + 1}', email=f'u{i}@example.com')
+                user.rules = [Rule(destination_ip=f'192.0.2.{i}', destination_port=443, protocol='tcp',
+                                   action='ACCEPT')]
+                db.session.add(user)
+            bump_revision()
+            db.session.commit()
+        config_cache.invalidate()
+        revision_cache.invalidate()
+        ruleset_cache.clear()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def count_queries(self, method, url, **kwargs):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+            try:
+                response = getattr(self.client, method)(url, **kwargs)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return response, statements
+
+    def test_cursor_pagination_and_field_selection(self):
+        first = self.client.get('/api/v1/users?limit=2&fields=username').get_json()
+        self.assertEqual(first['items'], [{'id': 1, 'username': 'u0'}, {'id': 2, 'username': 'u1'}])
+        second = self.client.get(f"/api/v1/users?limit=2&fields=username&after={first['next']}").get_json()
+        third = self.client.get(f"/api/v1/users?limit=2&fields=username&after={second['next']}").get_json()
+        self.assertEqual([u['username'] for u in second['items'] + third['items']], ['u2', 'u3', 'u4'])
+        self.assertIsNone(third['next'])
+
+        rules = self.client.get('/api/v1/rules?user_id=3').get_json()['items']
+        self.assertEqual([(r['user_id'], r['destination_ip']) for r in rules], [(3, '192.0.2.2')])
+        response = self.client.get('/api/v1/users?fields=username,password')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('password', response.get_json()['error'])
+
+    def test_matching_etag_is_answered_without_queries(self):
+        response = self.client.get('/api/v1/users')
+        tag = response.headers['ETag']
+        response, statements = self.count_queries('get', '/api/v1/users', headers={'If-None-Match': tag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(statements, [])
+        # Another query string is another representation
+        self.assertNotEqual(self.client.get('/api/v1/users?limit=2').headers['ETag'], tag)
+
+        with app.app_context():
+            user = db.session.get(User, 1)
+            user.email = 'changed@example.com'
+            bump_revision(user)
+            db.session.commit()
+        response = self.client.get('/api/v1/users', headers={'If-None-Match': tag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['items'][0]['email'], 'changed@example.com')
+
+    def test_ndjson_streams_whole_collection(self):
+        response = self.client.get('/api/v1/rules?fields=destination_ip',
+                                   headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([r['destination_ip'] for r in lines], [f'192.0.2.{i}' for i in range(5)])
+        self.assertNotEqual(response.headers['ETag'], self.client.get('/api/v1/rules?fields=destination_ip').headers['ETag'])
+
+    def test_item_config_and_ruleset(self):
+        user = self.client.get('/api/v1/users/2').get_json()
+        self.assertEqual((user['username'], user['ip_address']), ('u1', '10.0.0.2'))
+        self.assertEqual(self.client.get('/api/v1/rules/99').status_code, 404)
+
+        response = self.client.get('/api/v1/config')
+        self.assertEqual(response.get_json()['user_network_cidr'], '10.0.0.0/24')
+        self.assertEqual(self.client.get('/api/v1/config',
+                                         headers={'If-None-Match': response.headers['ETag']}).status_code, 304)
+
+        ruleset = self.client.get('/api/v1/ruleset')
+        body = ruleset.get_json()
+        self.assertEqual(body['backend'], iptables.name)
+        self.assertIn('-d 192.0.2.4', body['content'])
+        self.assertEqual(self.client.get('/api/v1/ruleset',
+                                         headers={'If-None-Match': ruleset.headers['ETag']}).status_code, 304)
+
+
+class DriftTestCase(unittest.TestCase):
+    APPLIED = (
+        "*filter\n"
+        ":FWM_U_1 - [0:0]\n"
+        "-F FORWARD\n"
+        "-F INPUT\n"
+        "-A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT\n"
+        "-A FORWARD -s 10.0.0.2 -j FWM_U_1\n"
+        "-A FWM_U_1 -d 1.1.1.1 -p tcp --dport 443 -m comment --comment fwm:r1 -j ACCEPT\n"
+        "-A FWM_U_1 -d 2.2.2.0/24 -m comment --comment fwm:r2 -j DROP\n"
+        "COMMIT\n"
+        "*nat\n"
+        "-F POSTROUTING\n"
+        "COMMIT\n"
+    )
+    # How the kernel lists APPLIED
+    SAVED = (
+        "# Generated by iptables-save\n"
+        "*filter\n"
+        ":INPUT ACCEPT [0:0]\n"
+        ":FORWARD ACCEPT [0:0]\n"
+        ":OUTPUT ACCEPT [0:0]\n"
+        ":DOCKER - [0:0]\n"
+        ":FWM_U_1 - [0:0]\n"
+        "-A INPUT -m conntrack --ctstate RELATED,ESTABLISHED -j ACCEPT\n"
+        "-A FORWARD -s 10.0.0.2/32 -j FWM_U_1\n"
+        "-A DOCKER -j RETURN\n"
+        "-A FWM_U_1 -d 1.1.1.1/32 -p tcp -m tcp --dport 443 -m comment --comment \"fwm:r1\" -j ACCEPT\n"
+        "-A FWM_U_1 -d 2.2.2.0/24 -m comment --comment fwm:r2 -j DROP\n"
+        "COMMIT\n"
+        "*nat\n"
+        ":POSTROUTING ACCEPT [0:0]\n"
+        "COMMIT\n"
+    )
+
+    def test_kernel_rendering_normalizes_to_generated_spec(self):
+        self.assertEqual(
+            drift.normalize_spec('-d 1.1.1.1 -p tcp --dport 443 -m comment --comment fwm:r1 -j ACCEPT'),
+            drift.normalize_spec('-d 1.1.1.1/32 -p tcp -m tcp --dport 443 -m comment --comment "fwm:r1" -j ACCEPT'))
+        self.assertNotEqual(drift.normalize_spec('-d 1.1.1.1 -j ACCEPT'), drift.normalize_spec('! -d 1.1.1.1 -j ACCEPT'))
+        report = drift.compare(parse_restore_content(self.APPLIED), drift.parse_save(self.SAVED))
+        self.assertEqual(report, drift.DriftReport(0, 0, []))
+
+    def test_compare_reports_only_our_differing_chains(self):
+        saved = self.SAVED.replace('-A FWM_U_1 -d 2.2.2.0/24 -m comment --comment fwm:r2 -j DROP\n', '') \
+            .replace(':FWM_U_1 - [0:0]\n', ':FWM_U_1 - [0:0]\n:FWM_U_9 - [0:0]\n') \
+            .replace('-A DOCKER -j RETURN\n', '-A DOCKER -j DROP\n-A FORWARD -j ACCEPT\n-A FWM_U_9 -j DROP\n')
+        applied = parse_restore_content(self.APPLIED)
+        report = drift.compare(applied, drift.parse_save(saved))
+        self.assertEqual(report.missing, 1)
+        self.assertEqual(report.extra, 2)
+        self.assertEqual(report.chains, [('filter', 'FORWARD'), ('filter', 'FWM_U_1'), ('filter', 'FWM_U_9')])
+
+        content = drift.repair_content(applied, report.chains)
+        self.assertEqual(content, (
+            "*filter\n"
+            "-F FORWARD\n"
+            ":FWM_U_1 - [0:0]\n"
+            "-A FORWARD -s 10.0.0.2 -j FWM_U_1\n"
+            "-A FWM_U_1 -d 1.1.1.1 -p tcp --dport 443 -m comment --comment fwm:r1 -j ACCEPT\n"
+            "-A FWM_U_1 -d 2.2.2.0/24 -m comment --comment fwm:r2 -j DROP\n"
+            "-F FWM_U_9\n"
+            "-X FWM_U_9\n"
+            "COMMIT\n"))
+
+        reordered = self.SAVED.replace(
+            '-A FWM_U_1 -d 1.1.1.1/32 -p tcp -m tcp --dport 443 -m comment --comment "fwm:r1" -j ACCEPT\n'
+            '-A FWM_U_1 -d 2.2.2.0/24 -m comment --comment fwm:r2 -j DROP\n',
+            '-A FWM_U_1 -d 2.2.2.0/24 -m comment --comment fwm:r2 -j DROP\n'
+            '-A FWM_U_1 -d 1.1.1.1/32 -p tcp -m tcp --dport 443 -m comment --comment "fwm:r1" -j ACCEPT\n')
+        self.assertEqual(drift.compare(applied, drift.parse_save(reordered)),
+                         drift.DriftReport(0, 0, [('filter', 'FWM_U_1')]))
+
+    def test_iptables_check_and_repair_use_the_applied_snapshot(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            manager = IptablesManager(snapshot_path=os.path.join(tmp, 'snapshot.json'))
+            self.assertIsNone(manager.check_drift())
+            with mock.patch.object(manager, '_restore') as restore, \
+                    mock.patch.object(manager, '_read_kernel_chains', return_value={'filter': {}}):
+                manager.apply_compiled(self.APPLIED, revision=3)
+                saved = self.SAVED.replace('-A FORWARD -s 10.0.0.2/32 -j FWM_U_1\n', '')
+                with mock.patch('iptables_manager.subprocess.run',
+                                return_value=SimpleNamespace(stdout=saved.encode())) as run:
+                    report = manager.check_drift()
+                run.assert_called_once()
+                self.assertEqual(run.call_args[0][0], ['iptables-save'])
+                self.assertEqual(report, drift.DriftReport(1, 0, [('filter', 'FORWARD')]))
+                self.assertEqual(manager.repair_drift(report), 1)
+                restore.assert_called_with("*filter\n-F FORWARD\n-A FORWARD -s 10.0.0.2 -j FWM_U_1\nCOMMIT\n")
+            self.assertEqual(manager._load_snapshot()['revision'], 3)
+
+    def test_nftables_listing_compared_per_chain(self):
+        applied = ("table ip firewall_manager {\n\tchain forward {\n\t\tip saddr vmap @fwd_users\n\t}\n"
+                   "\tchain user_1 {\n\t\tip daddr 1.1.1.1 counter accept comment \"fwm:r1\"\n\t}\n}\n")
+        edited = applied.replace('\t\tip daddr 1.1.1.1', '\t\tip daddr 9.9.9.9 drop\n\t\tip daddr 1.1.1.1')
+        self.assertEqual(drift.compare_listings(applied, applied, 'ip firewall_manager').chains, [])
+        self.assertEqual(drift.compare_listings(applied, edited, 'ip firewall_manager'),
+                         drift.DriftReport(0, 1, [('ip firewall_manager', 'user_1')]))
+
+    def test_checker_repairs_and_exports_metrics(self):
+        backend = mock.Mock()
+        backend.name = 'iptables'
+        backend.check_drift.side_effect = [drift.DriftReport(2, 1, [('filter', 'FORWARD')]), drift.DriftReport(0, 0, [])]
+        backend.repair_drift.return_value = 1
+        checker = drift.DriftChecker(app, backend, mock.MagicMock(), interval=0, repair=True)
+        report, repaired = checker.check()
+        self.assertEqual((report.chains, repaired), ([], 1))
+        backend.repair_drift.assert_called_once()
+        self.assertIn('fwm_ruleset_drift_chains{backend="iptables"} 0', metrics.DRIFT_CHAINS.render())
+        self.assertEqual(checker.last[1], report)
+
+
+class AuditLogTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with app.app_context():
+            db.create_all()
+            db.session.add(SystemConfig(host_ip='10.0.0.254', user_network_cidr='10.0.0.0/24', is_configured=True))
+            db.session.commit()
+        config_cache.invalidate()
+        ruleset_cache.clear()
+        audit_log.discard()
+        audit_log._periods.clear()
+
+    def tearDown(self):
+        audit_log.discard()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def entries(self):
+        with app.app_context():
+            return [(e.action, e.user_id, e.rule_id, e.revision, audit.decode(e))
+                    for e in AuditEntry.query.order_by(AuditEntry.id)]
+
+    def test_routes_buffer_entries_until_flushed(self):
+        self.client.post('/user/add/page', data={'username': 'alice', 'ip_address': '10.0.0.2',
+                                                 'forward_mode': 'ROUTE', 'full_name': 'Alice'})
+        self.client.post('/rules/add', data={'user_id': 1, 'destination_ip': '192.0.2.1', 'protocol': 'tcp',
+                                             'destination_port': '443', 'action': 'ACCEPT'})
+        self.assertEqual(audit_log.pending(), 2)
+        self.assertEqual(self.entries(), [])
+
+        self.assertEqual(audit_log.flush(), 2)
+        (add_user, add_rule) = self.entries()
+        self.assertEqual(add_user[:4], ('user.add', 1, None, 1))
+        self.assertEqual(add_user[4]['username'], [None, 'alice'])
+        self.assertNotIn('email', add_user[4])
+        self.assertEqual(add_rule[:4], ('rule.add', 1, 1, 2))
+        self.assertEqual(add_rule[4]['destination_port'], [None, 443])
+
+    def test_edit_and_delete_store_before_and_after(self):
+        self.client.post('/user/add/page', data={'username': 'alice', 'ip_address': '10.0.0.2',
+                                                 'forward_mode': 'ROUTE', 'full_name': 'Alice'})
+        self.client.post('/user/1/edit', data={'ip_address': '10.0.0.3', 'forward_mode': 'NAT',
+                                               'user_type': 'employee', 'full_name': 'Alice'})
+        self.client.post('/user/1/delete')
+        audit_log.flush()
+        _, edit, delete = self.entries()
+        self.assertEqual(edit[0], 'user.edit')
+        self.assertEqual(edit[4], {'forward_mode': ['ROUTE', 'NAT'], 'ip_address': ['10.0.0.2', '10.0.0.3']})
+        self.assertEqual(delete[0], 'user.delete')
+        self.assertEqual(delete[4]['ip_address'], ['10.0.0.3', None])
+
+    def test_bulk_import_records_each_row(self):
+        body = "\n".join([
+            '{"username": "alice", "rules": [{"destination_ip": "1.1.1.1", "protocol": "tcp", "destination_port": 443}]}',
+            '{"username": "bob", "rules": [{"destination_ip": "8.8.8.8"}, {"destination_ip": "9.9.9.9"}]}',
+        ])
+        response = self.client.post('/api/bulk/import?kind=users&format=jsonl', data=body)
+        self.assertEqual(response.status_code, 200, response.get_json())
+        self.assertEqual(audit_log.flush(), 5)
+        entries = self.entries()
+        self.assertEqual([e[:3] for e in entries], [('user.add', 1, None), ('user.add', 2, None),
+                                                    ('rule.add', 1, 1), ('rule.add', 2, 2), ('rule.add', 2, 3)])
+        self.assertEqual({e[3] for e in entries}, {1})
+        self.assertEqual(entries[1][4]['username'], [None, 'bob'])
+        self.assertEqual(entries[2][4]['destination_port'], [None, 443])
+
+        rules = "username,destination_ip\nalice,4.4.4.4\n"
+        self.client.post('/api/bulk/import?kind=rules&format=csv', data=rules)
+        audit_log.flush()
+        self.assertEqual(self.entries()[-1][:4], ('rule.add', 1, 4, 2))
+
+    def test_gateway_and_setup_changes_are_recorded(self):
+        self.client.post('/gateways', data={'name': 'edge', 'backend': 'iptables'})
+        self.client.post('/user/add/page', data={'username': 'alice', 'ip_address': '10.0.0.2',
+                                                 'forward_mode': 'ROUTE', 'full_name': 'Alice', 'gateway_id': '1'})
+        self.client.post('/gateways/1/delete')
+        self.client.post('/setup', data={'host_ip': '10.0.0.1', 'user_network_cidr': '10.0.0.0/24'})
+        audit_log.flush()
+        actions = [(e[0], e[1], e[4]) for e in self.entries()]
+        self.assertEqual(actions[0][0], 'gateway.add')
+        self.assertIn(('user.edit', 1, {'gateway_id': [1, None]}), actions)
+        self.assertIn('gateway.delete', [a[0] for a in actions])
+        self.assertEqual(actions[-1], ('config.edit', None, {'host_ip': ['10.0.0.254', '10.0.0.1']}))
+
+    def test_user_history_pages_newest_first(self):
+        now = int(time.time())
+        entries = [{'timestamp': now + i, 'action': 'user.edit', 'user_id': 1 + i % 2, 'rule_id': None,
+                    'revision': i + 1, 'actor': None, 'data': None} for i in range(10)]
+        with app.app_context():
+            audit.write(entries)
+            db.session.commit()
+            first = audit.user_history(1, limit=3)
+            self.assertEqual([e.revision for e in first.items], [9, 7, 5])
+            second = audit.user_history(1, after=first.next_cursor, limit=3)
+            self.assertEqual([e.revision for e in second.items], [3, 1])
+            self.assertIsNone(second.next_cursor)
+
+        body = self.client.get('/api/v1/audit?user_id=2&limit=2').get_json()
+        self.assertEqual([e['revision'] for e in body['items']], [10, 8])
+        self.assertIsNotNone(body['next'])
+
+    def test_revision_diff_nets_changes(self):
+        self.client.post('/user/add/page', data={'username': 'alice', 'ip_address': '10.0.0.2',
+                                                 'forward_mode': 'ROUTE', 'email': 'a@example.com'})
+        for email in ('b@example.com', 'a@example.com', 'c@example.com'):
+            self.client.post('/user/1/edit', data={'ip_address': '10.0.0.2', 'forward_mode': 'ROUTE',
+                                                   'user_type': 'employee', 'email': email})
+        self.client.post('/rules/add', data={'user_id': 1, 'destination_ip': '192.0.2.1', 'protocol': 'tcp',
+                                             'action': 'ACCEPT'})
+        self.client.post('/rule/1/delete')
+        audit_log.flush()
+
+        with app.app_context():
+            self.assertEqual([e.revision for e in audit.revision_changes(1, 3)], [2, 3])
+            self.assertEqual(audit.revision_diff(1, 3), [])
+            changes = audit.revision_diff(1, 6)
+        self.assertEqual(changes, [{'kind': 'user', 'id': 1, 'action': 'edit',
+                                    'changes': {'email': ['a@example.com', 'c@example.com']}}])
+        body = self.client.get('/api/v1/audit?from_revision=0&to_revision=4').get_json()
+        self.assertEqual(body['changes'][0]['action'], 'add')
+        self.assertEqual(body['changes'][0]['changes']['email'], [None, 'c@example.com'])
+
+    def test_purge_drops_whole_months(self):
+        def at(year, month):
+            return calendar.timegm((year, month, 15, 0, 0, 0))
+        with app.app_context():
+            for year, month in ((2025, 1), (2025, 2), (2025, 3)):
+                audit.write([{'timestamp': at(year, month), 'action': 'apply', 'user_id': None,
+                              'rule_id': None, 'revision': None, 'actor': None, 'data': None}] * 3)
+                db.session.commit()
+            self.assertEqual([(p.period, p.first_id) for p in AuditPartition.query.order_by(AuditPartition.period)],
+                             [(202501, 1), (202502, 4), (202503, 7)])
+
+            self.assertEqual(audit.purge(now=at(2025, 3), months=1, batch_size=2), 3)
+            self.assertEqual(db.session.query(func.min(AuditEntry.id)).scalar(), 4)
+            self.assertEqual([p.period for p in AuditPartition.query], [202502, 202503])
+            self.assertEqual(audit.purge(now=at(2025, 3), months=1), 0)
+            self.assertEqual(audit.purge(now=at(2026, 1), months=0), 6)
+            self.assertEqual(AuditEntry.query.count(), 0)
+
+        self.assertEqual(audit.shift_period(202501, -1), 202412)
+        self.assertEqual(audit.shift_period(202412, 13), 202601)
+
+
+class StreamingRestoreTestCase(unittest.TestCase):
+    def test_lines_are_piped_to_iptables_restore(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, 'restored.txt')
+            stub = os.path.join(tmp, 'iptables-restore')
+            with open(stub, 'w') as f:
+                f.write(f"#!/bin/sh\ncat > {out}\n")
+            os.chmod(stub, 0o755)
+            users = [SimpleNamespace(id=1, ip_address='10.0.0.2', forward_mode='ROUTE', rules=[
+                SimpleNamespace(destination_ip='1.1.1.1', protocol='all', destination_port=None, action='ACCEPT')])]
+            manager = IptablesManager()
+            with mock.patch.dict(os.environ, {'PATH': tmp + os.pathsep + os.environ['PATH']}):
+                manager.apply_rules_stream(users)
+            with open(out) as f:
+                self.assertEqual(f.read(), manager.generate_iptables_file_content(users))
+
+class TreeDispatchTestCase(unittest.TestCase):
+    def make_user(self, user_id, ip, mode='ROUTE'):
+        rule = SimpleNamespace(destination_ip='1.1.1.1', protocol='tcp', destination_port=80, action='ACCEPT')
+        return SimpleNamespace(id=user_id, ip_address=ip, forward_mode=mode, rules=[rule])
+
+    def test_per_user_chains(self):
+        users = [self.make_user(1, '10.8.0.2'), self.make_user(2, '10.8.0.3', 'NAT')]
+        content = IptablesManager().generate_iptables_file_content(users, dispatch='tree')
+        self.assertIn(":FWM_U_1 - [0:0]", content)
+        self.assertIn("-A FWM_U_1 -d 1.1.1.1 -p tcp --dport 80 -j ACCEPT", content)
+        self.assertIn("-A FWM_N_2 -d 1.1.1.1 -p tcp --dport 80 -j MASQUERADE", content)
+        self.assertNotIn("-A FORWARD -s 10.8.0.2 -d", content)
+
+    def test_tree_depth_is_logarithmic(self):
+        targets = [(f"10.8.{i // 256}.{i % 256}", f"FWM_U_{i}") for i in range(4096)]
+        chains, rules = build_dispatch_tree(targets, "FORWARD", "FWM_T_")
+        children = {}
+        for line in rules:
+            parts = line.split()
+            children.setdefault(parts[1], []).append(parts[-1])
+
+        def depth(chain):
+            return 1 + max((depth(c) for c in children.get(chain, []) if c in children), default=0)
+
+        self.assertLessEqual(depth("FORWARD"), 12)
+        self.assertTrue(all(len(v) <= 8 for v in children.values()))
+        jumped = [r.split()[-1] for r in rules if r.split()[-1].startswith("FWM_U_")]
+        self.assertEqual(len(jumped), 4096)
+
+class BackendGoldenTestCase(unittest.TestCase):
+    """
+    Both backends render the same users; compare against the checked-in
+    files under testdata/. Run with UPDATE_GOLDEN=1 to rewrite them.
+    """
+    GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+    def rule(self, dest, port=None, protocol='tcp', action='ACCEPT', rule_id=None):
+        return SimpleNamespace(id=rule_id, destination_ip=dest, destination_port=port, protocol=protocol, action=action)
+
+    def users(self):
+        users = [
+            SimpleNamespace(id=1, ip_address='10.8.0.2', forward_mode='ROUTE', rules=[
+                self.rule('192.168.1.10', 22),
+                self.rule('192.168.1.10', 443),
+                self.rule('192.168.2.0/24', 443),
+                self.rule('192.168.2.5', 443),
+                self.rule('10.0.0.0/8', protocol='all', action='DROP'),
+                self.rule('8.8.8.8', 53, protocol='udp'),
+                self.rule('8.8.4.4', 53, protocol='udp'),
+                self.rule('1.1.1.1', protocol='icmp'),
+            ]),
+            SimpleNamespace(id=2, ip_address='10.8.0.3', forward_mode='ROUTE', rules=[
+                self.rule('172.16.0.1', 80, action='DROP'),
+                self.rule('172.16.0.0/16', protocol='all'),
+            ]),
+            SimpleNamespace(id=3, ip_address='10.8.0.4', forward_mode='NAT', rules=[
+                self.rule('203.0.113.0/24', protocol='all'),
+                self.rule('198.51.100.7', 8080),
+            ]),
+            SimpleNamespace(id=4, ip_address='10.8.0.5', forward_mode='ROUTE', rules=[]),
+        ]
+        rule_ids = itertools.count(1)
+        for user in users:
+            for rule in user.rules:
+                rule.id = next(rule_ids)
+        return users
+
+    def assert_golden(self, name, content):
+        path = os.path.join(self.GOLDEN_DIR, name)
+        if os.environ.get('UPDATE_GOLDEN'):
+            with open(path, 'w') as f:
+                f.write(content)
+        with open(path) as f:
+            self.assertEqual(content, f.read())
+
+    def test_iptables_golden(self):
+        self.assert_golden('ruleset.iptables', IptablesManager().generate_iptables_file_content(self.users()))
+
+    def test_nftables_golden(self):
+        self.assert_golden('ruleset.nft', NftablesManager().generate_nft_content(self.users()))
+
+    def test_nftables_optimized_golden(self):
+        content, ipsets, stats = NftablesManager(optimize=True).build_ruleset(self.users())
+        self.assertEqual(ipsets, {})
+        self.assertEqual(stats['shadowed'], 1)
+        # Set folding already absorbs the shadowed rule
+        self.assert_golden('ruleset.nft', content)
+
+    def test_nftables_apply_skips_unchanged_script(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            manager = NftablesManager(snapshot_path=os.path.join(tmp, 'snapshot.json'))
+            content, ipsets, _ = manager.build_ruleset(self.users())
+            with mock.patch.object(manager, '_restore') as restore, \
+                    mock.patch.object(manager, '_read_kernel_table', return_value='table ip firewall_manager {}'):
+                self.assertEqual(manager.apply_compiled(content, ipsets, incremental=True)['mode'], 'full')
+                self.assertEqual(manager.apply_compiled(content, ipsets, incremental=True)['mode'], 'noop')
+                manager._read_kernel_table.return_value = None
+                self.assertEqual(manager.apply_compiled(content, ipsets, incremental=True)['mode'], 'full')
+            self.assertEqual(restore.call_count, 2)
+
+class RulesetOptimizerTestCase(unittest.TestCase):
+    def rule(self, dest, port=None, protocol='tcp', action='ACCEPT'):
+        return SimpleNamespace(destination_ip=dest, destination_port=port, protocol=protocol, action=action)
+
+    def test_shadowed_and_multiport(self):
+        user = SimpleNamespace(id=1, ip_address='10.8.0.2', forward_mode='ROUTE', rules=[
+            self.rule('10.0.0.0/8', protocol='all'),
+            self.rule('10.1.2.3', port=22, action='DROP'),
+            self.rule('192.168.1.1', port=22),
+            self.rule('192.168.1.1', port=80),
+            self.rule('192.168.1.1', port=443),
+        ])
+        result = optimize_ruleset([user], collapse_sources=False)
+        self.assertEqual(result.stats['rules_before'], 5)
+        self.assertEqual(result.stats['rules_after'], 2)
+        self.assertEqual(result.stats['shadowed'], 1)
+        content = IptablesManager().generate_iptables_file_content(result.users)
+        self.assertIn("-A FORWARD -s 10.8.0.2 -d 192.168.1.1 -p tcp -m multiport --dports 22,80,443 -j ACCEPT",
+                      content)
+
+    def test_shared_rules_collapse_into_ipset(self):
+        users = [SimpleNamespace(id=i, ip_address=f'10.8.0.{i}', forward_mode='ROUTE',
+                                 rules=[self.rule('172.16.0.10', port=443)]) for i in range(2, 6)]
+        result = optimize_ruleset(users)
+        self.assertEqual(result.stats['rules_after'], 1)
+        (name, members), = result.ipsets.items()
+        self.assertEqual(members, ['10.8.0.2', '10.8.0.3', '10.8.0.4', '10.8.0.5'])
+        content = IptablesManager().generate_iptables_file_content(result.users)
+        self.assertIn(f"-A FORWARD -m set --match-set {name} src -d 172.16.0.10 -p tcp --dport 443 -j ACCEPT",
+                      content)
+
+    def test_order_dependent_rules_are_not_collapsed(self):
+        users = [SimpleNamespace(id=i, ip_address=f'10.8.0.{i}', forward_mode='ROUTE', rules=[
+            self.rule('172.16.0.10', port=443, action='DROP'),
+            self.rule('172.16.0.0/24', protocol='all'),
+        ]) for i in range(2, 4)]
+        result = optimize_ruleset(users)
+        self.assertEqual(result.ipsets, {})
+        self.assertEqual(result.stats['rules_after'], 4)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import delete, func, insert, literal, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Rule, RuleCounter, TrafficSample, TrafficCollectorState
+
+logger = logging.getLogger(__name__)
+
+# Seconds between collections
+COLLECT_INTERVAL = 60
+
+# Bucket widths (seconds) of the raw and rolled-up samples
+MINUTE = 60
+HOUR = 3600
+
+# Minute samples older than this are rolled up into hourly ones
+MINUTE_RETENTION = 2 * 86400
+# Hourly samples older than this are dropped
+HOUR_RETENTION = 90 * 86400
+
+# Rates on the users and rules pages average over this many seconds
+RATE_WINDOW = 300
+
+# Rows per IN (...) lookup, below SQLite's bound parameter limit
+BATCH_SIZE = 500
+
+
+def _claim(now, min_gap):
+    """
+    Records a collection at `now` unless another process collected less
+    than `min_gap` seconds ago. Returns whether this process should collect.
+    """
+    claimed = db.session.query(TrafficCollectorState) \
+        .filter(TrafficCollectorState.id == 1, TrafficCollectorState.last_run <= now - min_gap) \
+        .update({TrafficCollectorState.last_run: now}, synchronize_session=False)
+    if claimed:
+        return True
+    if db.session.get(TrafficCollectorState, 1) is not None:
+        return False
+    try:
+        with db.session.begin_nested():
+            db.session.add(TrafficCollectorState(id=1, last_run=now))
+    except IntegrityError:
+        return False
+    return True
+
+
+def _rule_owners(rule_ids):
+    owners = {}
+    rule_ids = list(rule_ids)
+    for i in range(0, len(rule_ids), BATCH_SIZE):
+        owners.update(db.session.query(Rule.id, Rule.user_id).filter(Rule.id.in_(rule_ids[i:i + BATCH_SIZE])))
+    return owners
+
+
+def record_counters(counters, now):
+    """
+    Turns a {rule_id: (packets, bytes)} kernel reading into minute samples.
+
+    The delta against the previous reading is recorded for every rule that
+    saw traffic. A rule seen for the first time only sets the baseline, and
+    a counter lower than before (the rule was reloaded) counts from zero.
+    Returns the number of samples written.
+    """
+    previous = {rule_id: (packets, byte_count) for rule_id, packets, byte_count in
+                db.session.query(RuleCounter.rule_id, RuleCounter.packets, RuleCounter.bytes)}
+    owners = _rule_owners(counters)
+    bucket = now - now % MINUTE
+
+    samples, inserts, updates = [], [], []
+    for rule_id, (packets, byte_count) in counters.items():
+        user_id = owners.get(rule_id)
+        if user_id is None:
+            # Rule deleted since the last apply
+            continue
+        old = previous.pop(rule_id, None)
+        if old is None:
+            inserts.append({'rule_id': rule_id, 'packets': packets, 'bytes': byte_count})
+            continue
+        if old == (packets, byte_count):
+            continue
+        updates.append({'rule_id': rule_id, 'packets': packets, 'bytes': byte_count})
+        if packets < old[0] or byte_count < old[1]:
+            delta = (packets, byte_count)
+        else:
+            delta = (packets - old[0], byte_count - old[1])
+        if delta[1]:
+            samples.append({'resolution': MINUTE, 'bucket': bucket, 'user_id': user_id,
+                            'rule_id': rule_id, 'packets': delta[0], 'bytes': delta[1]})
+
+    if samples:
+        db.session.execute(insert(TrafficSample), samples)
+    if inserts:
+        db.session.execute(insert(RuleCounter), inserts)
+    if updates:
+        db.session.execute(update(RuleCounter), updates)
+    # Counters no longer in the kernel
+    gone = list(previous)
+    for i in range(0, len(gone), BATCH_SIZE):
+        db.session.execute(delete(RuleCounter).where(RuleCounter.rule_id.in_(gone[i:i + BATCH_SIZE])))
+    return len(samples)
+
+
+def downsample(now):
+    """
+    Rolls minute samples older than MINUTE_RETENTION into hourly samples
+    (whole hours only) and drops hourly samples older than HOUR_RETENTION.
+    """
+    cutoff = now - MINUTE_RETENTION
+    cutoff -= cutoff % HOUR
+    hour = TrafficSample.bucket - TrafficSample.bucket % HOUR
+    rollup = select(literal(HOUR), hour, TrafficSample.user_id, TrafficSample.rule_id,
+                    func.sum(TrafficSample.packets), func.sum(TrafficSample.bytes)) \
+        .where(TrafficSample.resolution == MINUTE, TrafficSample.bucket < cutoff) \
+        .group_by(hour, TrafficSample.user_id, TrafficSample.rule_id)
+    db.session.execute(insert(TrafficSample).from_select(
+        ['resolution', 'bucket', 'user_id', 'rule_id', 'packets', 'bytes'], rollup))
+    db.session.execute(delete(TrafficSample).where(
+        TrafficSample.resolution == MINUTE, TrafficSample.bucket < cutoff))
+    db.session.execute(delete(TrafficSample).where(
+        TrafficSample.resolution == HOUR, TrafficSample.bucket < now - HOUR_RETENTION))
+
+
+def collect(backend, now=None, min_gap=0):
+    """
+    Reads every rule counter from the kernel in one listing, records the
+    deltas and rolls up old samples. Commits. Returns the number of samples
+    written, or None if another process already collected within `min_gap`
+    seconds or the counters could not be read.
+
+    The claim is committed before the listing runs and the samples are
+    written in a second transaction, so the database write lock is never
+    held while the external command runs.
+    """
+    now = int(now if now is not None else time.time())
+    if not _claim(now, min_gap):
+        db.session.rollback()
+        return None
+    db.session.commit()
+    counters = backend.read_rule_counters()
+    if counters is None:
+        return None
+    written = record_counters(counters, now)
+    downsample(now)
+    db.session.commit()
+    return written
+
+
+class TrafficCollector:
+    """
+    Collects traffic counters every `interval` seconds in a background
+    thread. Every worker process may run one; the TrafficCollectorState
+    claim lets only one of them collect per interval.
+    """
+    def __init__(self, app, backend, interval=COLLECT_INTERVAL):
+        self.app = app
+        self.backend = backend
+        self.interval = interval
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the collector thread if it is not running.
+        """
+        if self.interval <= 0:
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name='traffic-collector', daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self.app.app_context():
+                    collect(self.backend, min_gap=self.interval / 2)
+            except Exception:
+                logger.exception("Traffic collection failed")
+
+
+def _window_start(now):
+    # The RATE_WINDOW / MINUTE latest buckets, the current one included
+    now = int(now if now is not None else time.time())
+    return now - now % MINUTE - RATE_WINDOW + MINUTE
+
+
+def user_traffic_column(user_column, now=None):
+    """
+    Correlated subquery: bytes sent under `user_column`'s rules over the
+    last RATE_WINDOW seconds. Added to a listing query it costs no extra
+    round trip per row.
+    """
+    return select(func.coalesce(func.sum(TrafficSample.bytes), 0)) \
+        .where(TrafficSample.resolution == MINUTE, TrafficSample.user_id == user_column,
+               TrafficSample.bucket >= _window_start(now)) \
+        .scalar_subquery()
+
+
+def rule_traffic_column(rule_column, now=None):
+    """
+    Like user_traffic_column, for one rule.
+    """
+    return select(func.coalesce(func.sum(TrafficSample.bytes), 0)) \
+        .where(TrafficSample.resolution == MINUTE, TrafficSample.rule_id == rule_column,
+               TrafficSample.bucket >= _window_start(now)) \
+        .scalar_subquery()
+
+
+def format_rate(window_bytes):
+    """
+    Formats bytes counted over RATE_WINDOW as a bit rate.
+    """
+    bits = (window_bytes or 0) * 8 / RATE_WINDOW
+    if bits < 1000:
+        return f"{bits:.0f} bit/s"
+    for unit in ('kbit/s', 'Mbit/s', 'Gbit/s'):
+        bits /= 1000
+        if bits < 1000 or unit == 'Gbit/s':
+            return f"{bits:.1f} {unit}"